@@ -0,0 +1,175 @@
+# accumulator.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Accumulate statistics for a stream of values in one pass, using bounded memory.
+# Accumulators can be merged, so statistics for parts of a stream may be collected
+# separately, e.g. by different processes, then combined.
+
+import numpy as np
+
+# QuantileSketch
+#
+# Approximate quantiles, using a hierarchy of compactors (Karnin, Lang & Liberty, 2016).
+# Each value at level i stands for 2**i of the original values. When a level is full
+# it is sorted, and every other value is promoted to the next level, so a sketch
+# of n values holds about k*log2(n/k) values.
+
+class QuantileSketch:
+    def __init__(self,k=256):
+        self.k       = k
+        self.levels  = [[]]
+        self.parity  = [0]
+
+    def extend(self,values):
+        self.levels[0].extend(np.ravel(values).tolist())
+        self.compress()
+
+    def merge(self,other):
+        while len(self.levels)<len(other.levels):
+            self.levels.append([])
+            self.parity.append(0)
+        for level,values in enumerate(other.levels):
+            self.levels[level].extend(values)
+        self.compress()
+
+    def compress(self):
+        level = 0
+        while level<len(self.levels):
+            while len(self.levels[level])>=self.k:
+                if level+1==len(self.levels):
+                    self.levels.append([])
+                    self.parity.append(0)
+                values                 = sorted(self.levels[level])
+                # Alternate between odd and even values, so errors tend to cancel
+                self.levels[level+1].extend(values[self.parity[level]:2*(len(values)//2):2])
+                self.levels[level]     = values[2*(len(values)//2):]
+                self.parity[level]     = 1 - self.parity[level]
+            level += 1
+
+    def quantile(self,q):
+        values  = np.array([value for values in self.levels for value in values])
+        weights = np.array([2**level for level,values in enumerate(self.levels) for _ in values])
+        if len(values)==0: return np.nan
+        order   = np.argsort(values,kind='stable')
+        ranks   = np.cumsum(weights[order])
+        return values[order][np.minimum(np.searchsorted(ranks,np.asarray(q)*ranks[-1]),len(values)-1)]
+
+# Histogram
+#
+# Count values in bins of equal width. The width is a power of 2 times the initial width,
+# and bin i covers [i*width,(i+1)*width), so histograms with the same initial width can
+# be merged. When values span more than max_bins bins, the width is doubled.
+
+class Histogram:
+    def __init__(self,width=2**-10,max_bins=64):
+        self.width    = width
+        self.max_bins = max_bins
+        self.counts   = {}
+
+    def extend(self,values):
+        indices,counts = np.unique(np.floor(np.ravel(values)/self.width).astype(np.int64),return_counts=True)
+        self.add_counts(dict(zip(indices.tolist(),counts.tolist())),self.width)
+
+    def merge(self,other):
+        self.add_counts(other.counts,other.width)
+
+    def add_counts(self,counts,width):
+        while width<self.width:
+            counts = self.coarsen(counts)
+            width *= 2
+        while self.width<width:
+            self.counts = self.coarsen(self.counts)
+            self.width *= 2
+        for index,count in counts.items():
+            self.counts[index] = self.counts.get(index,0) + count
+        while len(self.counts)>0 and max(self.counts)-min(self.counts)>=self.max_bins:
+            self.counts = self.coarsen(self.counts)
+            self.width *= 2
+
+    def coarsen(self,counts):
+        product = {}
+        for index,count in counts.items():
+            product[index//2] = product.get(index//2,0) + count
+        return product
+
+    # get_bins
+    #
+    # Returns edges of all bins from lowest to highest, and counts (including empty bins)
+
+    def get_bins(self):
+        if len(self.counts)==0: return np.array([0,self.width]), np.array([0])
+        lowest  = min(self.counts)
+        indices = np.arange(lowest,max(self.counts)+1)
+        return (np.append(indices,indices[-1]+1)*self.width,
+                np.array([self.counts.get(index,0) for index in indices.tolist()]))
+
+# Accumulator
+#
+# Count, mean, variance, minimum, maximum, quantiles, and histogram for a stream of values.
+# Mean and variance are updated with the pairwise formula of Chan, Golub & LeVeque,
+# which is also used to merge accumulators.
+
+class Accumulator:
+    def __init__(self,width=2**-10,max_bins=64,k=256):
+        self.n         = 0
+        self.mean      = 0.0
+        self.M2        = 0.0     # Sum of squared deviations from mean
+        self.min       = np.inf
+        self.max       = -np.inf
+        self.sketch    = QuantileSketch(k=k)
+        self.histogram = Histogram(width=width,max_bins=max_bins)
+
+    def add(self,value):
+        self.extend([value])
+
+    def extend(self,values):
+        values = np.ravel(values).astype(float)
+        if len(values)==0: return
+        self.update_moments(len(values),np.mean(values),np.sum((values-np.mean(values))**2))
+        self.min = min(self.min,np.min(values))
+        self.max = max(self.max,np.max(values))
+        self.sketch.extend(values)
+        self.histogram.extend(values)
+
+    def merge(self,other):
+        if other.n==0: return
+        self.update_moments(other.n,other.mean,other.M2)
+        self.min = min(self.min,other.min)
+        self.max = max(self.max,other.max)
+        self.sketch.merge(other.sketch)
+        self.histogram.merge(other.histogram)
+
+    def update_moments(self,n,mean,M2):
+        total      = self.n + n
+        delta      = mean - self.mean
+        self.M2   += M2 + delta**2 * self.n * n / total
+        self.mean += delta * n / total
+        self.n     = total
+
+    def std(self):
+        return np.sqrt(self.M2/self.n) if self.n>0 else np.nan
+
+    def cv(self):
+        return self.std()/self.mean if self.n>0 else np.nan
+
+    def quantile(self,q):
+        return self.sketch.quantile(q)
+
+    def __str__(self):
+        q05,q50,q95 = self.quantile([0.05,0.5,0.95]) if self.n>0 else (np.nan,)*3
+        return (f'n={self.n}, mean={self.mean:.6g}, std={self.std():.6g}, CV={self.cv():.2}, '
+                f'min={self.min:.6g}, 5%={q05:.6g}, median={q50:.6g}, 95%={q95:.6g}, max={self.max:.6g}')
@@ -0,0 +1,299 @@
+# agesepir.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Age-structured version of the SEPIR model (see sepir.py), with A age bands mixing
+# according to a contact matrix.
+#
+# The state is a (7,A) array, one column for each band, holding fractions of that band's
+# population; it is flattened (compartment by compartment) for solve_ivp. People in band a
+# are infected at rate beta * S[a] * (contacts @ (epsilon*P + I))[a], where contacts[a,b]
+# is the average number of contacts that someone in band a has with people in band b.
+# beta is chosen so that the largest eigenvalue of the next generation matrix is R0.
+#
+# ICU beds are shared by all bands, so each band's case fatality rate depends on the total
+# demand for beds, D = N * sum(share*pICU*I). As in sepir.dy,
+#     CFR[a] = CFR1[a] - (nICU/D) * (CFR1[a] - CFR0[a]),
+# but only while demand exceeds the number of beds; otherwise CFR[a] = CFR0[a] (as in
+# stochastic.py and metapop.py). Without this, the recovered terms would jump as D
+# approached zero, and the implicit solvers fail at the start of an outbreak when bands
+# have their own CFR0 and CFR1. So with one band, this is the model of sepir.dy, except
+# while the ICUs can cope.
+#
+# pICU, CFR0, and CFR1 may have one value for each band, as may c, alpha, gamma, delta,
+# and epsilon; all are broadcast against the bands. An AgeBands object, which holds the
+# population shares, contacts, and band parameters, can be used by sepir.py and t028.py
+# in place of the sepir module.
+
+import argparse, numpy as np, sepir
+
+# get_band_values
+#
+# Reshape a parameter that has one value for each band, so it broadcasts against
+# compartments of shape (A,K); scalars are left alone.
+
+def get_band_values(value):
+    return np.reshape(value,(-1,1)) if np.ndim(value)==1 else value
+
+# dy
+#
+# Compute derivative of state, using array operations. y may have shape (7*A,), or
+# (7*A,K) to evaluate K states at once, so it can be used with solve_ivp(...,vectorized=True).
+#
+# Parameters:
+#     t
+#     y         State, flattened from shape (7,A)
+#     N         Total population
+#     beta      Transmission coefficient (see get_beta)
+#     nICU      Number of ICU beds, shared by all bands
+#     share     Proportion of population in each band
+#     contacts  Contact matrix, shape (A,A)
+#     Others as for sepir.dy (scalars, or one value for each band)
+
+def dy(t,y,N,c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,nICU,pICU,share,contacts):
+    shape             = np.shape(y)
+    S,E,P,I0,I1,_,_   = np.reshape(y,(7,len(share),-1))
+    c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,pICU,share = \
+        [get_band_values(value) for value in [c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,pICU,share]]
+    I         = I0 + I1
+    infection = beta * S * (contacts @ (epsilon*P + I))
+    demand    = N * np.sum(share*pICU*I,axis=0)                 # ICU beds needed
+    # 1 - CFR = (1-CFR1) + excess
+    excess    = (CFR1 - CFR0) * np.where(demand>nICU, nICU/np.maximum(demand,nICU), 1)
+    return np.concatenate([-infection,
+                           infection - alpha*E,
+                           alpha*E - delta*P,
+                           delta*P - (gamma + c)*I0,
+                           c*I0 - gamma*I1,
+                           gamma*((1-CFR1)*I0 + excess*I0),
+                           gamma*((1-CFR1)*I1 + excess*I1)]).reshape(shape)
+
+# jacobian
+#
+# Exact Jacobian of dy with respect to y, which must have shape (7*A,). It is dense, with
+# 7 x 7 blocks, each A x A: infection couples bands through contacts, and deaths couple
+# them through the shared demand for ICU beds.
+
+def jacobian(t,y,N,c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,nICU,pICU,share,contacts):
+    A               = len(share)
+    S,E,P,I0,I1,_,_ = np.reshape(y,(7,A))
+    ones            = np.ones(A)
+    c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,pICU = \
+        [value*ones for value in [c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,pICU]]
+    I        = I0 + I1
+    force    = beta * (contacts @ (epsilon*P + I))
+    contact  = (beta*S)[:,None] * contacts                 # d(infection)/dI, for I0 and I1
+    demand   = N * np.sum(share*pICU*I)
+    J        = np.zeros((7,A,7,A))
+    bands    = np.arange(A)
+    def set_diagonal(i,j,values):
+        J[i,bands,j,bands] = values
+    set_diagonal(0,0,-force)
+    J[0,:,2] = -contact * epsilon
+    J[0,:,3] = -contact
+    J[0,:,4] = -contact
+    set_diagonal(1,0,force)
+    set_diagonal(1,1,-alpha)
+    J[1,:,2] = contact * epsilon
+    J[1,:,3] = contact
+    J[1,:,4] = contact
+    set_diagonal(2,1,alpha)
+    set_diagonal(2,2,-delta)
+    set_diagonal(3,2,delta)
+    set_diagonal(3,3,-(gamma + c))
+    set_diagonal(4,3,c)
+    set_diagonal(4,4,-gamma)
+    if demand>nICU:
+        # The recovered terms include gamma*k*I0/D, with k = nICU*(CFR1-CFR0), and D depends
+        # on I0 and I1 in every band
+        k          = gamma * nICU * (CFR1 - CFR0) / demand
+        d_demand   = N * share * pICU / demand              # d(log D)/dI, for I0 and I1
+        set_diagonal(5,3,gamma*(1 - CFR1) + k)
+        set_diagonal(6,4,gamma*(1 - CFR1) + k)
+        for i,Ii in [(5,I0),(6,I1)]:
+            J[i,:,3] -= np.outer(k*Ii,d_demand)
+            J[i,:,4] -= np.outer(k*Ii,d_demand)
+    else:
+        set_diagonal(5,3,gamma*(1 - CFR0))
+        set_diagonal(6,4,gamma*(1 - CFR0))
+    return J.reshape(7*A,7*A)
+
+# get_beta
+#
+# Compute transmission coefficient, so that the largest eigenvalue of the next generation
+# matrix, beta * contacts * (epsilon/delta + 1/gamma), is R0. With one band and contacts
+# [[1]], this is sepir.get_beta.
+
+def get_beta(R0=2.5,gamma=0.1,delta=1.0,epsilon=0.15,contacts=np.ones((1,1))):
+    infectiousness = np.broadcast_to(epsilon/delta + 1/gamma,len(contacts))
+    return R0/np.max(np.abs(np.linalg.eigvals(contacts*infectiousness[None,:])))
+
+# get_initial_y
+#
+# Initialize population: the initial exposed are spread across bands in proportion to
+# their populations, so the same fraction of each band is exposed
+
+def get_initial_y(initial=1,N=1000,A=1):
+    return np.repeat(sepir.get_initial_y(initial=initial,N=N),A)
+
+# get_totals
+#
+# Add bands together: convert a state, flattened from (7,A), or a solution of shape
+# (7*A,T), to fractions of the whole population, with shape (7,) or (7,T)
+
+def get_totals(y,share):
+    y = np.asarray(y)
+    return np.tensordot(share,y.reshape((7,len(share))+y.shape[1:]),axes=([0],[1]))
+
+# get_ICU_demand
+#
+# Number of ICU beds needed by each band, from a solution of shape (7*A,T)
+
+def get_ICU_demand(y,N,share,pICU):
+    y    = np.reshape(y,(7,len(share),-1))
+    I    = y[sepir.Indices.INFECTIOUS_UNTESTED.value] + y[sepir.Indices.INFECTIOUS_TESTED.value]
+    return N * get_band_values(share) * get_band_values(pICU) * I
+
+# AgeBands
+#
+# Population shares, contacts, and band parameters, with methods that match the functions
+# of the sepir module, so that an AgeBands object can be used in place of sepir. Values of
+# pICU, CFR0 and CFR1 given for bands take the place of the scalars passed to the methods.
+
+class AgeBands:
+    # Parameters:
+    #     share     Proportion of population in each band (normalized to sum to 1)
+    #     contacts  Contact matrix, shape (A,A) (default: homogeneous mixing)
+    #     pICU      Proportion of cases requiring ICU, for each band (optional)
+    #     CFR0      Case fatality rate for cases under ICU max, for each band (optional)
+    #     CFR1      Case fatality rate for cases exceeding ICU max, for each band (optional)
+    #     names     Name of each band, for display
+    def __init__(self,share,contacts=None,pICU=None,CFR0=None,CFR1=None,names=None):
+        self.share    = np.asarray(share,dtype=float)/np.sum(share)
+        self.contacts = np.tile(self.share,(len(self.share),1)) if contacts is None else np.asarray(contacts,dtype=float)
+        self.pICU     = None if pICU is None else np.asarray(pICU,dtype=float)
+        self.CFR0     = None if CFR0 is None else np.asarray(CFR0,dtype=float)
+        self.CFR1     = None if CFR1 is None else np.asarray(CFR1,dtype=float)
+        self.names    = [str(i) for i in range(len(self.share))] if names is None else list(names)
+        if self.contacts.shape!=(len(self.share),len(self.share)):
+            raise ValueError(f'Contact matrix has shape {self.contacts.shape}, but there are {len(self.share)} bands')
+
+    def __len__(self):
+        return len(self.share)
+
+    # get_args
+    #
+    # Complete arguments for dy or jacobian, from the arguments of sepir.dy
+
+    def get_args(self,N,c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,nICU,pICU):
+        return (N, c, alpha, beta, gamma, delta, epsilon,
+                CFR1 if self.CFR1 is None else self.CFR1,
+                CFR0 if self.CFR0 is None else self.CFR0,
+                nICU,
+                pICU if self.pICU is None else self.pICU,
+                self.share,
+                self.contacts)
+
+    def dy_vectorized(self,t,y,*args):
+        return dy(t,y,*self.get_args(*args))
+
+    def jacobian(self,t,y,*args):
+        return jacobian(t,y,*self.get_args(*args))
+
+    def get_beta(self,R0=2.5,gamma=0.1,delta=1.0,epsilon=0.15):
+        return get_beta(R0=R0,gamma=gamma,delta=delta,epsilon=epsilon,contacts=self.contacts)
+
+    def get_initial_y(self,initial=1,N=1000):
+        return get_initial_y(initial=initial,N=N,A=len(self))
+
+    def get_solver_options(self,method='RK45'):
+        options = dict(method=method)
+        if method in sepir.IMPLICIT_METHODS:
+            options['vectorized'] = True
+            options['jac']        = self.jacobian
+        return options
+
+    def get_totals(self,y):
+        return get_totals(y,self.share)
+
+    # get_key
+    #
+    # Everything that determines a solution, for cache keys
+
+    def get_key(self):
+        return dict(share=self.share,contacts=self.contacts,pICU=self.pICU,CFR0=self.CFR0,CFR1=self.CFR1)
+
+# load_bands
+#
+# Read age bands from a CSV file, with a header and one row for each band. The file must
+# have a column population (or share); it may also have columns name, pICU, CFR0, and CFR1.
+# The contact matrix is read from a separate CSV file, with one row for each band and no
+# header; if there is none, bands mix homogeneously.
+
+def load_bands(file_name,contacts=None):
+    bands = np.genfromtxt(file_name,delimiter=',',names=True,dtype=None,encoding='utf-8')
+    bands = np.atleast_1d(bands)
+    names = bands.dtype.names
+    return AgeBands(bands['population'] if 'population' in names else bands['share'],
+                    contacts = None if contacts==None else np.loadtxt(contacts,delimiter=',',ndmin=2),
+                    pICU     = bands['pICU'] if 'pICU' in names else None,
+                    CFR0     = bands['CFR0'] if 'CFR0' in names else None,
+                    CFR1     = bands['CFR1'] if 'CFR1' in names else None,
+                    names    = bands['name'] if 'name' in names else None)
+
+if __name__=='__main__':
+    from scipy.integrate import solve_ivp
+
+    parser = argparse.ArgumentParser('Age-structured SEPIR model: ICU demand and deaths for each band')
+    parser.add_argument('bands',                     help='CSV file of age bands (see load_bands)')
+    parser.add_argument('--contacts',                default=None,     help='CSV file of contact matrix (default: homogeneous mixing)')
+    parser.add_argument('--R0',         type=float, default=2.5,      help='Basic Reproduction number')
+    parser.add_argument('--initial',    type=int,   default=20,       help='Number of exposed people at start')
+    parser.add_argument('--N',          type=int,   default=5000000,  help='Population size')
+    parser.add_argument('--nICU',       type=int,   default=300,      help='Number of ICU beds')
+    parser.add_argument('--end',        type=int,   default=400,      help='Number of days to be simulated')
+    parser.add_argument('--c',          type=float, default=0.1,      help='Testing rate for symptomatic cases, per diem')
+    parser.add_argument('--alpha',      type=float, default=0.25,     help='E to P transition rate, per diem')
+    parser.add_argument('--gamma',      type=float, default=0.1,      help='I to R tranition, per diem')
+    parser.add_argument('--delta',      type=float, default=1.0,      help='P to I, per diem')
+    parser.add_argument('--epsilon',    type=float, default=0.15,     help='Relative infectiousness')
+    parser.add_argument('--CFR1',       type=float, default=2.0/100,  help='Case Fatality Rate with cases exceeding ICU max (unless given for bands)')
+    parser.add_argument('--CFR0',       type=float, default=1.0/100,  help='Case Fatality Rate for cases under ICU max (unless given for bands)')
+    parser.add_argument('--pICU',       type=float, default=1.25/100, help='Proportion of cases requiring ICU (unless given for bands)')
+    parser.add_argument('--method',                 default='RK45',   help='Integration method for solve_ivp',
+                        choices=['RK45','RK23','DOP853']+sepir.IMPLICIT_METHODS)
+    args = parser.parse_args()
+
+    ages = load_bands(args.bands,contacts=args.contacts)
+    beta = ages.get_beta(R0=args.R0,gamma=args.gamma,delta=args.delta,epsilon=args.epsilon)
+    sol  = solve_ivp(ages.dy_vectorized,(0,args.end),ages.get_initial_y(initial=args.initial,N=args.N),
+                     args   = (args.N,args.c,args.alpha,beta,args.gamma,args.delta,args.epsilon,
+                               args.CFR1,args.CFR0,args.nICU,args.pICU),
+                     t_eval = np.arange(args.end+1),
+                     atol   = 1e-9,
+                     rtol   = 1e-6,
+                     **ages.get_solver_options(args.method))
+    pICU   = args.pICU if ages.pICU is None else ages.pICU
+    demand = get_ICU_demand(sol.y,args.N,ages.share,pICU)
+    y      = sol.y.reshape(7,len(ages),-1)[:,:,-1]
+    deaths = args.N * ages.share * (1 - y.sum(axis=0))
+    print (f'{"Band":12s}{"Population":>12s}{"Infections":>12s}{"Peak ICU":>10s}{"Day":>6s}{"Deaths":>10s}')
+    for a,name in enumerate(ages.names):
+        print (f'{name:12s}{args.N*ages.share[a]:12.0f}{args.N*ages.share[a]*(1-y[0,a]):12.0f}'
+               f'{demand[a].max():10.1f}{sol.t[demand[a].argmax()]:6.0f}{deaths[a]:10.1f}')
+    total = demand.sum(axis=0)
+    print (f'Peak ICU demand {total.max():.1f} on day {sol.t[total.argmax()]:.0f}, '
+           f'with {args.nICU} beds: exceeded for {np.sum(total>args.nICU)} days')
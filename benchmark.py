@@ -0,0 +1,368 @@
+# benchmark.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmarks for the model (sepir.dy, t028.evolveR0, t028.monte_carlo) and the corpus
+# tools (verify-links.link_data, extract-keys tokenization), so that changes in
+# performance can be measured.
+#
+# Each benchmark uses fixed seeds and parameters. The corpus tools are run on a
+# synthetic corpus with the same layout as CORD-19 (json files and metadata.csv),
+# so no data need to be downloaded. Results are written to a json file, with
+# throughput, percentiles of times, and peak memory, and may be compared with the
+# results of an earlier run, such as benchmark-baseline.json.
+#
+# Each benchmark runs in a fresh process, since peak memory is a high-water mark
+# for the whole process, and would otherwise include every benchmark run before it.
+
+import argparse, contextlib, io, json, os, platform, random, sys, tempfile, time, numpy as np, pandas as pd
+import importlib.util, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join, dirname, abspath
+
+try:
+    import resource
+except ImportError:           # Not available on Windows
+    resource = None
+
+# load_script
+#
+# Import one of the scripts whose names contain hyphens, e.g. verify-links.py
+
+def load_script(name):
+    spec   = importlib.util.spec_from_file_location(name.replace('-','_'),join(dirname(abspath(__file__)),f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# get_peak_rss
+#
+# Largest resident set size so far (MB) of this process, and of its child processes that have finished.
+# These never decrease, so each benchmark is measured in a process of its own (see run_benchmark).
+
+def get_peak_rss():
+    if resource==None: return None, None
+    scale = 1/2**20 if sys.platform=='darwin' else 1/2**10     # ru_maxrss is in bytes on macOS, otherwise KB
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+# create_corpus
+#
+# Create a synthetic corpus: json files in document_parses/pdf_json, and metadata.csv.
+# Some metadata records have several shas, some papers are only linked by pmcid, and
+# some papers have no metadata.
+#
+# Parameters:
+#     path        Where corpus is to be created
+#     papers      Number of papers
+#     segments    Number of segments of body_text in each paper
+#     words       Number of words in each segment
+#     vocabulary  Number of distinct words
+#     seed        Seed for random number generator
+
+def create_corpus(path,papers=1000,segments=10,words=100,vocabulary=5000,seed=1):
+    rng       = random.Random(seed)
+    lexicon   = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3,10)))
+                 for _ in range(vocabulary)]
+    weights   = [1/(rank+1) for rank in range(vocabulary)]     # Zipf's law
+    json_path = join(path,'document_parses','pdf_json')
+    os.makedirs(json_path,exist_ok=True)
+    records   = []
+    for i in range(papers):
+        paper_id = f'{rng.getrandbits(160):040x}' if rng.random()<0.8 else f'PMC{1000000+i}'
+        title    = ' '.join(rng.choices(lexicon,weights,k=8)).capitalize()
+        with open(join(json_path,f'{paper_id}.json'),'w') as json_file:
+            json.dump({'paper_id'   : paper_id,
+                       'metadata'   : {'title':title,'authors':[]},
+                       'abstract'   : [],
+                       'body_text'  : [{'text'      : ' '.join(rng.choices(lexicon,weights,k=words)) + '.',
+                                         'cite_spans': [],
+                                         'ref_spans' : [],
+                                         'section'   : 'Introduction'} for _ in range(segments)],
+                       'bib_entries': {},
+                       'ref_entries': {},
+                       'back_matter': []},
+                      json_file)
+        if rng.random()<0.05: continue                         # Paper without metadata
+        is_pmc = paper_id.startswith('PMC')
+        sha    = '' if is_pmc else paper_id
+        if not is_pmc and rng.random()<0.1:
+            sha = f'{sha}; {rng.getrandbits(160):040x}'
+        records.append({'cord_uid'                    : f'{rng.getrandbits(32):08x}',
+                        'sha'                         : sha,
+                        'source_x'                    : 'PMC' if is_pmc else 'Elsevier',
+                        'title'                       : title,
+                        'doi'                         : f'10.1000/{i}',
+                        'pmcid'                       : paper_id if is_pmc else '',
+                        'pubmed_id'                   : rng.randint(10**7,10**8),
+                        'license'                     : 'cc-by',
+                        'abstract'                    : ' '.join(rng.choices(lexicon,weights,k=200)),
+                        'publish_time'                : '2020-03-01',
+                        'authors'                     : 'Smith, J.; Jones, K.',
+                        'journal'                     : 'Journal',
+                        'Microsoft Academic Paper ID' : '',
+                        'WHO #Covidence'              : '',
+                        'has_pdf_parse'               : not is_pmc,
+                        'has_pmc_xml_parse'           : is_pmc,
+                        'full_text_file'              : 'custom_license',
+                        'url'                         : ''})
+    pd.DataFrame(records).to_csv(join(path,'metadata.csv'),index=False)
+
+# measure
+#
+# Time a function several times
+#
+# Parameters:
+#     function  Function to be timed (no arguments)
+#     items     Number of items (e.g. runs or documents) processed by each call
+#     repeat    Number of times to call function
+#     warmup    Number of calls before timing starts
+#
+# Returns:
+#     dict of statistics
+
+def measure(function,items=1,repeat=5,warmup=1):
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    times           = np.array(times)
+    peak,children   = get_peak_rss()
+    return {'repeat'             : repeat,
+            'items'              : items,
+            'mean'               : float(times.mean()),
+            'min'                : float(times.min()),
+            'p50'                : float(np.percentile(times,50)),
+            'p90'                : float(np.percentile(times,90)),
+            'p99'                : float(np.percentile(times,99)),
+            'max'                : float(times.max()),
+            'throughput'         : float(items/np.median(times)),
+            'peak_rss_mb'        : peak,
+            'peak_rss_children_mb': children}
+
+# get_rhs
+#
+# A right hand side as solve_ivp calls it: wrapped by the solver for the method, which
+# passes args, converts the result to an array, and adds a column to y if the function
+# is vectorized (see sepir.get_solver_options)
+
+def get_rhs(fun,y,args,options):
+    import scipy.integrate
+    options = dict(options)
+    method  = options.pop('method')
+    if callable(options.get('jac')):
+        options['jac'] = lambda t,x,jac=options['jac']: jac(t,x,*args)
+    solver  = getattr(scipy.integrate,method)(lambda t,x: fun(t,x,*args),0,y,1,**options)
+    return solver.fun
+
+# Benchmarks
+#
+# Each returns the function to be timed, and the number of items it processes
+
+SEPIR_PARAMS = (5000000, 0.1, 0.25, 0.2463, 0.1, 1, 0.15, 0.02, 0.01, 300, 0.0125)
+
+def bench_rhs(fun,y,args,options):
+    rhs   = get_rhs(fun,y,args,options)
+    calls = 10000
+    def run():
+        for i in range(calls):
+            rhs(i/calls,y)
+    return run, calls
+
+def bench_dy(args):
+    import sepir
+    return bench_rhs(sepir.dy,
+                     np.array([0.9, 0.02, 0.01, 0.03, 0.02, 0.01, 0.01]),
+                     SEPIR_PARAMS,
+                     dict(method='RK45'))
+
+def bench_dy_vectorized(args):
+    import sepir
+    return bench_rhs(sepir.dy_vectorized,
+                     np.array([0.9, 0.02, 0.01, 0.03, 0.02, 0.01, 0.01]),
+                     SEPIR_PARAMS,
+                     sepir.get_solver_options('RK45'))
+
+def bench_dy_vectorized_BDF(args):
+    import sepir
+    return bench_rhs(sepir.dy_vectorized,
+                     np.array([0.9, 0.02, 0.01, 0.03, 0.02, 0.01, 0.01]),
+                     SEPIR_PARAMS,
+                     sepir.get_solver_options('BDF'))
+
+def bench_dy_ages(args):
+    import agesepir
+    rng    = np.random.default_rng(args.seed)
+    ages   = agesepir.AgeBands(rng.uniform(1,2,16),rng.uniform(0,3,(16,16)),pICU=rng.uniform(0.001,0.05,16))
+    return bench_rhs(ages.dy_vectorized,
+                     np.repeat([0.9, 0.02, 0.01, 0.03, 0.02, 0.01, 0.01],16),
+                     (5000000, 0.1, 0.25, ages.get_beta(), 0.1, 1, 0.15, 0.02, 0.01, 300, 0.0125),
+                     ages.get_solver_options('RK45'))
+
+def bench_evolveR0(args):
+    import t028
+    rng   = random.Random(args.seed)
+    NPIs  = [t028.create_NPIs(start=150,R0=2.5,lower_bound=0.9,upper_bound=1,dt=10,rng=rng) for _ in range(10)]
+    def run():
+        for member_NPIs in NPIs:
+            t028.evolveR0(NPIs=member_NPIs,atol=1e-9,rtol=1e-9)
+    return run, len(NPIs)
+
+def get_t028_args(extra=[]):
+    import t028
+    argv     = sys.argv
+    sys.argv = ['t028.py','--M',str(50),'--seed','1'] + extra
+    try:
+        return t028.parse_args()
+    finally:
+        sys.argv = argv
+
+def bench_monte_carlo(args):
+    import t028
+    t028_args = get_t028_args()
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            t028.monte_carlo(t028_args,t028_args.start)
+    return run, t028_args.M
+
+def bench_monte_carlo_ensemble(args):
+    import t028
+    t028_args = get_t028_args(['--ensemble'])
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            t028.monte_carlo(t028_args,t028_args.start)
+    return run, t028_args.M
+
+def bench_link_data(args):
+    verify_links = load_script('verify-links')
+    metadata     = verify_links.fix_semicolons(verify_links.create_meta_data(cord_path=args.corpus,snapshot=None))
+    papers       = list(verify_links.create_json_dict(cord_path=args.corpus))
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            verify_links.link_data(metadata,papers)
+    return run, len(papers)
+
+def bench_create_meta_data(args):
+    verify_links = load_script('verify-links')
+    def run():
+        verify_links.create_meta_data(cord_path=args.corpus,snapshot=None)
+    return run, 1
+
+def bench_scan_papers(args):
+    import corpus
+    file_names = list(corpus.find_json_files(args.corpus))
+    def run():
+        for _ in corpus.scan_papers(args.corpus):
+            pass
+    return run, len(file_names)
+
+def bench_extract_keys(args):
+    extract_keys = load_script('extract-keys')
+    import corpus
+    file_names   = list(corpus.find_json_files(args.corpus))
+    def run():
+        extract_keys.count_words(file_names)
+    return run, len(file_names)
+
+BENCHMARKS = {'dy'                  : bench_dy,
+              'dy_vectorized'       : bench_dy_vectorized,
+              'dy_vectorized_BDF'   : bench_dy_vectorized_BDF,
+              'dy_ages'             : bench_dy_ages,
+              'evolveR0'            : bench_evolveR0,
+              'monte_carlo'         : bench_monte_carlo,
+              'monte_carlo_ensemble': bench_monte_carlo_ensemble,
+              'create_meta_data'    : bench_create_meta_data,
+              'link_data'           : bench_link_data,
+              'scan_papers'         : bench_scan_papers,
+              'extract_keys'        : bench_extract_keys}
+
+# run_benchmark
+#
+# Set up and measure one benchmark. Returns dict of statistics, or the reason it was skipped
+
+def run_benchmark(name,args):
+    try:
+        run,items = BENCHMARKS[name](args)
+    except ImportError as err:
+        return {'skipped':str(err)}
+    return measure(run,items=items,repeat=args.repeat)
+
+# compare
+#
+# Compare median times with baseline. Returns names of benchmarks that are slower
+# than the baseline by more than threshold (a fraction).
+
+def compare(results,baseline,threshold=0.1):
+    regressions = []
+    print (f'{"Benchmark":24s}{"Baseline":>12s}{"Current":>12s}{"Ratio":>8s}')
+    for name,result in results['benchmarks'].items():
+        if name not in baseline['benchmarks'] or 'p50' not in result or 'p50' not in baseline['benchmarks'][name]:
+            continue
+        before = baseline['benchmarks'][name]['p50'] / baseline['benchmarks'][name]['items']
+        after  = result['p50'] / result['items']
+        ratio  = after/before
+        flag   = ' *' if ratio>1+threshold else ''
+        print (f'{name:24s}{before:12.3g}{after:12.3g}{ratio:8.2f}{flag}')
+        if ratio>1+threshold:
+            regressions.append(name)
+    return regressions
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser('Benchmark model and corpus tools')
+    parser.add_argument('--out',                   default='benchmark.json', help='File for results')
+    parser.add_argument('--baseline',              default=None,             help='Results of an earlier run, for comparison')
+    parser.add_argument('--threshold', type=float, default=0.1,              help='Report benchmarks this much slower than baseline (fraction)')
+    parser.add_argument('--only',                  default=None,             help='Benchmarks to run', nargs='+', choices=list(BENCHMARKS))
+    parser.add_argument('--repeat',    type=int,   default=5,                help='Number of times to run each benchmark')
+    parser.add_argument('--seed',      type=int,   default=1,                help='Seed for random number generator')
+    parser.add_argument('--corpus',                default=None,             help='Directory for synthetic corpus (default: temporary)')
+    parser.add_argument('--papers',    type=int,   default=1000,             help='Number of papers in synthetic corpus')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary:
+        if args.corpus==None:
+            args.corpus = temporary
+        if not os.path.exists(join(args.corpus,'metadata.csv')):
+            create_corpus(args.corpus,papers=args.papers,seed=args.seed)
+
+        results = {'python'    : sys.version,
+                   'platform'  : platform.platform(),
+                   'processor' : platform.processor(),
+                   'time'      : time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'settings'  : {key:value for key,value in vars(args).items() if key not in ['out','baseline']},
+                   'benchmarks': {}}
+        for name in args.only if args.only!=None else BENCHMARKS:
+            with ProcessPoolExecutor(max_workers=1,mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(run_benchmark,name,args).result()
+            results['benchmarks'][name] = result
+            if 'skipped' in result:
+                print (f'{name}: skipped ({result["skipped"]})')
+            else:
+                print (f'{name}: {result["throughput"]:.4g} per second, median {result["p50"]:.4g} s' +
+                       ('' if result['peak_rss_mb']==None else f', peak memory {result["peak_rss_mb"]:.4g} MB'))
+
+    with open(args.out,'w') as out:
+        json.dump(results,out,indent=2)
+
+    if args.baseline!=None:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results,json.load(baseline_file),threshold=args.threshold)
+        if len(regressions)>0:
+            print (f'Slower than baseline: {", ".join(regressions)}')
+            sys.exit(1)
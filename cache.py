@@ -0,0 +1,155 @@
+# cache.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cache for solutions of the model, so a solve that has been done before can be loaded
+# instead of being repeated.
+#
+# Each entry is identified by a hash of the parameters that determine it, and stored
+# on disk as a directory of .npy files, one for each array, which are memory-mapped when
+# loaded. The most recently used entries are also kept in memory. When the entries on
+# disk exceed a given size, those least recently used are removed. Each process keeps
+# a running total of the size on disk, so the entries are only listed when some need
+# to be removed.
+
+import hashlib, json, os, shutil, tempfile, numpy as np
+from collections import OrderedDict
+from os.path import join, exists
+
+class SolutionCache:
+    # Parameters:
+    #     path       Directory for cache
+    #     max_bytes  Maximum size of entries on disk
+    #     max_items  Maximum number of entries to keep in memory
+    def __init__(self,path='./cache',max_bytes=2**30,max_items=128):
+        self.path      = path
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.memory    = OrderedDict()
+        os.makedirs(path,exist_ok=True)
+        self.total     = sum(size for _,size,_ in self.get_entries())
+
+    # get_key
+    #
+    # Hash of parameters, which must be numbers, strings, None, or lists, tuples, dicts or
+    # arrays of these. Other types raise TypeError, since different objects could look
+    # the same if they were converted to strings.
+
+    def get_key(self,params):
+        def convert(x):
+            if hasattr(x,'tolist'):
+                return x.tolist()
+            raise TypeError(f'Cannot use {type(x).__name__} in key for cache')
+        return hashlib.sha256(json.dumps(params,sort_keys=True,default=convert).encode()).hexdigest()
+
+    # get
+    #
+    # Retrieve arrays stored for params: returns a dict of arrays, or None if there is no entry
+
+    def get(self,params):
+        key = self.get_key(params)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        entry = join(self.path,key)
+        try:
+            arrays = {name[:-4]:np.load(join(entry,name),mmap_mode='r')
+                      for name in os.listdir(entry) if name.endswith('.npy')}
+            os.utime(entry)
+        except (FileNotFoundError,ValueError):
+            return None
+        self.remember(key,arrays)
+        return arrays
+
+    # put
+    #
+    # Store arrays for params. The entry is written to a temporary directory and then renamed,
+    # so processes sharing the cache never see part of an entry.
+
+    def put(self,params,**arrays):
+        key   = self.get_key(params)
+        entry = join(self.path,key)
+        if not exists(entry):
+            temporary = tempfile.mkdtemp(dir=self.path,prefix='.tmp')
+            size      = 0
+            for name,array in arrays.items():
+                np.save(join(temporary,f'{name}.npy'),np.asarray(array))
+                size += os.path.getsize(join(temporary,f'{name}.npy'))
+            try:
+                os.rename(temporary,entry)
+                self.total += size
+            except OSError:         # Another process got there first
+                shutil.rmtree(temporary,ignore_errors=True)
+            if self.total>self.max_bytes:
+                self.evict()
+        self.remember(key,arrays)
+
+    def remember(self,key,arrays):
+        self.memory[key] = arrays
+        self.memory.move_to_end(key)
+        while len(self.memory)>self.max_items:
+            self.memory.popitem(last=False)
+
+    # get_entries
+    #
+    # Time of last use, size, and path of each entry on disk
+
+    def get_entries(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_dir() and not entry.name.startswith('.'):
+                try:
+                    size = sum(item.stat().st_size for item in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime,size,entry.path))
+                except FileNotFoundError:
+                    pass
+        return entries
+
+    # evict
+    #
+    # Remove least recently used entries from disk until total size is within limit. The
+    # entries are listed again, since other processes sharing the cache may have added
+    # or removed some.
+
+    def evict(self):
+        entries    = self.get_entries()
+        self.total = sum(size for _,size,_ in entries)
+        for _,size,path in sorted(entries):
+            if self.total<=self.max_bytes: break
+            shutil.rmtree(path,ignore_errors=True)
+            self.total -= size
+
+    # memoize
+    #
+    # Return arrays stored for params, or compute them (compute returns a dict of arrays) and store them
+
+    def memoize(self,params,compute):
+        arrays = self.get(params)
+        if arrays==None:
+            arrays = compute()
+            self.put(params,**arrays)
+        return arrays
+
+# open_cache
+#
+# Each process shares one SolutionCache for each path, so the entries in memory are reused
+
+caches = {}
+
+def open_cache(path,**kwargs):
+    if path not in caches:
+        caches[path] = SolutionCache(path,**kwargs)
+    return caches[path]
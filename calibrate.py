@@ -0,0 +1,469 @@
+# calibrate.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Fit parameters of the SEPIR model (see sepir.py) to daily counts of tested cases,
+# by least squares.
+#
+# Observations are read from a CSV file with a column day (days since the first people
+# were exposed), and one or more of:
+#     cases   Number of new cases reported (tested) on that day
+#     I1      Number of tested cases still infectious
+#     R1      Number of tested cases recovered
+# New cases are found by adding a compartment Q to the model, with dQ/dt = c*I0, which
+# accumulates the fraction of the population that has tested positive.
+#
+# Parameters are fitted on a log scale, within bounds, so they stay positive. The fit
+# proceeds in two stages:
+#
+#     Screening: the cost is evaluated at many starting points, from a Latin hypercube
+#     within the bounds. Points are evaluated in batches, each batch integrated as one
+#     system (using sepir.dy_vectorized, with one column for each point), and batches
+#     are shared among processes.
+#
+#     Fitting: the best few points are refined by scipy.optimize.least_squares, in
+#     parallel. The Jacobian of the residuals comes from forward sensitivities: the
+#     derivatives of the state with respect to the parameters are integrated alongside
+#     the state, using sepir.jacobian, so each iteration needs one integration, rather
+#     than one for each parameter. Each fit starts with loose tolerances for the solver,
+#     and is then polished with tight ones, starting from the parameters where the first
+#     fit finished. Nothing else carries over: every integration starts afresh from the
+#     initial state, and the solver chooses its own first step. Solutions are memoized
+#     only for identical parameters and tolerances, since least_squares asks for residuals
+#     and Jacobian at the same point.
+
+import argparse, json, math, numpy as np, sepir, time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from scipy.integrate import solve_ivp
+from scipy.optimize import least_squares
+from scipy.stats import qmc
+
+# Parameters that may be fitted: default value, lower bound, upper bound
+
+PARAMETERS = {'R0'      : (2.5,   0.5,  10),
+              'alpha'   : (0.25,  0.05, 2),
+              'c'       : (0.1,   0.01, 2),
+              'gamma'   : (0.1,   0.02, 1),
+              'delta'   : (1.0,   0.1,  5),
+              'epsilon' : (0.15,  0.01, 1),
+              'initial' : (20,    1,    10000)}
+
+SERIES = ['cases','I1','R1']
+
+Q = 7         # Index of cumulative fraction tested, added to the compartments of sepir.Indices
+
+# get_args
+#
+# Arguments for sepir.dy_vectorized from values of parameters (which may be scalars, or
+# arrays with one value for each column of state) and settings of model that are not fitted
+
+def get_args(values,settings):
+    return (settings['N'],
+            values['c'],
+            values['alpha'],
+            sepir.get_beta(R0=values['R0'],gamma=values['gamma'],delta=values['delta'],epsilon=values['epsilon']),
+            values['gamma'],
+            values['delta'],
+            values['epsilon'],
+            settings['CFR1'],
+            settings['CFR0'],
+            settings['nICU'],
+            settings['pICU'])
+
+# dy
+#
+# Derivative of state, sepir.dy_vectorized with cumulative tested added
+
+def dy(t,y,args):
+    y   = np.reshape(y,(Q+1,-1))
+    out = np.empty_like(y)
+    sepir.dy_vectorized(t,y[:Q],*args,out=out[:Q])
+    out[Q] = args[1]*y[sepir.Indices.INFECTIOUS_UNTESTED.value]
+    return out.ravel()
+
+# get_initial_y
+#
+# Initial state, with one column for each value of initial
+
+def get_initial_y(initial,N):
+    initial = np.atleast_1d(initial)
+    y       = np.zeros((Q+1,len(initial)))
+    y[sepir.Indices.SUSCEPTIBLE.value] = 1 - initial/N
+    y[sepir.Indices.EXPOSED.value]     = initial/N
+    return y
+
+# get_outputs
+#
+# Values of observed series, from states on each day 0,1,...
+#
+# Parameters:
+#     y       States, shape (Q+1,...,T)
+#     days    Days observed
+#     series  Names of series
+#     N       Population size
+
+def get_outputs(y,days,series,N):
+    outputs = []
+    for name in series:
+        if name=='cases':
+            tested = y[Q]
+            outputs.append(N*(tested[...,days] - tested[...,np.maximum(days-1,0)]))
+        elif name=='I1':
+            outputs.append(N*y[sepir.Indices.INFECTIOUS_TESTED.value][...,days])
+        elif name=='R1':
+            outputs.append(N*y[sepir.Indices.RECOVERED_TESTED.value][...,days])
+    return np.concatenate(outputs,axis=-1)
+
+# simulate_batch
+#
+# Integrate the model for several sets of parameters together, one column of state for each
+#
+# Returns:
+#     Observed series for each set, shape (K, len(series)*len(days)), or None if solver fails
+
+def simulate_batch(values,days,series,settings,rtol=1e-6,atol=1e-9):
+    K   = max(np.size(value) for value in values.values())
+    y0  = get_initial_y(values['initial']*np.ones(K),settings['N'])
+    sol = solve_ivp(dy,(0,days.max()),y0.ravel(),
+                    args   = (get_args(values,settings),),
+                    t_eval = np.arange(days.max()+1),
+                    rtol   = rtol,
+                    atol   = atol)
+    if not sol.success: return None
+    return get_outputs(sol.y.reshape(Q+1,K,-1),days,series,settings['N'])
+
+# get_parameter_derivatives
+#
+# Derivatives of dy with respect to the logarithms of parameters that are fitted
+#
+# Parameters:
+#     y       State, shape (Q+1,)
+#     f       dy at y
+#     values  Values of all parameters
+#     names   Names of fitted parameters
+#     beta    Transmission coefficient
+#
+# Returns:
+#     Array of shape (Q+1,len(names))
+
+def get_parameter_derivatives(y,f,values,names,beta):
+    S,E,P,I0,I1 = y[:5]
+    gamma       = values['gamma']
+    delta       = values['delta']
+    epsilon     = values['epsilon']
+    infection   = beta * S * (epsilon*P + I0 + I1)
+    K           = epsilon/delta + 1/gamma             # beta = R0/K
+    derivatives = np.zeros((Q+1,len(names)))
+    for j,name in enumerate(names):
+        column = derivatives[:,j]
+        if name=='R0':
+            column[0:2]  = [-infection, infection]
+        elif name=='alpha':
+            column[1:3]  = [-values['alpha']*E, values['alpha']*E]
+        elif name=='c':
+            c            = values['c']
+            column[3:5]  = [-c*I0, c*I0]
+            column[Q]    = c*I0
+        elif name=='gamma':
+            d_beta       = (1/gamma)/K                # d(log beta)/d(log gamma)
+            column[0:2]  = [-d_beta*infection, d_beta*infection]
+            column[3:7]  = [-gamma*I0, -gamma*I1, f[5], f[6]]
+        elif name=='delta':
+            d_beta       = (epsilon/delta)/K
+            column[0:2]  = [-d_beta*infection, d_beta*infection]
+            column[2:4]  = [-delta*P, delta*P]
+        elif name=='epsilon':
+            d_infection  = -(epsilon/delta)/K*infection + beta*S*epsilon*P
+            column[0:2]  = [-d_infection, d_infection]
+    return derivatives
+
+# simulate_sensitivities
+#
+# Integrate the model for one set of parameters, together with the derivatives of the
+# state with respect to the logarithms of the fitted parameters (forward sensitivities)
+#
+# Returns:
+#     outputs      Observed series, shape (len(series)*len(days),)
+#     derivatives  Derivatives of outputs, shape (len(series)*len(days),len(names))
+#     or None, None if solver fails
+
+def simulate_sensitivities(values,names,days,series,settings,rtol=1e-6,atol=1e-9):
+    args = get_args(values,settings)
+    beta = args[3]
+    p    = len(names)
+
+    def fun(t,z):
+        y           = z[:Q+1]
+        sensitivity = z[Q+1:].reshape(Q+1,p)
+        f           = dy(t,y,args)
+        J           = np.zeros((Q+1,Q+1))
+        J[:Q,:Q]    = sepir.jacobian(t,y[:Q],*args)
+        J[Q,sepir.Indices.INFECTIOUS_UNTESTED.value] = values['c']
+        return np.concatenate([f,(J @ sensitivity + get_parameter_derivatives(y,f,values,names,beta)).ravel()])
+
+    y0 = get_initial_y(values['initial'],settings['N'])[:,0]
+    s0 = np.zeros((Q+1,p))
+    if 'initial' in names:
+        s0[sepir.Indices.SUSCEPTIBLE.value,names.index('initial')] = -y0[sepir.Indices.EXPOSED.value]
+        s0[sepir.Indices.EXPOSED.value,names.index('initial')]     = y0[sepir.Indices.EXPOSED.value]
+    sol = solve_ivp(fun,(0,days.max()),np.concatenate([y0,s0.ravel()]),
+                    t_eval = np.arange(days.max()+1),
+                    rtol   = rtol,
+                    atol   = atol)
+    if not sol.success: return None,None
+    outputs     = get_outputs(sol.y[:Q+1],days,series,settings['N'])
+    derivatives = get_outputs(sol.y[Q+1:].reshape(Q+1,p,-1),days,series,settings['N'])
+    return outputs, derivatives.T
+
+# Objective
+#
+# Residuals of model compared with observations, and their Jacobian, as functions of the
+# logarithms of the fitted parameters. Residuals are differences of sqrt(count+1) (which
+# roughly equalizes the variance of counts), log(count+1), or counts, according to scale.
+
+class Objective:
+    # Parameters:
+    #     days      Days observed
+    #     observed  Dict of series name -> observed counts, one for each day
+    #     names     Names of parameters to be fitted
+    #     settings  Values of parameters that are not fitted, and of N, CFR1, CFR0, nICU, pICU
+    #     scale     sqrt, log, or linear
+    #     rtol      Relative tolerance for solver
+    #     atol      Absolute tolerance for solver
+    #     memo      Number of solutions to remember
+    def __init__(self,days,observed,names,settings,scale='sqrt',rtol=1e-8,atol=1e-12,memo=8):
+        self.days      = np.asarray(days,dtype=int)
+        self.series    = [name for name in SERIES if name in observed]
+        self.observed  = np.concatenate([np.asarray(observed[name],dtype=float) for name in self.series])
+        self.names     = list(names)
+        self.settings  = settings
+        self.scale     = scale
+        self.rtol      = rtol
+        self.atol      = atol
+        self.memo      = memo
+        self.solutions = OrderedDict()                 # (x,rtol,atol) -> (residuals,Jacobian)
+        self.target    = self.transform(self.observed)[0]
+        self.lower     = np.log([PARAMETERS[name][1] for name in self.names])
+        self.upper     = np.log([PARAMETERS[name][2] for name in self.names])
+
+    def get_values(self,x):
+        values = {name:self.settings[name] for name in PARAMETERS}
+        for name,value in zip(self.names,np.exp(x)):
+            values[name] = value
+        return values
+
+    # transform
+    #
+    # Apply scale to counts, returning transformed counts and derivative of transform
+
+    def transform(self,counts):
+        counts = np.maximum(counts,0)
+        if self.scale=='sqrt':
+            root = np.sqrt(counts+1)
+            return root, 0.5/root
+        if self.scale=='log':
+            return np.log(counts+1), 1/(counts+1)
+        return counts, np.ones_like(counts)
+
+    # evaluate
+    #
+    # Residuals and Jacobian at x, from memo if possible
+
+    def evaluate(self,x):
+        key = (np.asarray(x,dtype=float).tobytes(),self.rtol,self.atol)
+        if key in self.solutions:
+            self.solutions.move_to_end(key)
+            return self.solutions[key]
+        outputs,derivatives = simulate_sensitivities(self.get_values(x),self.names,self.days,self.series,self.settings,
+                                                     rtol=self.rtol,atol=self.atol)
+        if outputs is None:
+            # least_squares needs finite values, so a failure is treated as a very poor fit
+            solution = (np.full(len(self.target),1e6), np.zeros((len(self.target),len(self.names))))
+        else:
+            transformed,slope = self.transform(outputs)
+            solution          = (transformed - self.target, slope[:,None]*derivatives)
+        self.solutions[key] = solution
+        if len(self.solutions)>self.memo:
+            self.solutions.popitem(last=False)
+        return solution
+
+    def residuals(self,x):
+        return self.evaluate(x)[0]
+
+    def jacobian(self,x):
+        return self.evaluate(x)[1]
+
+    # get_costs
+    #
+    # Cost (half the sum of squared residuals) at each row of X, integrated as one batch
+
+    def get_costs(self,X):
+        X       = np.atleast_2d(X)
+        values  = self.get_values(X.T)
+        outputs = simulate_batch(values,self.days,self.series,self.settings,rtol=max(self.rtol,1e-6),atol=self.atol)
+        if outputs is None:
+            return np.full(len(X),np.inf)
+        return 0.5*np.sum((self.transform(outputs)[0] - self.target)**2,axis=1)
+
+# fit
+#
+# Fit from one starting point: first with loose tolerances for the solver, then polish
+# with the objective's own tolerances, starting from the parameters found by the first fit.
+# Only the parameters are passed on; the polish integrates each point again at the tighter
+# tolerances, and does not reuse solutions or step sizes from the first fit.
+#
+# Returns:
+#     Dict with x (log parameters), cost, number of evaluations, and whether it succeeded
+
+def fit(x0,objective,coarse=1e-5):
+    rtol,atol   = objective.rtol, objective.atol
+    evaluations = 0
+    x           = np.clip(x0,objective.lower,objective.upper)
+    for stage_rtol,stage_atol in [(max(rtol,coarse),max(atol,coarse*1e-3)),(rtol,atol)]:
+        objective.rtol, objective.atol = stage_rtol, stage_atol
+        result       = least_squares(objective.residuals,x,
+                                     jac     = objective.jacobian,
+                                     bounds  = (objective.lower,objective.upper),
+                                     x_scale = 'jac')
+        x            = result.x
+        evaluations += result.nfev
+    return dict(x=result.x,cost=result.cost,nfev=evaluations,success=result.success,message=result.message)
+
+# screen
+#
+# Costs at several starting points, evaluated in batches
+
+def screen(X,objective,batch=64):
+    return np.concatenate([objective.get_costs(X[i:i+batch]) for i in range(0,len(X),batch)])
+
+# calibrate
+#
+# Screen starting points, and fit the best of them
+#
+# Parameters:
+#     objective  Objective
+#     starts     Number of starting points to screen
+#     fits       Number of them to refine
+#     batch      Number of starting points integrated together
+#     workers    Number of processes (None: serial)
+#     seed       Seed for starting points
+#
+# Returns:
+#     Results of fits, best first
+
+def calibrate(objective,starts=64,fits=4,batch=16,workers=None,seed=None):
+    sampler = qmc.LatinHypercube(d=len(objective.names),seed=seed)
+    X       = qmc.scale(sampler.random(starts),objective.lower,objective.upper)
+    X[0]    = np.clip(np.log([objective.settings[name] for name in objective.names]),objective.lower,objective.upper)
+    chunks  = [X[i:i+batch] for i in range(0,len(X),batch)]
+    if workers==None:
+        costs   = np.concatenate([screen(chunk,objective,batch=batch) for chunk in chunks])
+        best    = np.argsort(costs)[:fits]
+        results = [fit(X[i],objective) for i in best]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            costs   = np.concatenate(list(executor.map(screen,chunks,repeat(objective),repeat(batch))))
+            best    = np.argsort(costs)[:fits]
+            results = list(executor.map(fit,X[best],repeat(objective)))
+    return sorted(results,key=lambda result:result['cost'])
+
+# get_standard_errors
+#
+# Approximate standard errors of the logarithms of fitted parameters (roughly, relative
+# errors of the parameters), from the Jacobian at the optimum
+
+def get_standard_errors(objective,x):
+    J        = objective.jacobian(x)
+    residual = objective.residuals(x)
+    dof      = max(1,len(residual)-len(x))
+    try:
+        covariance = np.linalg.inv(J.T @ J) * np.sum(residual**2)/dof
+    except np.linalg.LinAlgError:
+        return np.full(len(x),np.nan)
+    return np.sqrt(np.maximum(np.diag(covariance),0))
+
+# create_observations
+#
+# Synthetic observations from the model, with Poisson noise, for testing
+
+def create_observations(file_name,values,settings,days,series,rng):
+    days    = np.arange(1,days+1)
+    outputs = simulate_batch(values,days,series,settings)[0].reshape(len(series),len(days))
+    counts  = rng.poisson(np.maximum(outputs,0))
+    with open(file_name,'w') as observations:
+        observations.write(','.join(['day']+series)+'\n')
+        for i,day in enumerate(days):
+            observations.write(','.join([str(day)]+[str(count) for count in counts[:,i]])+'\n')
+
+# load_observations
+#
+# Read observations from CSV file: returns days, and dict of series name -> counts
+
+def load_observations(file_name):
+    data = np.atleast_1d(np.genfromtxt(file_name,delimiter=',',names=True))
+    return data['day'].astype(int), {name:data[name] for name in data.dtype.names if name in SERIES}
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser('Fit parameters of SEPIR model to daily counts of tested cases')
+    parser.add_argument('observations',                      help='CSV file with day, and one or more of cases, I1, R1')
+    parser.add_argument('--fit',                 default=['R0','alpha','c','gamma','epsilon'], nargs='+',
+                                                 choices=list(PARAMETERS), help='Parameters to be fitted')
+    parser.add_argument('--scale',               default='sqrt',     help='Scale on which observations are compared',
+                        choices=['sqrt','log','linear'])
+    parser.add_argument('--starts',  type=int,   default=64,         help='Number of starting points to screen')
+    parser.add_argument('--fits',    type=int,   default=4,          help='Number of best starting points to refine')
+    parser.add_argument('--batch',   type=int,   default=16,         help='Number of starting points integrated together')
+    parser.add_argument('--workers', type=int,   default=None,       help='Number of processes')
+    parser.add_argument('--seed',    type=int,   default=None,       help='Seed for random number generator')
+    parser.add_argument('--rtol',    type=float, default=1e-8,       help='Relative tolerance for ode solver')
+    parser.add_argument('--atol',    type=float, default=1e-12,      help='Absolute tolerance for ode solver')
+    parser.add_argument('--out',                 default=None,       help='Save fitted parameters to this (json) file')
+    parser.add_argument('--create',  type=int,   default=None,       help='Instead of fitting, write this many days of synthetic '
+                                                                          'observations, with Poisson noise, to the observations file')
+    parser.add_argument('--series',              default=['cases'],  help='Series for synthetic observations', nargs='+', choices=SERIES)
+    parser.add_argument('--N',       type=int,   default=5000000,    help='Population size')
+    parser.add_argument('--nICU',    type=int,   default=300,        help='Number of ICU beds')
+    parser.add_argument('--CFR1',    type=float, default=2.0/100,    help='Case Fatality Rate for cases exceeding ICU max')
+    parser.add_argument('--CFR0',    type=float, default=1.0/100,    help='Case Fatality Rate for cases under ICU max')
+    parser.add_argument('--pICU',    type=float, default=1.25/100,   help='Proportion of cases requiring ICU')
+    for name,(default,lower,upper) in PARAMETERS.items():
+        parser.add_argument(f'--{name}', type=float, default=default,
+                            help=f'Value of {name} if not fitted, and first starting point if it is (bounds {lower}-{upper})')
+    args = parser.parse_args()
+
+    settings = {name:getattr(args,name) for name in list(PARAMETERS)+['N','nICU','CFR1','CFR0','pICU']}
+
+    if args.create!=None:
+        create_observations(args.observations,{name:settings[name] for name in PARAMETERS},settings,args.create,args.series,
+                            np.random.default_rng(args.seed))
+    else:
+        days,observed = load_observations(args.observations)
+        objective     = Objective(days,observed,args.fit,settings,scale=args.scale,rtol=args.rtol,atol=args.atol)
+        start         = time.perf_counter()
+        results       = calibrate(objective,starts=args.starts,fits=args.fits,batch=args.batch,workers=args.workers,seed=args.seed)
+        best          = results[0]
+        errors        = get_standard_errors(objective,best['x'])
+        print (f'Fitted {len(args.fit)} parameters to {len(objective.target)} observations in {time.perf_counter()-start:.1f} s')
+        for result in results:
+            print (f'Cost {result["cost"]:.6g}, {result["nfev"]} evaluations: {result["message"]}')
+        print (f'{"Parameter":12s}{"Value":>12s}{"Rel. error":>12s}')
+        for name,x,error in zip(args.fit,best['x'],errors):
+            print (f'{name:12s}{math.exp(x):12.6g}{error:12.3g}')
+        if args.out!=None:
+            with open(args.out,'w') as out:
+                json.dump(dict(objective.get_values(best['x']),cost=best['cost']),out,indent=2)
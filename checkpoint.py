@@ -0,0 +1,91 @@
+# checkpoint.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Save the results of a long Monte Carlo simulation as it goes, so it can be resumed.
+#
+# A checkpoint is a directory containing settings.json, which records the settings
+# of the simulation, and a sequence of chunks, chunk-000000000.npz, ..., each holding
+# the summaries of a contiguous range of runs. Chunks are only ever added, and each is
+# written to a temporary file first, so an interrupted write cannot spoil earlier results.
+# Runs are seeded from the entropy in the settings and their index (see t028.get_rng), so
+# no state of a random number generator needs to be saved.
+
+import json, os, numpy as np
+from glob import glob
+from os.path import join, exists
+
+class Checkpoint:
+    # Parameters:
+    #     path       Directory for checkpoint
+    #     settings   Settings of simulation, which must match if simulation is resumed
+    #     resume     Continue from an existing checkpoint
+    #     every      Number of runs to collect before writing a chunk
+    def __init__(self,path,settings,resume=False,every=10000):
+        self.path      = path
+        self.every     = every
+        self.buffer    = []
+        self.completed = 0
+        settings_file  = join(path,'settings.json')
+        if resume and exists(settings_file):
+            with open(settings_file) as settings_json:
+                saved = json.load(settings_json)
+            differences = [key for key in settings if key!='entropy' and saved.get(key)!=settings[key]]
+            if len(differences)>0:
+                raise ValueError(f'Checkpoint {path} has different settings: {", ".join(differences)}')
+            self.settings = saved
+        else:
+            if exists(settings_file):
+                raise FileExistsError(f'Checkpoint {path} already exists: use --resume to continue it')
+            os.makedirs(path,exist_ok=True)
+            with open(settings_file,'w') as settings_json:
+                json.dump(settings,settings_json,indent=2)
+            self.settings = settings
+
+    # load
+    #
+    # Generator for summaries of completed runs, one chunk at a time. Once all chunks
+    # have been read, completed is the number of runs.
+
+    def load(self):
+        for file_name in sorted(glob(join(self.path,'chunk-*.npz'))):
+            with np.load(file_name) as chunk:
+                summaries = chunk['summaries']
+                if int(chunk['first'])!=self.completed:
+                    raise ValueError(f'Checkpoint {self.path}: {file_name} does not follow run {self.completed}')
+                self.completed += len(summaries)
+            yield summaries
+
+    # append
+    #
+    # Record summaries of next runs
+
+    def append(self,summaries):
+        self.buffer.append(summaries)
+        if sum(len(summaries) for summaries in self.buffer)>=self.every:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer)==0: return
+        summaries  = np.concatenate(self.buffer)
+        file_name  = join(self.path,f'chunk-{self.completed:09d}.npz')
+        temporary  = join(self.path,'chunk.tmp.npz')
+        np.savez(temporary,
+                 first     = self.completed,
+                 summaries = summaries)
+        os.replace(temporary,file_name)
+        self.completed += len(summaries)
+        self.buffer     = []
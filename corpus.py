@@ -0,0 +1,211 @@
+# corpus.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Read json files from the CORD-19 database, extracting only the fields that are needed,
+# so memory doesn't grow with the size of the corpus.
+#
+# Files are read by a pool of threads, a bounded number ahead of the one being used, since
+# reading from network storage is limited by latency rather than by the CPU. Each file is
+# decoded by the thread that opened it. If ijson is installed, headers are parsed
+# incrementally from the file, and reading stops as soon as the fields have been found.
+# Texts span most of a file, so they are decoded with orjson if it is installed,
+# otherwise streamed with ijson, otherwise loaded with json.
+#
+# Files that cannot be read are recorded in an Errors object, if one is supplied, and
+# skipped, so they can be reported together at the end.
+#
+# json
+#      paper_id
+#      metadata
+#          title
+#          authors
+#      abstract
+#      body_text  -- list of items
+#                    text
+#                    cite_spans
+#                    ref_spans
+#                    section
+#      bib_entries
+#      ref_entries
+#      back_matter
+
+import json, os
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Errors that cause a file to be skipped: it can't be opened or read, isn't valid json,
+# or lacks a field that is needed
+
+ERRORS = (OSError,ValueError,UnicodeDecodeError,KeyError) + (() if ijson==None else (ijson.JSONError,))
+
+# find_json_files
+#
+# Generator for paths of all json files below path, in the same order as os.walk
+
+def find_json_files(path):
+    directories = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    directories.append(entry.path)
+            elif entry.name.endswith('.json'):
+                yield entry.path
+    for directory in directories:
+        yield from find_json_files(directory)
+
+# get_decoder
+#
+# Function to decode json from bytes: orjson if available, otherwise json
+
+def get_decoder():
+    return json.loads if orjson==None else orjson.loads
+
+# Errors
+#
+# Summary of files that could not be read
+
+class Errors:
+    def __init__(self,examples=10):
+        self.examples = examples
+        self.errors   = []
+
+    def add(self,file_name,error):
+        self.errors.append((file_name,type(error).__name__,str(error)))
+
+    def merge(self,other):
+        self.errors.extend(other.errors)
+
+    def __len__(self):
+        return len(self.errors)
+
+    def report(self):
+        if len(self.errors)==0: return
+        print (f'{len(self.errors)} files could not be read: ' +
+               ', '.join(f'{name} {count}' for name,count in Counter(name for _,name,_ in self.errors).most_common()))
+        for file_name,name,message in self.errors[:self.examples]:
+            print (f'    {file_name} {name}: {message}')
+        if len(self.errors)>self.examples:
+            print (f'    ...')
+
+# read_json
+#
+# Generator for files, read by a pool of threads and decoded
+#
+# Parameters:
+#     file_names   Files to read
+#     decode       Function to extract what is wanted from a file, opened in binary mode
+#     threads      Number of threads used to read files
+#     prefetch     Maximum number of files to read ahead
+#     errors       Errors object to record files that can't be read (if None, errors are raised)
+#
+# Returns:
+#     file_name,decoded content, for each file in turn
+
+def read_json(file_names,decode=None,threads=8,prefetch=64,errors=None):
+    if decode==None:
+        decode = lambda json_file: get_decoder()(json_file.read())
+
+    def read(file_name):
+        with open(file_name,'rb') as json_file:
+            return decode(json_file)
+
+    file_names = iter(file_names)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque((file_name,executor.submit(read,file_name)) for file_name in islice(file_names,prefetch))
+        while len(pending)>0:
+            file_name,future = pending.popleft()
+            for next_file_name in islice(file_names,1):
+                pending.append((next_file_name,executor.submit(read,next_file_name)))
+            try:
+                yield file_name,future.result()
+            except ERRORS as err:
+                if errors==None: raise
+                errors.add(file_name,err)
+
+# get_header
+#
+# Extract paper_id, and optionally title, from a file opened in binary mode
+#
+# Returns:
+#     paper_id, or (paper_id,title) if title is wanted
+
+def get_header(json_file,title=False):
+    if ijson==None:
+        json_data = get_decoder()(json_file.read())
+        return (json_data['paper_id'],json_data['metadata']['title']) if title else json_data['paper_id']
+
+    wanted = {'paper_id':None}
+    if title:
+        wanted['metadata.title'] = None
+    found = 0
+    for prefix,event,value in ijson.parse(json_file):
+        if prefix in wanted and event=='string':
+            wanted[prefix] = value
+            found         += 1
+            if found==len(wanted): break
+    if wanted['paper_id']==None:
+        raise KeyError('paper_id')
+    return (wanted['paper_id'],wanted['metadata.title']) if title else wanted['paper_id']
+
+# get_texts
+#
+# Extract text of each segment of body_text from a file opened in binary mode
+
+def get_texts(json_file):
+    if ijson!=None and orjson==None:
+        return list(ijson.items(json_file,'body_text.item.text'))
+    return [body_text_segment['text'] for body_text_segment in get_decoder()(json_file.read())['body_text']]
+
+# read_header
+#
+# Read paper_id, and optionally title, from one file
+
+def read_header(file_name,title=False):
+    with open(file_name,'rb') as json_file:
+        return get_header(json_file,title=title)
+
+# read_texts
+#
+# Read text of each segment of body_text from one file
+
+def read_texts(file_name):
+    with open(file_name,'rb') as json_file:
+        return get_texts(json_file)
+
+# scan_papers
+#
+# Generator for paper_id (or (paper_id,title) if title is wanted) of every json file below path.
+# Files that cannot be parsed are recorded in errors, and skipped.
+
+def scan_papers(path,title=False,errors=None,threads=8):
+    for _,header in read_json(find_json_files(path),
+                              decode  = lambda data: get_header(data,title=title),
+                              threads = threads,
+                              errors  = Errors() if errors==None else errors):
+        yield header
@@ -0,0 +1,194 @@
+# ensemble.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Integrate an ensemble of realizations of the SEPIR model as one system. The state is
+# a (7,M) array, one column for each member, and each member has its own schedule of NPIs,
+# so a Monte Carlo simulation needs one integration instead of M.
+#
+# The integrator is the Dormand-Prince 5(4) pair used by solve_ivp's RK45, with one step
+# size shared by all members. The error of a step is the worst error of any member, so
+# every member is integrated at least as accurately as it would be on its own.
+
+import numpy as np, sepir, instrument
+
+# Dormand-Prince coefficients
+
+C = np.array([0, 1/5, 3/10, 4/5, 8/9, 1])
+A = [np.array([]),
+     np.array([1/5]),
+     np.array([3/40, 9/40]),
+     np.array([44/45, -56/15, 32/9]),
+     np.array([19372/6561, -25360/2187, 64448/6561, -212/729]),
+     np.array([9017/3168, -355/33, 46732/5247, 49/176, -5103/18656])]
+B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+E = np.array([-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40])
+
+# Step size control, as in solve_ivp
+
+SAFETY     = 0.9
+MIN_FACTOR = 0.2
+MAX_FACTOR = 10
+
+# create_schedule
+#
+# Merge the NPIs for all members into one list of breakpoints
+#
+# Parameters:
+#     NPIs     One list of NPIs for each member [[(t1,f1),(t2,f2),...],...]
+#
+# Returns:
+#     breakpoints  Sorted array of distinct times at which some NPI is applied
+#     members      For each breakpoint, the members that apply an NPI at that time
+#     factors      For each breakpoint, the factors that these members apply to R0
+
+def create_schedule(NPIs):
+    times       = np.array([t for member_NPIs in NPIs for t,_ in member_NPIs],dtype=float)
+    factors     = np.array([f for member_NPIs in NPIs for _,f in member_NPIs],dtype=float)
+    members     = np.repeat(np.arange(len(NPIs)),[len(member_NPIs) for member_NPIs in NPIs])
+    order       = np.argsort(times,kind='stable')
+    breakpoints,starts = np.unique(times[order],return_index=True)
+    return (breakpoints,
+            np.split(members[order],starts[1:]),
+            np.split(factors[order],starts[1:]))
+
+# get_error_norm
+#
+# RMS error for each member, scaled by tolerances; the step is judged by the worst member
+
+def get_error_norm(error,y,y_new,atol,rtol):
+    scale = atol + np.maximum(np.abs(y),np.abs(y_new)) * rtol
+    return np.sqrt(np.max(np.mean((error/scale)**2,axis=0)))
+
+# select_initial_step
+#
+# Estimate a first step that suits every member (Hairer, Norsett & Wanner, as solve_ivp)
+
+def select_initial_step(fun,t0,y0,f0,t_bound,atol,rtol):
+    scale = atol + np.abs(y0) * rtol
+    d0    = np.sqrt(np.mean((y0/scale)**2,axis=0))
+    d1    = np.sqrt(np.mean((f0/scale)**2,axis=0))
+    h0    = np.where((d0<1e-5) | (d1<1e-5), 1e-6, 0.01 * d0 / np.where(d1>0,d1,1))
+    h0    = min(np.min(h0), t_bound-t0)
+    f1    = fun(t0 + h0, y0 + h0*f0)
+    d2    = np.max(np.sqrt(np.mean(((f1-f0)/scale)**2,axis=0))) / h0
+    d1    = np.max(d1)
+    h1    = max(1e-6, h0 * 1e-3) if d1<=1e-15 and d2<=1e-15 else (0.01 / max(d1, d2)) ** (1/5)
+    return min(100 * h0, h1)
+
+# evolve_ensemble
+#
+# Evolve all members from the initial state over t_range, applying each member's NPIs
+# to its own R0. The parameters of the model may be scalars, or arrays with one value
+# for each member. The initial state is y0 if given, otherwise initial exposed in a
+# population that is otherwise susceptible.
+#
+# Returns:
+#     y        Final state, shape (7,M)
+#     peaks    Largest value of I0+I1 seen by each member (fraction of population)
+#     t_peaks  Time at which each member reached its peak
+
+def evolve_ensemble(NPIs    = [],       # One list of NPIs [(t1,f1),(t2,f2),...] for each member
+                    R0      = 2.5,      # Initial value of Basic Reproduction number
+                    t_range = (0,400),  # Range of times (days)
+                    N       = 5000000,  # Population size
+                    initial = 20,       # Initial number exposed
+                    c       = 0.1,      # Testing rate for symptomatic cases, per diem
+                    alpha   = 0.25,     # E to P transition rate, per diem
+                    gamma   = 0.1,      # I to R transition, per diem
+                    delta   = 1,        # P to I, per diem
+                    epsilon = 0.15,     # relative infectiousness
+                    CFR1    = 2.0/100,  # case fatality rate for cases exceedinging ICU max
+                    CFR0    = 1.0/100,  # case fatality rate for cases under ICU max
+                    nICU    = 300,      # number of ICU beds
+                    pICU    = 1.25/100, # proportion of cases requiring ICU
+                    atol    = 1e-7,     # Absolute error tolerance for ODE solver
+                    rtol    = 1e-7,     # Relative error tolerance for ODE solver
+                    y0      = None):    # Initial state, shape (7,) or (7,M)
+    M       = len(NPIs)
+    beta    = sepir.get_beta(R0=R0,gamma=gamma,delta=delta,epsilon=epsilon) * np.ones(M)
+    y       = np.zeros((7,M))
+    if y0 is None:
+        y[sepir.Indices.SUSCEPTIBLE.value] = 1 - initial/N
+        y[sepir.Indices.EXPOSED.value]     = initial/N
+    else:
+        y[:]  = np.reshape(y0,(7,-1))
+
+    def fun(t,y,out=None):
+        return sepir.dy_vectorized(t,y,N,c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,nICU,pICU,out=out)
+
+    t,t_end                      = t_range
+    breakpoints,members,factors  = create_schedule(NPIs)
+    for i in np.flatnonzero(breakpoints<=t):
+        beta[members[i]] *= factors[i]
+    stops   = [(breakpoint,i) for i,breakpoint in enumerate(breakpoints) if t<breakpoint<t_end] + [(t_end,None)]
+
+    K       = np.empty((7,7,M))     # Stages; K[6] is the derivative at the end of the step
+    y_new   = np.empty((7,M))
+    error   = np.empty((7,M))
+    peaks   = y[sepir.Indices.INFECTIOUS_UNTESTED.value] + y[sepir.Indices.INFECTIOUS_TESTED.value]
+    t_peaks = np.full(M,float(t))
+
+    fun(t,y,out=K[0])
+    h        = select_initial_step(fun,t,y,K[0],t_end,atol,rtol)
+    accepted = rejected = 0
+    for t_stop,i in stops:
+        while t<t_stop:
+            step_rejected = False
+            while True:
+                h_step = min(h, t_stop - t)
+                for s in range(1,6):
+                    np.dot(A[s],K[:s].reshape(s,-1),out=y_new.reshape(-1))
+                    y_new *= h_step
+                    y_new += y
+                    fun(t + C[s]*h_step,y_new,out=K[s])
+                np.dot(B,K[:6].reshape(6,-1),out=y_new.reshape(-1))
+                y_new *= h_step
+                y_new += y
+                fun(t + h_step,y_new,out=K[6])
+                np.dot(E,K.reshape(7,-1),out=error.reshape(-1))
+                error *= h_step
+                error_norm = get_error_norm(error,y,y_new,atol,rtol)
+                if error_norm<1:
+                    accepted += 1
+                    factor = MAX_FACTOR if error_norm==0 else min(MAX_FACTOR, SAFETY * error_norm**(-1/5))
+                    if step_rejected:
+                        factor = min(1, factor)
+                    # A step truncated at t_stop says little about the next one
+                    h      = h * min(1,factor) if h_step<h else h * factor
+                    break
+                h             = h_step * max(MIN_FACTOR, SAFETY * error_norm**(-1/5))
+                step_rejected = True
+                rejected     += 1
+
+            t         = t_stop if h_step==t_stop-t else t + h_step
+            y,y_new   = y_new,y
+            K[0]      = K[6]
+            infected  = y[sepir.Indices.INFECTIOUS_UNTESTED.value] + y[sepir.Indices.INFECTIOUS_TESTED.value]
+            higher    = infected>peaks
+            peaks[higher]   = infected[higher]
+            t_peaks[higher] = t
+
+        if i!=None:
+            # Apply NPIs: R0, and therefore beta, changes, so derivative must be recomputed
+            beta[members[i]] *= factors[i]
+            fun(t,y,out=K[0])
+
+    if instrument.enabled:
+        # Initial derivative, initial step, 6 per step attempted, and 1 per NPI
+        instrument.count_solver(2 + 6*(accepted+rejected) + len(stops) - 1,0,accepted,rejected)
+
+    return y,peaks,t_peaks
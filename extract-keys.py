@@ -16,7 +16,8 @@
 # along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
 #
 # Produce SCF file containing a list of all words, with a count of the 
-# number of documents in which each word occurs
+# number of times each word occurs, or (--mode document) of the number of
+# documents in which each word occurs
 #
 # Metadata fields:
 #      cord_uid
@@ -53,58 +54,335 @@
 #      ref_entries
 #      back_matter
 
-import json,pandas as pd, spacy, sys, os, matplotlib.pyplot as plt,math,argparse
+import corpus,invertedindex,termstore,json,numpy as np,pandas as pd, spacy, sys, os, matplotlib.pyplot as plt,math,argparse
 from spacy.matcher import PhraseMatcher
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from os.path import join
 
+# create_nlp
+#
+# Language used for tokenizing text: each process has its own
+
+nlp = None
+
+def create_nlp():
+    global nlp
+    nlp = spacy.blank('en')
+
+# WordCounts
+#
+# Count words, mapping each word to an integer, in the order in which words are first
+# seen, and keeping counts in an array indexed by these integers
+
+class WordCounts:
+    def __init__(self):
+        self.vocabulary = {}
+        self.counts     = np.zeros(1024,dtype=np.int64)
+
+    def add(self,words):
+        word_ids = [self.vocabulary.setdefault(word,len(self.vocabulary)) for word in words]
+        if len(self.vocabulary)>len(self.counts):
+            self.counts = np.concatenate((self.counts,np.zeros(max(len(self.counts),len(self.vocabulary)),dtype=np.int64)))
+        if len(word_ids)>0:
+            self.counts[:max(word_ids)+1] += np.bincount(word_ids)
+
+    # merge
+    #
+    # Add counts from another WordCounts; words that are new to this one are added
+    # in the order in which the other saw them
+
+    def merge(self,other):
+        word_ids = np.array([self.vocabulary.setdefault(word,len(self.vocabulary)) for word in other.vocabulary],
+                            dtype=np.int64)
+        if len(self.vocabulary)>len(self.counts):
+            self.counts = np.concatenate((self.counts,np.zeros(len(self.vocabulary),dtype=np.int64)))
+        self.counts[word_ids] += other.counts[:len(word_ids)]
+
+    # get_sorted
+    #
+    # Words and counts, in descending order by count (or the k words with highest counts).
+    # Words with equal counts appear in the order in which they were first seen.
+
+    def get_sorted(self,k=None):
+        counts = self.counts[:len(self.vocabulary)]
+        if k==None or k>=len(counts):
+            order = np.argsort(-counts,kind='stable')
+        elif k<=0:
+            return []
+        else:
+            least = counts[np.argpartition(-counts,k-1)[k-1]]
+            order = np.flatnonzero(counts>=least)
+            order = order[np.argsort(-counts[order],kind='stable')][:k]
+        words = list(self.vocabulary)
+        return [(words[i],int(counts[i])) for i in order]
+
+# count_words
+#
+# Construct list of words in some files, with a count of the number of times each word
+# occurs, or (if mode is 'document') of the number of documents in which each word occurs.
+#
+# Parameters:
+#     file_names   Files to process, in order
+#     batch_size   Number of segments of text to be tokenized together
+#     verbose      Print name of each file
+#     index        Also build an inverted index of the files
+#     mode         'term' or 'document'
+#     threads      Number of threads used to read files
+#
+# Returns:
+#     WordCounts, invertedindex.IndexWriter (or None if index isn't set), and corpus.Errors
+
+def count_words(file_names,batch_size=1000,verbose=False,index=False,mode='term',threads=8):
+    if nlp==None:
+        create_nlp()
+    writer = invertedindex.IndexWriter() if index else None
+    errors = corpus.Errors()
+    
+    def decode(json_file):
+        json_data = corpus.get_decoder()(json_file.read())
+        return json_data['paper_id'] if index else None, [segment['text'] for segment in json_data['body_text']]
+    
+    def get_texts():
+        for i,(file_name,(paper_id,texts)) in enumerate(corpus.read_json(file_names,
+                                                                         decode  = decode,
+                                                                         threads = threads,
+                                                                         errors  = errors)):
+            if verbose:
+                print (os.path.basename(file_name))
+            if index:
+                writer.add(paper_id)
+            for text in texts:
+                yield text,i
+    
+    counts         = WordCounts()
+    document,words = None,{}     # Words of current document, in order of first occurrence
+    
+    def end_document():
+        if mode=='document':
+            counts.add(words)
+        if index:
+            writer.add_words(document,words)
+    
+    for doc,i in nlp.pipe(get_texts(),batch_size=batch_size,as_tuples=True):
+        if i!=document:
+            if document!=None:
+                end_document()
+            document,words = i,{}
+        doc_words = list(get_words(doc))
+        if mode=='term':
+            counts.add(doc_words)
+        if mode=='document' or index:
+            words.update(dict.fromkeys(doc_words))
+    if document!=None:
+        end_document()
+    
+    return counts,writer,errors
+
+# get_words
+#
+# Words from a tokenized text, omitting stop words and anything that isn't alphabetic
 
-parser = argparse.ArgumentParser('Extract keywords from json files')
-parser.add_argument('--path', default=r'C:\CORD-19', help='Path of root of json files')
-parser.add_argument('--out',  default='keywords.csv', help='Path to store keywords')
-parser.add_argument('--plot', default=False, action='store_true',help='Plot frequncies')
-args  = parser.parse_args()
+def get_words(doc):
+    for token in doc:
+        if not token.is_stop and token.lemma_.isalpha():
+            yield token.lemma_.lower()
+
+# count_documents
+#
+# Count words separately for each file
+#
+# Parameters:
+#     file_names   Files to process
+#     batch_size   Number of segments of text to be tokenized together
+#     mode         'term' to count occurrences of each word, 'document' to count 1 for each word present
+#     threads      Number of threads used to read files
+#
+# Returns:
+#     List of counts, one for each file (None if file couldn't be read), and corpus.Errors
 
-nlp = spacy.blank('en')
+def count_documents(file_names,batch_size=1000,mode='term',threads=8):
+    if nlp==None:
+        create_nlp()
+    errors = corpus.Errors()
+    
+    # Files that can't be read are skipped, so position in file_names is found by name
+    positions = {file_name:i for i,file_name in enumerate(file_names)}
+    
+    def get_texts():
+        for file_name,texts in corpus.read_json(file_names,
+                                                decode  = corpus.get_texts,
+                                                threads = threads,
+                                                errors  = errors):
+            i         = positions[file_name]
+            counts[i] = defaultdict(int)
+            for text in texts:
+                yield text,i
+    
+    counts = [None for _ in file_names]
+    for doc,i in nlp.pipe(get_texts(),batch_size=batch_size,as_tuples=True):
+        for word in get_words(doc):
+            counts[i][word] = 1 if mode=='document' else counts[i][word]+1
+    return [None if document_counts==None else dict(document_counts) for document_counts in counts],errors
 
-# Construct list of all words, with a count of the number of documents in which 
-# each word occurs
+# get_frequencies
+#
+# Construct list of all words, with a count of the number of times each word occurs, or
+# (if mode is 'document') of the number of documents in which it occurs, sorted in
+# descending order by frequency, or just the top words if top is specified.
+#
+# If workers is specified, the files are split into contiguous shards, which are counted
+# by separate processes; the counts are merged in the order of the shards, so words
+# with the same frequency are listed in the same order as they would be by one process.
+# If index is specified, an inverted index (see invertedindex.py) is saved there. Files
+# that couldn't be read are listed at the end.
 
-words_with_frequencies = defaultdict(lambda : 0)
+def get_frequencies(path,workers=None,batch_size=1000,verbose=False,index=None,mode='term',top=None,threads=8):
+    if workers==None:
+        words_with_frequencies,writer,errors = count_words(corpus.find_json_files(path),
+                                                           batch_size = batch_size,
+                                                           verbose    = verbose,
+                                                           index      = index!=None,
+                                                           mode       = mode,
+                                                           threads    = threads)
+    else:
+        file_names             = list(corpus.find_json_files(path))
+        size                   = max(1,math.ceil(len(file_names)/(4*workers)))
+        words_with_frequencies = WordCounts()
+        writer                 = invertedindex.IndexWriter() if index!=None else None
+        errors                 = corpus.Errors()
+        with ProcessPoolExecutor(max_workers=workers,initializer=create_nlp) as executor:
+            for counts,shard_writer,shard_errors in executor.map(count_words,
+                                                                 [file_names[i:i+size] for i in range(0,len(file_names),size)],
+                                                                 repeat(batch_size),
+                                                                 repeat(verbose),
+                                                                 repeat(index!=None),
+                                                                 repeat(mode),
+                                                                 repeat(threads)):
+                if index!=None:
+                    writer.merge(shard_writer)
+                words_with_frequencies.merge(counts)
+                errors.merge(shard_errors)
+    
+    errors.report()
+    if index!=None:
+        writer.save(index)
 
-for root, _, files in os.walk(args.path):
-    for file_name in files:
-        if file_name.endswith('.json'):
-            print (file_name)
-            with open(join(root,file_name)) as json_file:
-                json_data = json.load(json_file)
-                for body_text_segment in json_data['body_text']:
-                    for token in nlp(body_text_segment['text']):
-                        if not token.is_stop and token.lemma_.isalpha():
-                            words_with_frequencies[token.lemma_.lower()]+=1
+    return words_with_frequencies.get_sorted(top)
 
-# Sort in descending order by frequency
+# update_store
+#
+# Bring a termstore.TermStore up to date with the corpus, processing only files that
+# have been added or modified since it was last updated, and removing files that have
+# been deleted. Returns words and counts for the whole corpus. Files that couldn't be
+# read are listed at the end, and not recorded, so they will be tried again next time.
 
-word_freq_sorted = sorted(list(words_with_frequencies.items()),
-                          key = lambda x: x[1],
-                          reverse=True)
+def update_store(store,path,workers=None,batch_size=1000,verbose=False,top=None,threads=8):
+    changed,deleted = store.get_changes([os.path.relpath(file_name,path)
+                                         for file_name in corpus.find_json_files(path)])
+    for file_name in deleted:
+        store.remove(file_name)
+    store.commit()
+    if verbose:
+        print (f'{len(changed)} files added or modified, {len(deleted)} deleted')
+    
+    size    = 1000 if workers==None else max(1,min(1000,math.ceil(len(changed)/(4*workers))))
+    chunks  = [changed[i:i+size] for i in range(0,len(changed),size)]
+    def get_names(chunk):
+        return [join(path,file_name) for file_name,_,_,_ in chunk]
+    
+    if workers==None:
+        counts = (count_documents(get_names(chunk),batch_size=batch_size,mode=store.mode,threads=threads)
+                  for chunk in chunks)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers,initializer=create_nlp)
+        counts   = executor.map(count_documents,
+                                [get_names(chunk) for chunk in chunks],
+                                repeat(batch_size),
+                                repeat(store.mode),
+                                repeat(threads))
+    
+    errors = corpus.Errors()
+    for chunk,(chunk_counts,chunk_errors) in zip(chunks,counts):
+        for (file_name,mtime,file_size,hash),document_counts in zip(chunk,chunk_counts):
+            if document_counts!=None:
+                store.add(file_name,mtime,file_size,hash,document_counts)
+        store.commit()
+        errors.merge(chunk_errors)
+    
+    if workers!=None:
+        executor.shutdown()
+    
+    errors.report()
+    return store.get_frequencies(top)
 
+# write_frequencies
+#
 # Output words and frequencies as a CSV file
 
-with open(args.out,'w') as out:
-    for word,frequency in word_freq_sorted:
-        try:
-            out.write(f'{word},{frequency}\n')
-        except UnicodeEncodeError:
-            pass
+def write_frequencies(word_freq_sorted,out='keywords.csv'):
+    with open(out,'w') as out:
+        for word,frequency in word_freq_sorted:
+            try:
+                out.write(f'{word},{frequency}\n')
+            except UnicodeEncodeError:
+                pass
 
-# Optionally plot frequencies on a log-log scale
+# plot_frequencies
+#
+# Plot frequencies on a log-log scale
 
-if args.plot:
+def plot_frequencies(word_freq_sorted):
     plt.plot([math.log(i+1) for i in range(len(word_freq_sorted))],
              [math.log(frequency) for _,frequency in word_freq_sorted])
     plt.title('To Zipf, or not to Zipf?')
     plt.ylabel('Log Frequency')
     plt.xlabel('Log Rank')
     plt.savefig('Frequencies')
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser('Extract keywords from json files')
+    parser.add_argument('--path',                   default=r'C:\CORD-19',    help='Path of root of json files')
+    parser.add_argument('--out',                    default='keywords.csv',   help='Path to store keywords')
+    parser.add_argument('--plot',                   default=False,            help='Plot frequncies', action='store_true')
+    parser.add_argument('--workers',    type=int,   default=None,             help='Share files among this many processes')
+    parser.add_argument('--batch-size', type=int,   default=1000,             help='Number of segments of text to be tokenized together')
+    parser.add_argument('--verbose',                default=False,            help='Print name of each file', action='store_true')
+    parser.add_argument('--store',                  default=None,             help='Database of counts for each file, so only files that '
+                                                                                   'have changed since last run need to be processed')
+    parser.add_argument('--index',                  default=None,             help='Directory in which to save inverted index '
+                                                                                   '(see invertedindex.py for queries)')
+    parser.add_argument('--mode',                   default='term',           help='Count occurrences of each word (term), or documents '
+                                                                                   'in which it occurs (document)', choices=['term','document'])
+    parser.add_argument('--top',        type=int,   default=None,             help='Only output this many of the most frequent words')
+    parser.add_argument('--threads',    type=int,   default=8,                help='Number of threads reading files (for each process)')
+    args  = parser.parse_args()
+    if args.store!=None and args.index!=None:
+        parser.error('--index needs every file to be processed, so it cannot be used with --store')
+    
+    if args.store==None:
+        word_freq_sorted = get_frequencies(args.path,
+                                           workers    = args.workers,
+                                           batch_size = args.batch_size,
+                                           verbose    = args.verbose,
+                                           index      = args.index,
+                                           mode       = args.mode,
+                                           top        = args.top,
+                                           threads    = args.threads)
+    else:
+        store            = termstore.TermStore(args.store,root=args.path,mode=args.mode)
+        word_freq_sorted = update_store(store,
+                                        args.path,
+                                        workers    = args.workers,
+                                        batch_size = args.batch_size,
+                                        verbose    = args.verbose,
+                                        top        = args.top,
+                                        threads    = args.threads)
+        store.close()
+    
+    write_frequencies(word_freq_sorted,out=args.out)
+    
+    if args.plot:
+        plot_frequencies(word_freq_sorted)
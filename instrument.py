@@ -0,0 +1,226 @@
+# instrument.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Optional instrumentation, to find where the time goes in a simulation: timers for
+# phases and calls of interest, counters (evaluations of the right hand side, accepted
+# and rejected steps of the solver), and a summary of each run.
+#
+# Nothing is recorded unless enable() has been called. When it hasn't, timer() returns
+# a context manager that does nothing, and callers test enabled before doing any work
+# to collect values, so the cost is a few attribute lookups per call.
+#
+# Evaluations of the right hand side are taken from the solver's nfev, so dy itself is
+# not wrapped. The solvers don't report rejected steps; for the explicit Runge-Kutta
+# methods they are inferred from nfev, since every attempted step costs n_stages evaluations.
+# For other methods, rejected steps are not counted.
+
+import csv, sys, time, numpy as np, scipy.integrate
+from contextlib import nullcontext
+from accumulator import Accumulator
+
+enabled = False
+stats   = None
+
+RUNGE_KUTTA = {'RK23':scipy.integrate.RK23, 'RK45':scipy.integrate.RK45, 'DOP853':scipy.integrate.DOP853}
+
+NULL_TIMER = nullcontext()
+
+# Stats
+#
+# Everything recorded by one process
+
+class Stats:
+    def __init__(self,keep_runs=False):
+        self.timers   = {}                           # name -> [calls, total, max] (seconds)
+        self.counters = {}                           # name -> total
+        self.runs     = {}                           # field -> Accumulator, over all runs
+        self.records  = [] if keep_runs else None    # Summary of each run
+
+    def merge(self,other):
+        for name,(calls,total,longest) in other.timers.items():
+            timer    = self.timers.setdefault(name,[0,0.0,0.0])
+            timer[0] += calls
+            timer[1] += total
+            timer[2]  = max(timer[2],longest)
+        for name,value in other.counters.items():
+            self.counters[name] = self.counters.get(name,0) + value
+        for name,values in other.runs.items():
+            self.runs.setdefault(name,Accumulator()).merge(values)
+        if self.records!=None and other.records!=None:
+            self.records.extend(other.records)
+
+# Timer
+#
+# Context manager that adds time taken to a named timer
+
+class Timer:
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,*exception):
+        self.elapsed = time.perf_counter() - self.start
+        add_time(self.name,self.elapsed)
+        return False
+
+# enable
+#
+# Start recording, discarding anything recorded earlier
+#
+# Parameters:
+#     keep_runs     Keep summary of every run (see write_runs), as well as aggregates
+
+def enable(keep_runs=False):
+    global enabled, stats
+    enabled = True
+    stats   = Stats(keep_runs=keep_runs)
+
+def disable():
+    global enabled
+    enabled = False
+
+# timer
+#
+# Context manager to time a block of code, e.g. with instrument.timer('plot'): ...
+
+def timer(name):
+    return Timer(name) if enabled else NULL_TIMER
+
+def add_time(name,seconds):
+    timer     = stats.timers.setdefault(name,[0,0.0,0.0])
+    timer[0] += 1
+    timer[1] += seconds
+    timer[2]  = max(timer[2],seconds)
+
+def count(name,n=1):
+    if enabled:
+        stats.counters[name] = stats.counters.get(name,0) + n
+
+# get_rejected
+#
+# Infer number of rejected steps from number of evaluations of right hand side
+#
+# Parameters:
+#     method        Integration method
+#     nfev          Number of evaluations made by steps (not counting those made when solver was created)
+#     accepted      Number of steps accepted
+#     dense_output  Set if solver computed dense output (DOP853 needs extra evaluations for this)
+#
+# Returns:
+#     Number of steps rejected, or None if it can't be inferred for this method
+
+def get_rejected(method,nfev,accepted,dense_output=False):
+    if method not in RUNGE_KUTTA: return None
+    if method=='DOP853' and dense_output:
+        nfev -= 3*accepted
+    return max(0,nfev//RUNGE_KUTTA[method].n_stages - accepted)
+
+# count_solver
+#
+# Add counts from a solution or solver to counters
+#
+# Parameters:
+#     nfev          Evaluations of right hand side
+#     njev          Evaluations of Jacobian
+#     accepted      Number of steps accepted
+#     rejected      Number of steps rejected, or None if not known
+
+def count_solver(nfev,njev,accepted,rejected):
+    count('dy calls',nfev)
+    count('jacobian calls',njev)
+    count('accepted steps',accepted)
+    if rejected!=None:
+        count('rejected steps',rejected)
+
+# count_solution
+#
+# Add counts from the result of solve_ivp (called without t_eval) to counters,
+# allowing for the two evaluations made when the solver is created.
+
+def count_solution(sol,method,dense_output=False):
+    accepted = len(sol.t) - 1
+    count_solver(sol.nfev,sol.njev,accepted,get_rejected(method,sol.nfev-2,accepted,dense_output=dense_output))
+
+# record_run
+#
+# Record summary of one run: values are added to aggregates, and kept if requested
+
+def record_run(run,**values):
+    for name,value in values.items():
+        if value!=None:
+            stats.runs.setdefault(name,Accumulator()).add(value)
+    if stats.records!=None:
+        stats.records.append(dict(run=run,**values))
+
+# take
+#
+# Return everything recorded so far, and start again: used by worker processes to
+# send their records to the parent, which merges them.
+
+def take():
+    global stats
+    taken = stats
+    stats = Stats(keep_runs=taken.records!=None)
+    return taken
+
+def merge(other):
+    stats.merge(other)
+
+# run_profiled
+#
+# Enable instrumentation in a worker process, call function, and return its result,
+# together with what was recorded
+
+def run_profiled(function,keep_runs,*args):
+    enable(keep_runs=keep_runs)
+    return function(*args), take()
+
+# report
+#
+# Print aggregate report
+
+def report(file=sys.stdout):
+    if stats==None: return
+    if len(stats.timers)>0:
+        print (f'{"Timer":32s}{"Calls":>10s}{"Total (s)":>12s}{"Mean (s)":>12s}{"Max (s)":>12s}',file=file)
+        for name,(calls,total,longest) in sorted(stats.timers.items(),key=lambda item:-item[1][1]):
+            print (f'{name:32s}{calls:10d}{total:12.4g}{total/calls:12.4g}{longest:12.4g}',file=file)
+    if len(stats.counters)>0:
+        print (f'{"Counter":32s}{"Total":>10s}',file=file)
+        for name,value in stats.counters.items():
+            print (f'{name:32s}{value:10d}',file=file)
+        if stats.counters.get('accepted steps',0)>0 and 'rejected steps' in stats.counters:
+            attempts = stats.counters['accepted steps'] + stats.counters['rejected steps']
+            print (f'{"rejection rate":32s}{stats.counters["rejected steps"]/attempts:10.3f}',file=file)
+    with np.errstate(invalid='ignore',divide='ignore'):     # CV of values that are all zero
+        for name,values in stats.runs.items():
+            print (f'Per run, {name}: {values}',file=file)
+
+# write_runs
+#
+# Write summary of each run to a CSV file, in order of run
+
+def write_runs(file_name):
+    if stats==None or stats.records==None or len(stats.records)==0: return
+    fields = list(dict.fromkeys(field for record in stats.records for field in record))
+    with open(file_name,'w',newline='') as runs_file:
+        writer = csv.DictWriter(runs_file,fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(sorted(stats.records,key=lambda record:record['run']))
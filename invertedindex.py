@@ -0,0 +1,206 @@
+# invertedindex.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Inverted index for a corpus: for each word, the documents in which it occurs.
+#
+# An index is a directory containing:
+#     papers.json     paper_id of each document, in order of document number
+#     words.json      All words, sorted
+#     terms.npy       For each word, offset of its postings and number of documents
+#     postings.npy    Document numbers for each word in turn, in ascending order. Each
+#                     is stored as the difference from its predecessor (the first as it
+#                     is), using the smallest unsigned type that fits. Postings are
+#                     memory-mapped when the index is opened.
+
+import json, numpy as np, os
+from array import array
+from bisect import bisect_left
+from os.path import join
+
+TERM = np.dtype([('offset', np.int64),    # Position of first posting
+                 ('df',     np.int64)])   # Number of documents containing word
+
+# extend
+#
+# Append a numpy array to an array.array, without converting it to a list
+
+def extend(target,values):
+    target.frombytes(memoryview(np.ascontiguousarray(values,dtype=target.typecode)).cast('B'))
+
+# IndexWriter
+#
+# Collect words from documents, one document at a time, then save index
+
+class IndexWriter:
+    def __init__(self):
+        self.vocabulary = {}
+        self.papers     = []
+        self.word_ids   = array('I')
+        self.documents  = array('I')
+
+    # add
+    #
+    # Add next document
+    #
+    # Parameters:
+    #     paper_id  Identifies document
+    #     words     Words found in document
+    #
+    # Returns:
+    #     Document number, which may be used to add more words later
+
+    def add(self,paper_id,words=[]):
+        document = len(self.papers)
+        self.papers.append(paper_id)
+        self.add_words(document,words)
+        return document
+
+    def add_words(self,document,words):
+        word_ids = [self.vocabulary.setdefault(word,len(self.vocabulary)) for word in set(words)]
+        self.word_ids.extend(word_ids)
+        self.documents.extend([document]*len(word_ids))
+
+    # merge
+    #
+    # Append documents from another IndexWriter
+
+    def merge(self,other):
+        word_ids = np.array([self.vocabulary.setdefault(word,len(self.vocabulary)) for word in other.vocabulary],
+                            dtype=self.word_ids.typecode)
+        extend(self.word_ids,word_ids[np.frombuffer(other.word_ids,dtype=other.word_ids.typecode)])
+        extend(self.documents,np.frombuffer(other.documents,dtype=other.documents.typecode) +
+                              np.dtype(self.documents.typecode).type(len(self.papers)))
+        self.papers.extend(other.papers)
+
+    def save(self,path):
+        os.makedirs(path,exist_ok=True)
+        words        = sorted(self.vocabulary)
+        rank         = np.empty(len(words),dtype=np.int64)
+        rank[[self.vocabulary[word] for word in words]] = np.arange(len(words))
+        word_ids     = rank[np.asarray(self.word_ids,dtype=np.int64)]
+        documents    = np.asarray(self.documents,dtype=np.int64)
+        order        = np.lexsort((documents,word_ids))
+        word_ids     = word_ids[order]
+        documents    = documents[order]
+        distinct     = np.ones(len(documents),dtype=bool)
+        distinct[1:] = (word_ids[1:]!=word_ids[:-1]) | (documents[1:]!=documents[:-1])
+        word_ids     = word_ids[distinct]
+        documents    = documents[distinct]
+        terms        = np.zeros(len(words),dtype=TERM)
+        terms['df']  = np.bincount(word_ids,minlength=len(words))
+        terms['offset'][1:] = np.cumsum(terms['df'])[:-1]
+        gaps         = documents.copy()
+        gaps[1:]    -= documents[:-1]
+        gaps[terms['offset'][terms['df']>0]] = documents[terms['offset'][terms['df']>0]]
+        largest      = int(gaps.max()) if len(gaps)>0 else 0
+        dtype        = next(dtype for dtype in [np.uint8,np.uint16,np.uint32,np.uint64] if largest<=np.iinfo(dtype).max)
+        np.save(join(path,'postings.npy'),gaps.astype(dtype))
+        np.save(join(path,'terms.npy'),terms)
+        with open(join(path,'words.json'),'w') as words_file:
+            json.dump(words,words_file)
+        with open(join(path,'papers.json'),'w') as papers_file:
+            json.dump(self.papers,papers_file)
+
+# InvertedIndex
+#
+# Query an index that has been saved by IndexWriter
+
+class InvertedIndex:
+    def __init__(self,path):
+        with open(join(path,'words.json')) as words_file:
+            self.words = json.load(words_file)
+        with open(join(path,'papers.json')) as papers_file:
+            self.papers = json.load(papers_file)
+        self.terms      = np.load(join(path,'terms.npy'))
+        self.postings   = np.load(join(path,'postings.npy'),mmap_mode='r')
+        self.word_index = {word:i for i,word in enumerate(self.words)}
+
+    # get_documents
+    #
+    # Document numbers of documents that contain word, in ascending order
+
+    def get_documents(self,word):
+        if word not in self.word_index: return np.zeros(0,dtype=np.int64)
+        offset,df = self.terms[self.word_index[word]]
+        return np.cumsum(self.postings[offset:offset+df],dtype=np.int64)
+
+    def get_document_frequency(self,word):
+        return int(self.terms['df'][self.word_index[word]]) if word in self.word_index else 0
+
+    def get_papers(self,documents):
+        return [self.papers[document] for document in documents]
+
+    # query_and
+    #
+    # paper_ids of documents that contain every word
+
+    def query_and(self,words):
+        words     = sorted(words,key=self.get_document_frequency)
+        documents = self.get_documents(words[0]) if len(words)>0 else np.zeros(0,dtype=np.int64)
+        for word in words[1:]:
+            if len(documents)==0: break
+            documents = np.intersect1d(documents,self.get_documents(word),assume_unique=True)
+        return self.get_papers(documents)
+
+    # query_or
+    #
+    # paper_ids of documents that contain any of the words
+
+    def query_or(self,words):
+        return self.get_papers(np.unique(np.concatenate([self.get_documents(word) for word in words]+
+                                                        [np.zeros(0,dtype=np.int64)])))
+
+    # get_top
+    #
+    # The k words that occur in most documents, optionally restricted to words starting with prefix
+    #
+    # Returns:
+    #     List of (word,number of documents), in descending order of number of documents
+
+    def get_top(self,k=10,prefix=''):
+        first  = bisect_left(self.words,prefix)
+        last   = bisect_left(self.words,prefix+'\U0010ffff') if len(prefix)>0 else len(self.words)
+        dfs    = self.terms['df'][first:last]
+        k      = min(k,len(dfs))
+        if k==0: return []
+        # Find k-th largest count, then take words that reach it, alphabetically among equals
+        least  = dfs[np.argpartition(-dfs,k-1)[k-1]]
+        top    = np.flatnonzero(dfs>=least)
+        top    = top[np.lexsort((top,-dfs[top]))][:k]
+        return [(self.words[first+i],int(dfs[i])) for i in top]
+
+if __name__=='__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser('Query inverted index of corpus (see extract-keys.py --index)')
+    parser.add_argument('--index',             default='index',  help='Directory containing index')
+    parser.add_argument('--all',               default=[],       help='List papers that contain all these words',  nargs='+')
+    parser.add_argument('--any',               default=[],       help='List papers that contain any of these words', nargs='+')
+    parser.add_argument('--top',    type=int,  default=None,     help='List words that occur in most papers')
+    parser.add_argument('--prefix',            default='',       help='Restrict --top to words with this prefix')
+    args = parser.parse_args()
+
+    index = InvertedIndex(args.index)
+    if len(args.all)>0:
+        for paper_id in index.query_and(args.all):
+            print (paper_id)
+    if len(args.any)>0:
+        for paper_id in index.query_or(args.any):
+            print (paper_id)
+    if args.top!=None:
+        for word,df in index.get_top(args.top,prefix=args.prefix):
+            print (f'{word},{df}')
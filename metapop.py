@@ -0,0 +1,342 @@
+# metapop.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Metapopulation version of the SEPIR model (see sepir.py): R regions, each with its own
+# population, ICU beds, and schedule of NPIs, coupled by mobility.
+#
+# The state is a (7,R) array, one column for each region, holding fractions of that
+# region's population; it is flattened (compartment by compartment) for solve_ivp.
+# People in region r are infected at rate beta[r] * S[r] * (C @ (epsilon*P + I))[r], where
+# C is a sparse R x R coupling matrix: C[r,j] is the weight of contacts that residents of
+# r have with residents of j. Rows normally sum to 1; if C is the identity, each region
+# follows sepir.dy on its own, except that the case fatality rate is never allowed to
+# fall below CFR0 (see get_CFR). Each region's case fatality rate depends on its own
+# ICU beds and cases.
+#
+# The Jacobian is sparse: apart from infection, which couples regions through C, each
+# compartment of a region depends only on compartments of the same region. It is supplied
+# to the implicit solvers as a sparse matrix, or, if they are to estimate it by finite
+# differences, its sparsity structure is supplied as jac_sparsity.
+
+import argparse, numpy as np, scipy.sparse as sparse, sepir, ensemble
+from scipy.integrate import solve_ivp
+from scipy.optimize import OptimizeResult
+
+# get_CFR
+#
+# Case fatality rate in each region, as for sepir.dy, but never less than CFR0 (as in
+# stochastic.get_CFR): while a region's ICUs can cope, the rate is CFR0, and it rises
+# towards CFR1 as they are overwhelmed. This keeps dy continuous as the number of cases
+# in a region falls to zero, which the implicit solvers need.
+
+def get_CFR(I,N,CFR1,CFR0,nICU,pICU):
+    overflow = I*N*pICU > nICU
+    return np.where(overflow,
+                    CFR1 - (nICU/(N*np.where(overflow,I,1)*pICU)) * (CFR1 - CFR0),
+                    CFR0)
+
+# dy
+#
+# Compute derivative of state
+#
+# Parameters:
+#     t
+#     y        State, flattened from shape (7,R)
+#     C        Coupling matrix, scipy.sparse, shape (R,R)
+#     N        Population of each region
+#     beta     Transmission coefficient for each region
+#     nICU     Number of ICU beds in each region
+#     Others as for sepir.dy (scalars, or one value for each region)
+
+def dy(t,y,C,N,c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,nICU,pICU):
+    S,E,P,I0,I1,_,_ = np.reshape(y,(7,-1))
+    infection = beta * S * (C @ (epsilon*P + I0 + I1))
+    survival  = 1 - get_CFR(I0 + I1,N,CFR1,CFR0,nICU,pICU)
+    return np.concatenate([-infection,
+                           infection - alpha*E,
+                           alpha*E - delta*P,
+                           delta*P - (gamma + c)*I0,
+                           c*I0 - gamma*I1,
+                           gamma*survival*I0,
+                           gamma*survival*I1])
+
+# jacobian
+#
+# Exact Jacobian of dy, as a sparse matrix, built from 7 x 7 blocks, each R x R. Blocks
+# are diagonal, except for the dependence of infection on P, I0 and I1, which follows C.
+
+def jacobian(t,y,C,N,c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,nICU,pICU):
+    S,E,P,I0,I1,_,_ = np.reshape(y,(7,-1))
+    R        = len(S)
+    ones     = np.ones(R)
+    I        = I0 + I1
+    force    = beta * (C @ (epsilon*P + I))
+    contact  = sparse.diags(beta*S) @ C                 # d(infection)/dI, for I0 and I1
+    survival = 1 - get_CFR(I,N,CFR1,CFR0,nICU,pICU)
+    # Where the ICUs are overwhelmed, 1 - CFR = (1-CFR1) + excess, with excess inversely
+    # proportional to I, so the recovered terms depend on the mix of I0 and I1. The
+    # derivatives are bounded, since excess < CFR1-CFR0.
+    overflow = I*N*pICU > nICU
+    I        = np.where(overflow, I, 1)
+    excess   = np.where(overflow, nICU*(CFR1 - CFR0)/(N*pICU*I), 0)
+    share0   = I0/I
+    share1   = I1/I
+    diagonal = lambda values: sparse.diags(values*ones)
+    blocks   = [[None]*7 for _ in range(7)]
+    blocks[0][0] = diagonal(-force)
+    blocks[0][2] = -contact @ diagonal(epsilon)
+    blocks[0][3] = -contact
+    blocks[0][4] = -contact
+    blocks[1][0] = diagonal(force)
+    blocks[1][1] = diagonal(-alpha)
+    blocks[1][2] = -blocks[0][2]
+    blocks[1][3] = contact
+    blocks[1][4] = contact
+    blocks[2][1] = diagonal(alpha)
+    blocks[2][2] = diagonal(-delta)
+    blocks[3][2] = diagonal(delta)
+    blocks[3][3] = diagonal(-(gamma + c))
+    blocks[4][3] = diagonal(c)
+    blocks[4][4] = diagonal(-gamma)
+    blocks[5][3] = diagonal(gamma*(survival - excess*share0))
+    blocks[5][4] = diagonal(-gamma*excess*share0)
+    blocks[6][3] = diagonal(-gamma*excess*share1)
+    blocks[6][4] = diagonal(gamma*(survival - excess*share1))
+    blocks[5][5] = sparse.csr_matrix((R,R))           # Fixes shape of last rows and columns
+    blocks[6][6] = sparse.csr_matrix((R,R))
+    return sparse.bmat(blocks,format='csc')
+
+# get_sparsity
+#
+# Sparsity structure of the Jacobian, for finite difference estimates
+
+def get_sparsity(C):
+    R          = C.shape[0]
+    identity   = sparse.identity(R,format='csr')
+    coupling   = (C!=0).astype(float) + identity
+    blocks     = [[None]*7 for _ in range(7)]
+    for i,j in [(0,0),(1,0),(1,1),(2,1),(2,2),(3,2),(3,3),(4,3),(4,4),(5,3),(5,4),(6,3),(6,4)]:
+        blocks[i][j] = identity
+    for i in [0,1]:
+        for j in [2,3,4]:
+            blocks[i][j] = coupling
+    blocks[5][5] = sparse.csr_matrix((R,R))
+    blocks[6][6] = sparse.csr_matrix((R,R))
+    return sparse.bmat(blocks,format='csc')
+
+# get_solver_options
+#
+# Keyword arguments for solve_ivp(dy,...). For Radau and BDF, the Jacobian is supplied
+# as a sparse matrix, or, if analytic is False, just its sparsity structure. LSODA cannot
+# use sparse Jacobians, so it estimates a dense one.
+
+def get_solver_options(method,C,analytic=True):
+    options = dict(method=method)
+    if method in ['Radau','BDF']:
+        if analytic:
+            options['jac'] = jacobian
+        else:
+            options['jac_sparsity'] = get_sparsity(C)
+    return options
+
+# get_initial_y
+#
+# Initial state: everyone susceptible, except for the number exposed in each region
+
+def get_initial_y(initial,N):
+    y    = np.zeros((7,len(N)))
+    y[1] = np.asarray(initial)/N
+    y[0] = 1 - y[1]
+    return y
+
+# evolve_regions
+#
+# Integrate the model over t_range, applying each region's NPIs to its R0 at the specified
+# times. The integration is restarted at each time at which some region applies an NPI.
+#
+# Returns:
+#     Solution with fields t, and y, with shape (7,R,len(t)); plus nfev, njev, nlu
+#     summed over all intervals
+
+def evolve_regions(C,                   # Coupling matrix, scipy.sparse, shape (R,R)
+                   N,                   # Population of each region
+                   nICU,                # Number of ICU beds in each region
+                   initial,             # Initial number exposed in each region
+                   NPIs    = None,      # For each region, a list [(t1,f1),(t2,f2),...]: apply factor f1 to R0 at t1...
+                   R0      = 2.5,       # Initial value of Basic Reproduction number (scalar or one for each region)
+                   t_range = (0,400),   # Range of times (days)
+                   c       = 0.1,       # Testing rate for symptomatic cases, per diem
+                   alpha   = 0.25,      # E to P transition rate, per diem
+                   gamma   = 0.1,       # I to R transition, per diem
+                   delta   = 1,         # P to I, per diem
+                   epsilon = 0.15,      # relative infectiousness
+                   CFR1    = 2.0/100,   # case fatality rate for cases exceedinging ICU max
+                   CFR0    = 1.0/100,   # case fatality rate for cases under ICU max
+                   pICU    = 1.25/100,  # proportion of cases requiring ICU
+                   atol    = 1e-9,
+                   rtol    = 1e-6,
+                   method  = 'RK45',    # Integration method for solve_ivp
+                   analytic= True,      # Use analytic Jacobian (otherwise, finite differences with jac_sparsity)
+                   t_eval  = None):     # Times at which solution is wanted (default: points chosen by solver)
+    C        = sparse.csr_matrix(C)
+    N        = np.asarray(N,dtype=float)
+    nICU     = np.asarray(nICU,dtype=float)
+    R        = len(N)
+    beta     = sepir.get_beta(R0=R0,gamma=gamma,delta=delta,epsilon=epsilon) * np.ones(R)
+    t,t_end  = t_range
+    breakpoints,regions,factors = ensemble.create_schedule(NPIs if NPIs!=None else [[] for _ in range(R)])
+    for i in np.flatnonzero(breakpoints<=t):
+        np.multiply.at(beta,regions[i],factors[i])
+    stops    = [(breakpoint,i) for i,breakpoint in enumerate(breakpoints) if t<breakpoint<t_end] + [(t_end,None)]
+    options  = get_solver_options(method,C,analytic=analytic)
+    t_eval   = None if t_eval is None else np.asarray(t_eval)
+    y        = get_initial_y(initial,N).ravel()
+    ts       = []
+    ys       = []
+    nfev     = njev = nlu = 0
+    for t_stop,i in stops:
+        if t_eval is None:
+            segment = None
+        else:
+            # Points wanted in this interval, and its end, where the next starts
+            wanted  = t_eval[(t_eval>t) & (t_eval<=t_stop) | (t_eval==t) & (len(ts)==0)]
+            segment = np.union1d(wanted,[t_stop])
+        sol     = solve_ivp(dy,(t,t_stop),y,
+                            args   = (C,N,c,alpha,beta.copy(),gamma,delta,epsilon,CFR1,CFR0,nICU,pICU),
+                            atol   = atol,
+                            rtol   = rtol,
+                            t_eval = segment,
+                            **options)
+        if not sol.success:
+            raise RuntimeError(f'Solver failed between {t} and {t_stop}: {sol.message}')
+        keep    = (np.arange(len(sol.t))>0) | (len(ts)==0) if t_eval is None else np.isin(sol.t,wanted)
+        ts.append(sol.t[keep])
+        ys.append(sol.y[:,keep])
+        nfev,njev,nlu = nfev+sol.nfev, njev+sol.njev, nlu+sol.nlu
+        t,y     = t_stop, sol.y[:,-1]
+        if i!=None:
+            np.multiply.at(beta,regions[i],factors[i])
+    t = np.concatenate(ts)
+    return OptimizeResult(t    = t,
+                          y    = np.concatenate(ys,axis=1).reshape(7,R,len(t)),
+                          nfev = nfev,
+                          njev = njev,
+                          nlu  = nlu)
+
+# create_regions
+#
+# Synthetic regions for experiments: populations drawn from a lognormal distribution,
+# ICU beds in proportion to population, and regions arranged in a ring, each sending
+# a proportion mobility of its contacts equally to the neighbours on either side.
+#
+# Returns:
+#     C, N, nICU
+
+def create_regions(R=100,neighbours=2,mobility=0.05,N=5000000,nICU=300,rng=None):
+    if rng==None:
+        rng = np.random.default_rng()
+    populations = np.maximum(1000,np.round(rng.lognormal(np.log(N/R),1,size=R)))
+    beds        = np.round(nICU*populations/N)
+    rows,cols   = [],[]
+    for offset in range(1,neighbours+1):
+        for sign in [-1,1]:
+            rows.append(np.arange(R))
+            cols.append((np.arange(R) + sign*offset) % R)
+    rows        = np.concatenate(rows)
+    cols        = np.concatenate(cols)
+    C           = sparse.csr_matrix((np.full(len(rows),mobility/len(rows)*R),(rows,cols)),shape=(R,R))
+    C.sum_duplicates()
+    return C + sparse.diags(1-np.asarray(C.sum(axis=1)).ravel()), populations, beds
+
+if __name__=='__main__':
+    import random, t028
+    from accumulator import Accumulator
+
+    parser = argparse.ArgumentParser('Metapopulation SEPIR model: regions coupled by mobility')
+    parser.add_argument('--R',          type=int,   default=100,        help='Number of synthetic regions')
+    parser.add_argument('--neighbours', type=int,   default=2,          help='Number of neighbours on each side of a synthetic region')
+    parser.add_argument('--mobility',   type=float, default=0.05,       help='Proportion of contacts of synthetic regions with neighbours')
+    parser.add_argument('--regions',                default=None,       help='CSV file with N and nICU for each region, '
+                                                                             'and optionally initial (instead of synthetic regions)')
+    parser.add_argument('--coupling',               default=None,       help='Coupling matrix, saved by scipy.sparse.save_npz (with --regions)')
+    parser.add_argument('--N',          type=int,   default=5000000,    help='Total population of synthetic regions')
+    parser.add_argument('--nICU',       type=int,   default=300,        help='Total number of ICU beds in synthetic regions')
+    parser.add_argument('--initial',    type=int,   default=20,         help='Number of exposed people in first region at start')
+    parser.add_argument('--R0',         type=float, default=2.5,        help='Initial value of Basic Reproduction number')
+    parser.add_argument('--end',        type=int,   default=400,        help='Number of days to be simulated')
+    parser.add_argument('--start',      type=int,   default=None,       help='Start applying NPIs (default: no NPIs)')
+    parser.add_argument('--dt',         type=int,   default=5,          help='Average interval between NPIs')
+    parser.add_argument('--average',    type=float, default=0.95,       help='Average effect of an NPI on R0')
+    parser.add_argument('--method',                 default='RK45',     help='Integration method for ode solver',
+                        choices=['RK45','RK23','DOP853']+sepir.IMPLICIT_METHODS)
+    parser.add_argument('--jacobian',               default='analytic', help='Supply Jacobian to implicit methods, or just its sparsity',
+                        choices=['analytic','sparsity'])
+    parser.add_argument('--atol',       type=float, default=1e-9,       help='Absolute tolerance for ode solver')
+    parser.add_argument('--rtol',       type=float, default=1e-6,       help='Relative tolerance for ode solver')
+    parser.add_argument('--seed',       type=int,   default=None,       help='Seed for random number generator')
+    parser.add_argument('--out',                    default=None,       help='Save solution (daily) to this file (npz)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.regions==None:
+        C,N,nICU = create_regions(R=args.R,neighbours=args.neighbours,mobility=args.mobility,N=args.N,nICU=args.nICU,rng=rng)
+        initial  = np.zeros(args.R)
+        initial[0] = args.initial
+    else:
+        regions  = np.genfromtxt(args.regions,delimiter=',',names=True)
+        C        = sparse.load_npz(args.coupling) if args.coupling!=None else sparse.identity(len(regions))
+        N        = regions['N']
+        nICU     = regions['nICU']
+        initial  = regions['initial'] if 'initial' in regions.dtype.names else np.zeros(len(regions))
+        if 'initial' not in regions.dtype.names:
+            initial[0] = args.initial
+
+    NPIs = None
+    if args.start!=None:
+        npi_rng = random.Random(args.seed)
+        NPIs = [t028.create_NPIs(start       = args.start,
+                                 R0          = args.R0,
+                                 lower_bound = 2*args.average-1,
+                                 upper_bound = 1,
+                                 dt          = 2*args.dt,
+                                 rng         = npi_rng)
+                for _ in range(len(N))]
+
+    sol = evolve_regions(C,N,nICU,initial,
+                         NPIs     = NPIs,
+                         R0       = args.R0,
+                         t_range  = (0,args.end),
+                         atol     = args.atol,
+                         rtol     = args.rtol,
+                         method   = args.method,
+                         analytic = args.jacobian=='analytic',
+                         t_eval   = np.arange(0,args.end+1))
+    print (f'Evaluations: {sol.nfev}, Jacobians: {sol.njev}, LU decompositions: {sol.nlu}')
+
+    infected = (sol.y[sepir.Indices.INFECTIOUS_UNTESTED.value] + sol.y[sepir.Indices.INFECTIOUS_TESTED.value]) * N[:,None]
+    total    = infected.sum(axis=0)
+    print (f'Peak infections: {total.max():.6g} on day {sol.t[total.argmax()]:.0f}')
+    print (f'Infections:      {np.sum(N*(1-sol.y[sepir.Indices.SUSCEPTIBLE.value,:,-1])):.6g}')
+    print (f'Deaths:          {np.sum(N*(1-sol.y[:,:,-1].sum(axis=0))):.6g}')
+    for name,values in [('Day of peak in each region', sol.t[infected.argmax(axis=1)]),
+                        ('Peak in each region',        infected.max(axis=1))]:
+        statistics = Accumulator()
+        statistics.extend(values)
+        print (f'{name}: {statistics}')
+
+    if args.out!=None:
+        np.savez(args.out,t=sol.t,y=sol.y,N=N,nICU=nICU)
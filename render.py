@@ -0,0 +1,148 @@
+# render.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Render plots to files without a display. Figures are drawn with matplotlib's object API
+# on an Agg canvas, and each process reuses one figure for each size, so rendering many
+# plots doesn't accumulate figures. Long trajectories are decimated before drawing, and
+# batches of plots may be rendered by several processes.
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+# get_figure
+#
+# Blank figure of specified size, reused by subsequent calls in the same process
+
+figures = {}
+
+def get_figure(figsize=(20,6)):
+    if figsize not in figures:
+        figures[figsize] = Figure(figsize=figsize)
+        FigureCanvasAgg(figures[figsize])
+    figure = figures[figsize]
+    figure.clear()
+    return figure
+
+# decimate
+#
+# Select points to plot from long curves. The points are divided into buckets, and the
+# smallest and largest value of each curve in each bucket are kept, together with the
+# first and last points, so peaks and troughs survive.
+#
+# Parameters:
+#     t           Times, which all curves share
+#     ys          Values of curves, shape (len(t),) or (number of curves,len(t))
+#     max_points  Largest number of points to keep
+#
+# Returns:
+#     Sorted indices of points to plot
+
+def decimate(t,ys,max_points=4000):
+    n  = len(t)
+    ys = np.atleast_2d(ys)
+    if n<=max_points: return np.arange(n)
+    buckets = max(1,(max_points-2)//(2*len(ys)))
+    size    = -(-n//buckets)
+    padded  = np.pad(ys,((0,0),(0,buckets*size-n)),mode='edge').reshape(len(ys),buckets,size)
+    starts  = np.arange(buckets)*size
+    return np.unique(np.concatenate(([0,n-1],
+                                     np.ravel(starts + np.argmin(padded,axis=2)),
+                                     np.ravel(starts + np.argmax(padded,axis=2)))).clip(0,n-1))
+
+# render_detail
+#
+# Plot state vector for one value of Basic Reproduction number, and save it
+#
+# Parameters:
+#     file_name       Where plot is to be saved
+#     t               Times
+#     y               State vector at each time, shape (7,len(t))
+#     N               Population size (for scaling)
+#     Rc              Basic Reproduction number during control (for use in title)
+#     control_days    Number of days controlled
+#     R_uncontrolled  Basic Reproduction number once control is lifted (for use in title)
+#     max_points      Largest number of points to plot
+#     figure          Figure to draw on (default: reuse figure from get_figure)
+
+def render_detail(file_name,t,y,N=1,Rc=1,control_days=400,R_uncontrolled=2.5,max_points=4000,figure=None):
+    y      = N * np.asarray(y)
+    curves = [(y[0],                         dict(color='b',                 label='S (Susceptible)')),
+              (y[1],                         dict(color='g',                 label='E (Exposed)')),
+              (y[2],                         dict(color='r',                 label='P (Presymptomatic)')),
+              (y[3],                         dict(color='c', linestyle=':',  label='I0 (Infectious, untested')),
+              (y[4],                         dict(color='c', linestyle='--', label='I1 (Infectious, untested)')),
+              (y[3] + y[4],                  dict(color='c',                 label='I (Total Infectious)')),
+              (y[5],                         dict(color='m', linestyle=':',  label='R0 (Recovered, untested)')),
+              (y[6],                         dict(color='m', linestyle='--', label='R1 (Recovered, tested)')),
+              (y[5] + y[6],                  dict(color='m',                 label='R (Total Recovered)')),
+              (N - y.sum(axis=0),            dict(color='k',                 label='Deaths'))]
+    keep   = decimate(t,[curve for curve,_ in curves],max_points=max_points)
+    if figure==None:
+        figure = get_figure((20,6))
+    ax     = figure.add_subplot(111)
+    for curve,style in curves:
+        ax.plot(np.asarray(t)[keep],curve[keep],**style)
+    ax.legend(loc='best')
+    ax.set_xlabel('Days')
+    ax.set_title('Progression of COVID-19: Rc = {0:.2f} for {1} days, then {2:.2f}'.format(Rc,control_days,R_uncontrolled))
+    ax.grid()
+    ax.axvspan(0, control_days, facecolor='b', alpha=0.125)
+    figure.savefig(file_name)
+
+# render_curves
+#
+# Plot selected components of a solution, and save it
+#
+# Parameters:
+#     file_name       Where plot is to be saved
+#     t               Times
+#     ys              Values of curves, one row for each
+#     labels          Label for each curve
+#     max_points      Largest number of points to plot
+
+def render_curves(file_name,t,ys,labels=[],max_points=4000):
+    keep   = decimate(t,ys,max_points=max_points)
+    figure = get_figure((20,6))
+    ax     = figure.add_subplot(111)
+    for y,label in zip(ys,labels):
+        ax.plot(np.asarray(t)[keep],np.asarray(y)[keep],label=label)
+    ax.legend()
+    figure.savefig(file_name)
+
+# render_all
+#
+# Render a batch of plots, optionally sharing them among several processes
+#
+# Parameters:
+#     render    Function used to render each plot, e.g. render_detail
+#     jobs      Keyword arguments for each plot
+#     workers   Number of processes (None to render plots in this process)
+
+def render_all(render,jobs,workers=None):
+    if workers==None:
+        for job in jobs:
+            render(**job)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(render_job,repeat(render),jobs):
+                pass
+
+def render_job(render,job):
+    render(**job)
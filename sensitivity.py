@@ -0,0 +1,456 @@
+# sensitivity.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Global sensitivity analysis of the SEPIR model with NPIs (see sepir.py and t028.py):
+# which parameters of the model, and of the NPIs, drive peak load and total infections?
+#
+# Each factor varies uniformly between bounds, and the others keep their values. Two
+# designs are available:
+#
+#     saltelli  Matrices A and B of base samples from a scrambled Sobol sequence, and
+#               for each factor i the matrix AB_i, which is A with column i from B; so
+#               there are samples*(k+2) evaluations for k factors. First order indices
+#               use the estimator of Saltelli et al (2010), total indices Jansen's.
+#
+#     morris    Trajectories of k+1 points on a grid of levels, each step changing one
+#               factor, giving one elementary effect of each factor per trajectory.
+#               Cheaper, for screening many factors: samples*(k+1) evaluations.
+#
+# Evaluations are integrated in batches as one system (see ensemble.py), with the
+# parameters of the model given as arrays with one value for each member, and batches
+# may be shared among processes. Outputs are streamed to a checkpoint directory (see
+# checkpoint.py) as they are computed, so a long analysis can be resumed. Confidence
+# intervals for the indices come from bootstrap resamples of the base samples (or
+# trajectories).
+#
+# NPIs are drawn by t028.create_NPIs, with the same random numbers for every evaluation,
+# so each evaluation is a deterministic function of the factors. Peaks are found at the
+# steps of the ensemble, as in t028, so they vary slightly with the size of batches.
+
+import argparse, math, os, time, warnings, numpy as np, checkpoint, ensemble, sepir, t028
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from scipy.stats import qmc
+
+# Factors: default value, lower and upper bounds
+
+FACTORS = {
+    'R0'      : (2.5,      1.5,     3.5),
+    'initial' : (20,       5,       100),
+    'N'       : (5000000,  1000000, 10000000),
+    'c'       : (0.1,      0.05,    0.2),
+    'alpha'   : (0.25,     0.15,    0.4),
+    'gamma'   : (0.1,      0.07,    0.15),
+    'delta'   : (1.0,      0.5,     2.0),
+    'epsilon' : (0.15,     0.05,    0.3),
+    'CFR1'    : (2.0/100,  1.5/100, 3.0/100),
+    'CFR0'    : (1.0/100,  0.5/100, 1.5/100),
+    'nICU'    : (300,      150,     600),
+    'pICU'    : (1.25/100, 0.8/100, 2.0/100),
+    'average' : (0.95,     0.9,     0.99),   # Average effect of an NPI on R0
+    'dt'      : (5,        2,       10),     # Average interval between NPIs
+    'start'   : (150,      100,     200)     # Start applying NPIs
+}
+
+# Factors that t028.create_NPIs needs as whole numbers of days
+
+INTEGERS = ['dt','start']
+
+# Output of one evaluation
+
+OUTPUT = np.dtype([('peak',       float),    # Peak number of infections
+                   ('ICU',        float),    # Peak number of cases needing ICU
+                   ('infections', float),    # Total number affected
+                   ('duration',   float),    # Time from start of NPIs to peak
+                   ('settled',    bool)])    # Set if population stabilized by end
+
+OUTPUTS = [name for name in OUTPUT.names if name!='settled']
+
+# get_group_size
+#
+# Number of evaluations for each base sample (saltelli) or trajectory (morris)
+
+def get_group_size(design,k):
+    return k+2 if design=='saltelli' else k+1
+
+# get_values
+#
+# Map points of the unit cube to values of the factors
+#
+# Parameters:
+#     U         Points, shape (n,k)
+#     names     Names of the k factors, one for each column of U
+#     ranges    Lower and upper bound for each factor
+#
+# Returns:
+#     Dictionary of arrays, one value for each point. Integer factors are split into
+#     equal intervals, one for each whole number in range.
+
+def get_values(U,names,ranges):
+    values = {}
+    for name,u in zip(names,U.T):
+        lower,upper = ranges[name]
+        if name in INTEGERS:
+            values[name] = np.minimum(np.floor(lower + u*(upper-lower+1)),upper)
+        else:
+            values[name] = lower + u*(upper-lower)
+    return values
+
+# create_saltelli
+#
+# Points for base samples first,...,last-1 of a Saltelli design, in groups of k+2:
+# rows of A, B, AB_1,...,AB_k
+#
+# Returns:
+#     Points in unit cube, shape ((last-first)*(k+2),k)
+
+def create_saltelli(first,last,k,entropy):
+    sobol = qmc.Sobol(d=2*k,scramble=True,rng=np.random.default_rng(np.random.SeedSequence(entropy)))
+    if first>0:
+        sobol.fast_forward(first)
+    with warnings.catch_warnings():
+        # Batches needn't be powers of 2: balance is a property of the whole design
+        warnings.simplefilter('ignore',UserWarning)
+        AB = sobol.random(last-first)
+    A,B   = AB[:,:k],AB[:,k:]
+    U     = np.repeat(A[:,None,:],k+2,axis=1)
+    U[:,1,:]   = B
+    i          = np.arange(k)
+    U[:,2+i,i] = B[:,i]
+    return U.reshape(-1,k)
+
+# create_morris
+#
+# Points for trajectories first,...,last-1 of a Morris design on a grid of levels. Each
+# trajectory has its own random number generator, seeded from the entropy for the
+# design and the index of the trajectory, so it doesn't depend on how the design is
+# split into batches.
+#
+# Returns:
+#     Points in unit cube, shape ((last-first)*(k+1),k)
+
+def create_morris(first,last,k,entropy,levels=4):
+    step = levels/(2*(levels-1))
+    U    = np.empty((last-first,k+1,k))
+    for j,trajectory in enumerate(range(first,last)):
+        rng        = np.random.default_rng(np.random.SeedSequence(entropy,spawn_key=(trajectory,)))
+        signs      = rng.choice([-1,1],size=k)
+        x0         = rng.integers(0,levels//2,size=k)/(levels-1) + np.where(signs<0,step,0)
+        order      = rng.permutation(k)
+        steps      = np.zeros((k+1,k))
+        steps[np.arange(1,k+1),order] = signs[order]*step
+        U[j]       = x0 + np.cumsum(steps,axis=0)
+    return U.reshape(-1,k)
+
+# create_design
+#
+# Points for groups first,...,last-1 of either design
+
+def create_design(first,last,settings):
+    k = len(settings['factors'])
+    if settings['design']=='saltelli':
+        return create_saltelli(first,last,k,settings['entropy'])
+    else:
+        return create_morris(first,last,k,settings['entropy'],levels=settings['levels'])
+
+# evaluate
+#
+# Integrate the model for a set of points as one ensemble, and summarize each as a record
+# of type OUTPUT
+#
+# Parameters:
+#     U          Points in unit cube, shape (n,k)
+#     settings   Factors and their ranges, values of the other parameters, and solver settings
+
+def evaluate(U,settings):
+    values   = dict(settings['fixed'])
+    values.update(get_values(U,list(settings['factors']),settings['factors']))
+    values   = {name:np.broadcast_to(np.asarray(value,dtype=float),len(U)) for name,value in values.items()}
+    rng      = t028.get_rng(settings['entropy'],0)
+    state    = rng.getstate()
+    NPIs     = []
+    for R0,average,dt,start in zip(values['R0'],values['average'],values['dt'],values['start']):
+        rng.setstate(state)
+        NPIs.append(t028.create_NPIs(R0          = R0,
+                                     start       = int(start),
+                                     lower_bound = 2*average-1,
+                                     upper_bound = 1,
+                                     dt          = 2*int(dt),
+                                     rng         = rng))
+    y,peaks,t_peaks = ensemble.evolve_ensemble(NPIs    = NPIs,
+                                               t_range = (0,settings['end']),
+                                               **{name:values[name] for name in ['R0','N','initial','c','alpha','gamma','delta',
+                                                                                 'epsilon','CFR1','CFR0','nICU','pICU']},
+                                               atol    = settings['atol'],
+                                               rtol    = settings['rtol'])
+    N                     = values['N']
+    outputs               = np.empty(len(U),dtype=OUTPUT)
+    outputs['peak']       = N*peaks
+    outputs['ICU']        = values['pICU']*N*peaks
+    outputs['infections'] = N*(1 - y[sepir.Indices.SUSCEPTIBLE.value])
+    outputs['duration']   = t_peaks - values['start']
+    outputs['settled']    = np.max(np.abs(y[[sepir.Indices.EXPOSED.value,
+                                               sepir.Indices.PRE_SYMPTOMATIC.value,
+                                               sepir.Indices.INFECTIOUS_UNTESTED.value,
+                                               sepir.Indices.INFECTIOUS_TESTED.value]]),axis=0) < settings['tolerance']
+    return outputs
+
+# evaluate_groups
+#
+# Evaluate groups first,...,last-1 of the design, integrating at most batch points at once
+
+def evaluate_groups(first,last,settings,batch=10000):
+    group = get_group_size(settings['design'],len(settings['factors']))
+    size  = max(1,batch//group)
+    return np.concatenate([evaluate(create_design(start,min(start+size,last),settings),settings)
+                           for start in range(first,last,size)])
+
+# run
+#
+# Evaluate every group of the design that has not already been saved in the checkpoint,
+# optionally sharing groups among processes, and return outputs of all evaluations
+
+def run(saved,batch=10000,workers=None):
+    settings = saved.settings
+    samples  = settings['samples']
+    group    = get_group_size(settings['design'],len(settings['factors']))
+    outputs  = list(saved.load())
+    first    = saved.completed//group
+    if first>0:
+        print (f'Resuming from {first} of {samples} groups')
+    if workers==None:
+        for start in range(first,samples,max(1,batch//group)):
+            end = min(start+max(1,batch//group),samples)
+            outputs.append(evaluate_groups(start,end,settings,batch=batch))
+            saved.append(outputs[-1])
+    else:
+        size   = max(1,min(batch//group,math.ceil((samples-first)/(4*workers))))
+        starts = range(first,samples,size)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(evaluate_groups,
+                                       starts,
+                                       [min(start+size,samples) for start in starts],
+                                       repeat(settings),
+                                       repeat(batch)):
+                outputs.append(result)
+                saved.append(result)
+    saved.flush()
+    return np.concatenate(outputs) if len(outputs)>0 else np.empty(0,dtype=OUTPUT)
+
+# get_saltelli_terms
+#
+# Terms whose means over base samples determine the Sobol indices
+#
+# Parameters:
+#     Y     Outputs for one quantity, shape (samples,k+2): f(A), f(B), f(AB_1),...
+#
+# Returns:
+#     Array, shape (samples,4+2k): f(A), f(B), f(A)^2, f(B)^2, then k terms for first
+#     order indices, and k for total
+
+def get_saltelli_terms(Y):
+    Y      = Y - Y[:,:2].mean()         # Centre, so variance isn't lost in rounding
+    fA,fB  = Y[:,0:1],Y[:,1:2]
+    fAB    = Y[:,2:]
+    return np.hstack([fA, fB, fA**2, fB**2, fB*(fAB-fA), (fA-fAB)**2])
+
+# get_sobol_indices
+#
+# First order and total indices from means of the terms from get_saltelli_terms
+#
+# Parameters:
+#     means    Means of terms, shape (...,4+2k)
+#
+# Returns:
+#     Dictionary with first and total indices, each shape (...,k)
+
+def get_sobol_indices(means):
+    k        = (means.shape[-1]-4)//2
+    variance = 0.5*(means[...,2] + means[...,3]) - (0.5*(means[...,0] + means[...,1]))**2
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return {'S1' : means[...,4:4+k]/variance[...,None],
+                'ST' : 0.5*means[...,4+k:]/variance[...,None]}
+
+# get_morris_terms
+#
+# Terms whose means over trajectories determine Morris's statistics
+#
+# Parameters:
+#     Y     Outputs for one quantity, shape (samples,k+1)
+#     U     Points of design in unit cube, shape (samples,k+1,k)
+#
+# Returns:
+#     Array, shape (samples,3k): elementary effect of each factor, its absolute value, and its square
+
+def get_morris_terms(Y,U):
+    samples,_,k = U.shape
+    steps       = np.diff(U,axis=1)
+    factors     = np.argmax(np.abs(steps),axis=2)
+    rows        = np.arange(samples)[:,None]
+    effects     = np.empty((samples,k))
+    effects[rows,factors] = np.diff(Y,axis=1) / np.take_along_axis(steps,factors[...,None],axis=2)[...,0]
+    return np.hstack([effects, np.abs(effects), effects**2])
+
+# get_morris_indices
+#
+# Mean of absolute elementary effects (mu*), mean, and standard deviation, from means
+# of the terms from get_morris_terms
+
+def get_morris_indices(means,samples):
+    k     = means.shape[-1]//3
+    mu    = means[...,:k]
+    return {'mu*'   : means[...,k:2*k],
+            'mu'    : mu,
+            'sigma' : np.sqrt(np.maximum(means[...,2*k:] - mu**2,0) * samples/max(samples-1,1))}
+
+# bootstrap
+#
+# Statistics from the means of terms, with bootstrap confidence intervals. Resampling
+# the rows is equivalent to weighting them by the number of times each is drawn, so
+# the means for a batch of resamples are a single matrix product.
+#
+# Parameters:
+#     terms        Terms for each base sample or trajectory, shape (samples,m)
+#     statistics   Function that computes a dictionary of statistics from means of terms
+#     resamples    Number of bootstrap resamples
+#     confidence   Confidence level for intervals
+#     rng          numpy random Generator (default: a new one)
+#     batch        Number of resamples computed together
+#
+# Returns:
+#     Dictionary: for each statistic, (value, lower, upper)
+
+def bootstrap(terms,statistics,resamples=1000,confidence=0.95,rng=None,batch=100):
+    rng      = np.random.default_rng() if rng is None else rng
+    samples  = len(terms)
+    estimate = statistics(terms.mean(axis=0))
+    draws    = {name:[] for name in estimate}
+    for first in range(0,resamples,batch):
+        weights = np.array([np.bincount(rng.integers(samples,size=samples),minlength=samples)
+                            for _ in range(min(batch,resamples-first))],dtype=float)
+        for name,value in statistics(weights @ terms / samples).items():
+            draws[name].append(value)
+    tail = 50*(1-confidence)
+    result = {}
+    for name,value in estimate.items():
+        lower,upper  = (np.nanpercentile(np.concatenate(draws[name]),[tail,100-tail],axis=0) if resamples>0
+                        else (np.full_like(value,np.nan),np.full_like(value,np.nan)))
+        result[name] = (value,lower,upper)
+    return result
+
+# analyze
+#
+# Compute indices for each output, with confidence intervals
+#
+# Returns:
+#     Dictionary: for each output, a dictionary of statistics, as from bootstrap
+
+def analyze(outputs,settings,resamples=1000,confidence=0.95,seed=None):
+    k       = len(settings['factors'])
+    samples = settings['samples']
+    group   = get_group_size(settings['design'],k)
+    rng     = np.random.default_rng(seed)
+    if settings['design']=='saltelli':
+        get_terms  = get_saltelli_terms
+        statistics = get_sobol_indices
+    else:
+        U          = create_design(0,samples,settings).reshape(samples,group,k)
+        get_terms  = lambda Y: get_morris_terms(Y,U)
+        statistics = lambda means: get_morris_indices(means,samples)
+    return {name:bootstrap(get_terms(outputs[name].reshape(samples,group)),statistics,
+                           resamples  = resamples,
+                           confidence = confidence,
+                           rng        = rng)
+            for name in OUTPUTS}
+
+# report
+#
+# Print table of indices for each output, and write them to a CSV file
+
+def report(indices,factors,file_name=None):
+    rows = []
+    for output,statistics in indices.items():
+        print (f'\n{output}')
+        print (f'{"Factor":10s}' + ''.join(f'{name:>30s}' for name in statistics))
+        for i,factor in enumerate(factors):
+            print (f'{factor:10s}' + ''.join(f' {value[i]:9.3g} [{lower[i]:8.3g},{upper[i]:8.3g}]'
+                                            for value,lower,upper in statistics.values()))
+            rows.append([output,factor] + [x[i] for value in statistics.values() for x in value])
+    if file_name!=None:
+        with open(file_name,'w') as out:
+            out.write(','.join(['output','factor'] + [f'{name}{suffix}' for name in next(iter(indices.values()))
+                                                      for suffix in ['','_lower','_upper']]) + '\n')
+            for row in rows:
+                out.write(','.join(str(x) for x in row) + '\n')
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser('Global sensitivity analysis of SEPIR model with NPIs')
+    parser.add_argument('--design',              default='saltelli', help='Sobol indices from Saltelli design, or Morris screening',
+                        choices=['saltelli','morris'])
+    parser.add_argument('--samples',  type=int,   default=1024,      help='Number of base samples (saltelli: a power of 2), '
+                                                                          'or trajectories (morris)')
+    parser.add_argument('--levels',   type=int,   default=4,         help='Number of levels of grid for morris (even)')
+    parser.add_argument('--factors',              default=list(FACTORS), nargs='+', choices=list(FACTORS),
+                                                                     help='Factors to vary; the others keep their values')
+    parser.add_argument('--range',                default=[],        help='Range of a factor, overriding its default', nargs=3,
+                        action='append', metavar=('FACTOR','LOWER','UPPER'))
+    parser.add_argument('--end',      type=int,   default=400,       help='Number of days to be simulated')
+    parser.add_argument('--atol',     type=float, default=1e-7,      help='Absolute tolerance for ode solver')
+    parser.add_argument('--rtol',     type=float, default=1e-7,      help='Relative tolerance for ode solver')
+    parser.add_argument('--tolerance',type=float, default=1e-6,      help='Tolerance for exposed, presymptomatic and infected at '
+                                                                          'end of run, for run to count as settled')
+    parser.add_argument('--batch',    type=int,   default=10000,     help='Number of evaluations integrated together')
+    parser.add_argument('--workers',  type=int,   default=None,      help='Number of processes')
+    parser.add_argument('--seed',     type=int,   default=None,      help='Seed for design and NPIs')
+    parser.add_argument('--out',                  default='./sensitivity', help='Directory for outputs of evaluations and indices')
+    parser.add_argument('--resume',               default=False,     help='Continue analysis saved in --out', action='store_true')
+    parser.add_argument('--checkpoint-every',type=int,default=100000,help='Number of evaluations to collect before writing to disk')
+    parser.add_argument('--resamples',type=int,   default=1000,      help='Number of bootstrap resamples for confidence intervals')
+    parser.add_argument('--confidence',type=float,default=0.95,      help='Confidence level')
+    for name,(default,lower,upper) in FACTORS.items():
+        parser.add_argument(f'--{name}', type=float, default=default, help=f'Value of {name} if not varied (default range {lower}-{upper})')
+    args = parser.parse_args()
+    if args.design=='saltelli' and args.samples & (args.samples-1)!=0:
+        parser.error('--samples must be a power of 2 for saltelli design')
+    if args.design=='morris' and (args.levels<2 or args.levels%2!=0):
+        parser.error('--levels must be even')
+
+    ranges = {name:[lower,upper] for name,(_,lower,upper) in FACTORS.items()}
+    for name,lower,upper in args.range:
+        if name not in FACTORS:
+            parser.error(f'--range: unknown factor {name}')
+        ranges[name] = [float(lower),float(upper)]
+    settings = {
+        'design'    : args.design,
+        'samples'   : args.samples,
+        'levels'    : args.levels,
+        'factors'   : {name:ranges[name] for name in args.factors},
+        'fixed'     : {name:getattr(args,name) for name in FACTORS if name not in args.factors},
+        'end'       : args.end,
+        'atol'      : args.atol,
+        'rtol'      : args.rtol,
+        'tolerance' : args.tolerance,
+        'entropy'   : np.random.SeedSequence(args.seed).entropy
+    }
+
+    start   = time.perf_counter()
+    saved   = checkpoint.Checkpoint(args.out,settings,resume=args.resume,every=args.checkpoint_every)
+    outputs = run(saved,batch=args.batch,workers=args.workers)
+    print (f'{len(outputs)} evaluations in {time.perf_counter()-start:.1f} s; '
+           f'{np.count_nonzero(~outputs["settled"])} had not settled by day {args.end}')
+    indices = analyze(outputs,saved.settings,resamples=args.resamples,confidence=args.confidence,seed=args.seed)
+    report(indices,list(saved.settings['factors']),file_name=os.path.join(args.out,'indices.csv'))
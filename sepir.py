@@ -21,8 +21,11 @@
 # Disclaimer: the program has not been discussed with these authors; it is
 # unreviewed, and in no way endorsed by them.
 
-import numpy as np,  matplotlib.pyplot as plt, os
+import numpy as np,  matplotlib.pyplot as plt, os, cache, render
 from scipy.integrate import solve_ivp
+from scipy.optimize import OptimizeResult
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from enum import Enum
 
 class Indices(Enum): 
@@ -96,11 +99,146 @@ def dy(t,y,
         gamma*(1-CFR)*I1
     ]
 
+# dy_vectorized
+#
+# Compute derivative of state vector using array operations. This is the same model
+# as dy, but y may have shape (7,), or (7,K) to evaluate K states at once, so it can be
+# used with solve_ivp(...,vectorized=True). Parameters may be scalars, or arrays of
+# shape (K,) giving one value for each column of y.
+#
+# Since CFR = CFR1 - excess/I, where excess = nICU*(CFR1-CFR0)/(N*pICU), the recovered
+# terms are computed as gamma*((1-CFR1)*I0 + excess*I0/I), which stays finite as I
+# approaches zero.
+#
+# Parameters:
+#    As for dy, plus
+#    out     Optional preallocated array, with the same shape as y, to receive the result.
+#            solve_ivp keeps references to the arrays that it is given, so only
+#            supply out if the caller owns the buffer.
+
+def dy_vectorized(t,y,
+                  N       = 5000000,  
+                  c       = 0.1, 
+                  alpha   = 0.25,   
+                  beta    = 0.2463,   
+                  gamma   = 0.1,  
+                  delta   = 1,   
+                  epsilon = 0.15, 
+                  CFR1    = 2.0/100,  
+                  CFR0    = 1.0/100,  
+                  nICU    = 300,   
+                  pICU    = 1.25/100,
+                  out     = None):
+    y      = np.asarray(y)
+    excess = nICU*(CFR1 - CFR0)/(N*pICU)
+    
+    if y.ndim==1 or y.shape[1]==1:
+        # A single state, (7,) or (7,1), as solvers supply except when estimating
+        # Jacobians: scalar arithmetic avoids the overhead of array operations on tiny arrays
+        S,E,P,I0,I1,_,_ = y.ravel().tolist()
+        I               = I0 + I1
+        infection       = beta * S * (epsilon*P + I)
+        survival        = 1-CFR1 if I>0 else 1
+        share0,share1   = (I0/I, I1/I) if I>0 else (0,0)
+        derivative      = [
+            -infection,
+            infection - alpha*E,
+            alpha*E - delta * P,
+            delta*P -(gamma + c) *I0,
+            c*I0 - gamma*I1,
+            gamma*(survival*I0 + excess*share0),
+            gamma*(survival*I1 + excess*share1)]
+        if out is None:
+            return np.array(derivative).reshape(y.shape)
+        out[...] = np.reshape(derivative,y.shape)
+        return out
+    
+    if out is None:
+        out = np.empty(y.shape)
+    S,E,P,I0,I1 = y[0],y[1],y[2],y[3],y[4]
+    I           = I0 + I1
+    positive    = I>0
+    infection   = beta * S * (epsilon*P + I)
+    survival    = np.where(positive, 1-CFR1, 1)
+    excess      = np.where(positive, excess, 0)
+    I           = np.where(positive, I, 1)
+    out[0]      = -infection
+    out[1]      = infection - alpha*E
+    out[2]      = alpha*E - delta * P
+    out[3]      = delta*P -(gamma + c) *I0
+    out[4]      = c*I0 - gamma*I1
+    out[5]      = gamma*(survival*I0 + excess*(I0/I))
+    out[6]      = gamma*(survival*I1 + excess*(I1/I))
+    return out
+
+# jacobian
+#
+# Exact Jacobian of dy (and dy_vectorized) with respect to y, for use by implicit solvers.
+# Accepts the same parameters as dy; y must have shape (7,).
+
+def jacobian(t,y,
+             N       = 5000000,  
+             c       = 0.1, 
+             alpha   = 0.25,   
+             beta    = 0.2463,   
+             gamma   = 0.1,  
+             delta   = 1,   
+             epsilon = 0.15, 
+             CFR1    = 2.0/100,  
+             CFR0    = 1.0/100,  
+             nICU    = 300,   
+             pICU    = 1.25/100 ):
+    S,E,P,I0,I1,R0,R1 = y
+    I                 = I0 + I1
+    force             = beta * (epsilon*P + I)
+    J                 = np.zeros((7,7))
+    J[0,0]            = -force
+    J[0,2]            = -beta * S * epsilon
+    J[0,3]            = -beta * S
+    J[0,4]            = -beta * S
+    J[1,0]            = force
+    J[1,1]            = -alpha
+    J[1,2]            = beta * S * epsilon
+    J[1,3]            = beta * S
+    J[1,4]            = beta * S
+    J[2,1]            = alpha
+    J[2,2]            = -delta
+    J[3,2]            = delta
+    J[3,3]            = -(gamma + c)
+    J[4,3]            = c
+    J[4,4]            = -gamma
+    if I>0:
+        # 1 - CFR = (1-CFR1) + k/I, so the recovered terms depend on the mix of I0 and I1
+        k      = nICU*(CFR1 - CFR0)/(N*pICU)
+        J[5,3] = gamma * (1 - CFR1 + k*I1/I**2)
+        J[5,4] = -gamma * k*I0/I**2
+        J[6,3] = -gamma * k*I1/I**2
+        J[6,4] = gamma * (1 - CFR1 + k*I0/I**2)
+    else:
+        J[5,3] = gamma
+        J[6,4] = gamma
+    return J
+
+# get_solver_options
+#
+# Keyword arguments for solve_ivp(dy_vectorized,...). Implicit methods are given the exact
+# Jacobian, and told that the right hand side is vectorized; explicit methods only ever
+# evaluate one state at a time, so they use the faster path for shape (7,).
+
+IMPLICIT_METHODS = ['Radau', 'BDF', 'LSODA']
+
+def get_solver_options(method='RK45'):
+    options = dict(method=method)
+    if method in IMPLICIT_METHODS:
+        options['vectorized'] = True
+        options['jac']        = jacobian
+    return options
+
 # scale
 #
 # Scale values for display
 def scale(ys,N=1):
-    return [N*y for y in ys]
+    return N*np.asarray(ys)
 
 # aggregate
 #
@@ -111,35 +249,31 @@ def scale(ys,N=1):
 #     selector
 
 def aggregate(y,selector=range(7)):
-    return [sum([y[i][j] for i in selector]) for j in range(len(y[0]))]
+    return np.sum(np.asarray(y)[list(selector)],axis=0)
 
 # plot_detail
 #
-# Plot state vector for one value of Basic Reproduction number
+# Plot state vector for one value of Basic Reproduction number (see render.render_detail)
 #
 # Parameters:
 #     t     time
 #     y     state vector
 #     N     Population size (for scaling)
 #     Rc    Basic Reproduction number (for use in title)
+#
+# The plot is saved as Rc-control_days.png, so plots from a sweep don't overwrite each other
 
 def plot_detail(t=[],y=[],N=1,Rc=1,control_days=400,R_uncontrolled=2.5,out='./'): 
-    plt.plot(t, scale(y[0],N=N),                             color='b',                 label='S (Susceptible)')
-    plt.plot(t, scale(y[1],N=N),                             color='g',                 label='E (Exposed)')
-    plt.plot(t, scale(y[2],N=N),                             color='r',                 label='P (Presymptomatic)')
-    plt.plot(t, scale(y[3],N=N),                             color='c', linestyle=':',  label='I0 (Infectious, untested')
-    plt.plot(t, scale(y[4],N=N),                             color='c', linestyle='--', label='I1 (Infectious, untested)')
-    plt.plot(t, scale(aggregate(y,selector=range(3,5)),N=N), color='c',                 label='I (Total Infectious)')
-    plt.plot(t, scale(y[5],N=N),                             color='m', linestyle=':',  label='R0 (Recovered, untested)')
-    plt.plot(t, scale(y[6],N=N),                             color='m', linestyle='--', label='R1 (Recovered, tested)')
-    plt.plot(t, scale(aggregate(y,selector=range(5,7)),N=N), color='m',                 label='R (Total Recovered)')
-    plt.plot(t, scale([1-d for d in aggregate(y)],N=N),      color='k',                 label='Deaths')
-    plt.legend(loc='best')
-    plt.xlabel('Days')
-    plt.title('Progression of COVID-19: Rc = {0:.2f} for {1} days, then {2:.2f}'.format(Rc,control_days,R_uncontrolled))
-    plt.grid()
-    plt.axvspan(0, control_days, facecolor='b', alpha=0.125)
-    plt.savefig(os.path.join(out,'{0}.png'.format(Rc)))
+    render.render_detail(**get_detail_job(t,y,N,Rc,control_days,R_uncontrolled,out))
+
+def get_detail_job(t,y,N,Rc,control_days,R_uncontrolled,out):
+    return dict(file_name      = os.path.join(out,'{0}-{1}.png'.format(Rc,control_days)),
+                t              = t,
+                y              = y,
+                N              = N,
+                Rc             = Rc,
+                control_days   = control_days,
+                R_uncontrolled = R_uncontrolled)
     
 # plot_infections
 #
@@ -148,16 +282,21 @@ def plot_detail(t=[],y=[],N=1,Rc=1,control_days=400,R_uncontrolled=2.5,out='./')
 # Parameters:
 #       infections
 #       control_days    Number of days controled (for display only)
+#       figure          Figure to draw on (default: reuse figure from render.get_figure)
 
-def plot_infections(infections,control_days=400,out='./'):
+def plot_infections(infections,control_days=400,out='./',figure=None):
+    if figure==None:
+        figure = render.get_figure((20,6))
+    ax = figure.add_subplot(111)
     for (Rc,t,y) in infections:
-        plt.plot (t,y,label='{0:.2f}'.format(Rc))
-    plt.title('Total Infections: {0} days before control lifted.'.format(control_days))
-    plt.legend(loc='best',title='Rc during control')
-    plt.xlabel('Days')
-    plt.grid() 
-    plt.axvspan(0, control_days, facecolor='b', alpha=0.125)
-    plt.savefig(os.path.join(out,'totals'))
+        keep = render.decimate(t,y)
+        ax.plot (np.asarray(t)[keep],np.asarray(y)[keep],label='{0:.2f}'.format(Rc))
+    ax.set_title('Total Infections: {0} days before control lifted.'.format(control_days))
+    ax.legend(loc='best',title='Rc during control')
+    ax.set_xlabel('Days')
+    ax.grid() 
+    ax.axvspan(0, control_days, facecolor='b', alpha=0.125)
+    figure.savefig(os.path.join(out,'totals'))
 
 # get_beta
 #
@@ -173,15 +312,149 @@ def get_beta(R0=2.5,gamma=0.1,delta=1.0,epsilon=0.15):
 def get_initial_y(initial=1,N=1000):
     return [1-initial/N, initial/N, 0, 0, 0, 0, 0]
 
+# solve
+#
+# Solve model over t_span using solve_ivp(dy_vectorized,...). If a cache.SolutionCache is
+# supplied, and the same problem has been solved before, the solution is retrieved from
+# the cache instead. If age bands are supplied, the age-structured model is solved.
+#
+# Parameters:
+#     t_span     Interval of integration
+#     y0         Initial state
+#     args       Parameters for dy_vectorized
+#     method     Integration method for solve_ivp
+#     atol       Absolute error tolerance
+#     rtol       Relative error tolerance
+#     solutions  Optional cache.SolutionCache
+#     t_eval     Times at which solution is wanted (default: points chosen by solver)
+#     ages       Optional agesepir.AgeBands
+#
+# Returns:
+#     Solution with fields t and y, as for solve_ivp
+
+def solve(t_span,y0,args=(),method='RK45',atol=1e-6,rtol=1e-3,solutions=None,t_eval=None,ages=None):
+    def compute():
+        sol = solve_ivp(dy_vectorized if ages==None else ages.dy_vectorized,
+                        t_span,y0,args=args,atol=atol,rtol=rtol,t_eval=t_eval,
+                        **(get_solver_options(method) if ages==None else ages.get_solver_options(method)))
+        return dict(t=sol.t,y=sol.y)
+    
+    return OptimizeResult(**(compute() if solutions==None else
+                             solutions.memoize(dict(model  = 'sepir',
+                                                    t_span = t_span,
+                                                    y0     = y0,
+                                                    args   = args,
+                                                    method = method,
+                                                    atol   = atol,
+                                                    rtol   = rtol,
+                                                    **({} if t_eval is None else dict(t_eval=t_eval)),
+                                                    **({} if ages==None else dict(ages=ages.get_key()))),
+                                               compute)))
+
+# solve_controlled
+#
+# Solve model with Rc for the controlled days, then with R_uncontrolled until the end
+#
+# Parameters:
+#     Rc              Basic Reproduction number during control
+#     control_days    Number of controlled days
+#     R_uncontrolled  Basic Reproduction number once control is lifted
+#     args            Command line arguments: parameters of model, end, method
+#     solutions       Optional cache.SolutionCache
+#     t_eval          Times at which solution is wanted (default: points chosen by solver)
+#     ages            Optional agesepir.AgeBands, for the age-structured model
+#
+# Returns:
+#     t, y  Times, and state at each time (shape (7,len(t))), added over age bands if any
+
+def solve_controlled(Rc,control_days,R_uncontrolled,args,solutions=None,t_eval=None,ages=None):
+    def get_args(R0):
+        return (args.N, args.c, args.alpha,
+                (get_beta if ages==None else ages.get_beta)(R0=R0,gamma=args.gamma,delta=args.delta,epsilon=args.epsilon),
+                args.gamma, args.delta, args.epsilon, args.CFR1, args.CFR0, args.nICU, args.pICU)
+    
+    sol          = solve((0,control_days),
+                         (get_initial_y if ages==None else ages.get_initial_y)(initial=args.initial,N=args.N),
+                         args      = get_args(Rc),
+                         method    = args.method,
+                         solutions = solutions,
+                         t_eval    = None if t_eval is None else t_eval[t_eval<=control_days],
+                         ages      = ages)
+    sol_extended = solve((control_days,args.end),
+                         sol.y[:,-1].tolist(),
+                         args      = get_args(R_uncontrolled),
+                         method    = args.method,
+                         solutions = solutions,
+                         t_eval    = None if t_eval is None else t_eval[t_eval>=control_days],
+                         ages      = ages)
+    y = np.concatenate((sol.y,sol_extended.y[:,1:]),axis=1)
+    return (np.concatenate((sol.t,sol_extended.t[1:])),
+            y if ages==None else ages.get_totals(y))
+
+# solve_row
+#
+# Solve model for one row of a sweep, sampled daily
+
+def solve_row(Rc,control_days,R_uncontrolled,args,ages=None):
+    _,y = solve_controlled(Rc,control_days,R_uncontrolled,args,
+                           solutions = None if args.cache==None else cache.open_cache(args.cache),
+                           t_eval    = np.arange(args.end+1),
+                           ages      = ages)
+    return y
+
+# sweep
+#
+# Solve model for every combination of Rc and control days, sharing the work among
+# several processes, and save trajectories in one .npz file. Row k has Rc[k], control[k],
+# and state y[k,:,:], sampled at times t.
+
+def sweep(file_name,args,R_uncontrolled,ages=None):
+    Rcs,controls = np.meshgrid(args.Rc,args.control,indexing='ij')
+    Rcs          = Rcs.ravel()
+    controls     = controls.ravel()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        y = np.array(list(executor.map(solve_row,
+                                       Rcs,
+                                       controls.tolist(),
+                                       repeat(R_uncontrolled),
+                                       repeat(args),
+                                       repeat(ages),
+                                       chunksize=max(1,len(Rcs)//(4*(args.workers or os.cpu_count() or 1))))))
+    np.savez(file_name,
+             Rc             = Rcs,
+             control        = controls,
+             R_uncontrolled = R_uncontrolled,
+             N              = args.N,
+             t              = np.arange(args.end+1),
+             y              = y)
+
+# render_sweep
+#
+# Plot details from a sweep file, for those rows that match selected values of Rc and control days
+
+def render_sweep(file_name,Rcs,controls,out='./',workers=None):
+    with np.load(file_name) as sweep:
+        rows = np.flatnonzero(np.isin(sweep['control'],controls) &
+                              np.any(np.isclose(sweep['Rc'][:,None],np.atleast_1d(Rcs)[None,:]),axis=1))
+        render.render_all(render.render_detail,
+                          [get_detail_job(sweep['t'],
+                                          sweep['y'][k],
+                                          int(sweep['N']),
+                                          sweep['Rc'][k],
+                                          sweep['control'][k],
+                                          float(sweep['R_uncontrolled']),
+                                          out) for k in rows],
+                          workers=workers)
+
 if __name__=='__main__':
-    import argparse
+    import argparse, sys, agesepir
     
     parser = argparse.ArgumentParser('Model COVID19 evolution')
     parser.add_argument('--Rc',      type=float, default=2.5,      help='Basic Reproduction number', nargs='+')
     parser.add_argument('--initial', type=int,   default=20,       help='Number of exposed people at start')
     parser.add_argument('--N',       type=int,   default=5000000,  help='Population size')
     parser.add_argument('--nICU',    type=int,   default=300,      help='Number of ICU beds')
-    parser.add_argument('--control', type=int,   default=400,      help='Number of controlled days to be simulated')
+    parser.add_argument('--control', type=int,   default=[400],    help='Number of controlled days to be simulated', nargs='+')
     parser.add_argument('--end',     type=int,   default=800,      help='Number of days to be simulated')
     parser.add_argument('--c',       type=float, default=0.1,      help='Testing rate for symptomatic cases, per diem')
     parser.add_argument('--alpha',   type=float, default=0.25,     help='E to P transition rate, per diem')
@@ -193,42 +466,53 @@ if __name__=='__main__':
     parser.add_argument('--pICU',    type=float, default=1.25/100, help='Proportion of cases requiring ICU')
     parser.add_argument('--show',                default=False,    help='Show plots at end of run', action='store_true')
     parser.add_argument('--out',                 default='./figs', help='Pathname for output')
+    parser.add_argument('--method',              default='RK45',   help='Integration method for solve_ivp',
+                        choices=['RK45','RK23','DOP853']+IMPLICIT_METHODS)
+    parser.add_argument('--cache',               default=None,     help='Directory for cache of solutions')
+    parser.add_argument('--sweep',               default=None,     help='Solve for every combination of Rc and control, and save '
+                                                                        'daily trajectories in this (.npz) file, without plotting')
+    parser.add_argument('--workers', type=int,   default=None,     help='Number of processes for sweep and rendering')
+    parser.add_argument('--render',              default=None,     help='Plot details from this sweep file for selected Rc and control')
+    parser.add_argument('--ages',                default=None,     help='CSV file of age bands, for age-structured model (see agesepir.load_bands)')
+    parser.add_argument('--contacts',            default=None,     help='CSV file of contact matrix for age bands (default: homogeneous mixing)')
     args = parser.parse_args()
     
-    infections = []
+    R_uncontrolled = max(args.Rc) if isinstance(args.Rc, list) else args.Rc
+    ages           = None if args.ages==None else agesepir.load_bands(args.ages,contacts=args.contacts)
+    
+    if args.sweep!=None:
+        sweep(args.sweep,args,R_uncontrolled,ages=ages)
+    
+    if args.render!=None:
+        render_sweep(args.render,args.Rc,args.control,out=args.out,workers=args.workers)
+    
+    if args.sweep!=None or args.render!=None:
+        sys.exit(0)
+    
+    if len(args.control)>1:
+        parser.error('Only --sweep accepts more than one value for --control')
+    control_days = args.control[0]
+    infections   = []
+    details      = []
+    solutions    = None if args.cache==None else cache.open_cache(args.cache)
      
     for Rc in args.Rc if isinstance(args.Rc, list) else [args.Rc]:
-        sol    = solve_ivp(dy, 
-                           (0,args.control),
-                           [1-args.initial/args.N, args.initial/args.N, 0, 0, 0, 0, 0],
-                           args=(args.N, args.c, args.alpha,
-                                 get_beta(R0=Rc,gamma=args.gamma,delta=args.delta,epsilon=args.epsilon),
-                                 args.gamma, args.delta, args.epsilon, args.CFR1, args.CFR0, args.nICU, args.pICU))
-        R_uncontrolled = max(args.Rc) if isinstance(args.Rc, list) else args.Rc
-        sol_extended  = solve_ivp(dy, 
-                           (sol.t[-1],args.end),
-                           [y[-1] for y in sol.y],
-                           args=(args.N, args.c, args.alpha,
-                                 get_beta(R0=R_uncontrolled,gamma=args.gamma,delta=args.delta,epsilon=args.epsilon),
-                                 args.gamma, args.delta, args.epsilon, args.CFR1, args.CFR0, args.nICU, args.pICU))
-        infections.append((Rc,
-                           np.concatenate((sol.t,sol_extended.t[1:])),
-                           np.concatenate((aggregate(sol.y,selector=range(3,5)),
-                                           aggregate(sol_extended.y,selector=range(3,5))[1:]))
-                           ))
- 
-        plt.figure(figsize=(20,6))
-        plot_detail(t=np.concatenate((sol.t,sol_extended.t[1:])),
-                    y=[np.concatenate((sol.y[i],sol_extended.y[i][1:])) for i in range(len(sol.y))],
-                    N=args.N,
-                    Rc=Rc,
-                    control_days=args.control,
-                    R_uncontrolled=R_uncontrolled,
-                    out=args.out)        
+        t,y = solve_controlled(Rc,control_days,R_uncontrolled,args,solutions=solutions,ages=ages)
+        infections.append((Rc, t, aggregate(y,selector=range(3,5))))
+        details.append(get_detail_job(t,y,args.N,Rc,control_days,R_uncontrolled,args.out))
+    
+    if args.show:
+        # Draw on pyplot figures, so they can be shown as well as saved
+        for job in details:
+            render.render_detail(**job,figure=plt.figure(figsize=(20,6)))
+    else:
+        render.render_all(render.render_detail,details,workers=args.workers)
     
     if isinstance(args.Rc, list):
-        plt.figure(figsize=(20,6))
-        plot_infections(infections,control_days=args.control,out=args.out)
+        plot_infections(infections,
+                        control_days = control_days,
+                        out          = args.out,
+                        figure       = plt.figure(figsize=(20,6)) if args.show else None)
     
     if args.show:
-        plt.show()
\ No newline at end of file
+        plt.show()
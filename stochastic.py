@@ -0,0 +1,361 @@
+# stochastic.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Stochastic version of the SEPIR model (see sepir.py), for small populations and the
+# early stages of an outbreak, where chance matters: an outbreak that starts with a few
+# exposed people may die out, or take off later than the deterministic model predicts.
+#
+# The state is the number of people in each of the seven compartments of sepir.Indices,
+# for each of M replicates, as a (7,M) array of integers. The replicates are advanced
+# together, each with its own clock:
+#
+#     While few people are exposed, presymptomatic or infectious, a replicate is simulated
+#     exactly, one transition at a time (Gillespie's direct method), since this is when
+#     the outbreak may die out, and the outcome depends on the timing of individual events.
+#
+#     Otherwise it is advanced by tau-leaping: in a leap of length tau, the number of people
+#     leaving each compartment is drawn from a binomial distribution, with probability
+#     rate*tau, so no compartment can become negative, and the expected change is tau times
+#     the derivative from sepir.dy. People leaving I0 are shared binomially between testing
+#     and removal, and removed people between recovery and death, with probability CFR.
+#     Each replicate has its own leap size, chosen so that the expected change in each
+#     compartment is small compared with its size (Cao, Gillespie & Petzold, Efficient step
+#     size selection for the tau-leaping simulation method, J Chem Phys 124, 2006).
+#
+# Replicates whose outbreak has died out, or which have reached the end of the simulation,
+# are dropped, so that effort goes to those still running.
+#
+# The case fatality rate is that of sepir.dy, CFR1 - (nICU/(I*pICU))*(CFR1-CFR0), where I
+# is the number infectious, but only while more cases need ICU than there are beds, as in
+# metapop.get_CFR; otherwise it is CFR0. dy's expression would fall below CFR0 (and may
+# become negative, or undefined when no one is infectious), which cannot be used as a
+# probability.
+#
+# Only a summary of each replicate is recorded (record type SUMMARY).
+
+import argparse, numpy as np, sepir
+from accumulator import Accumulator
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+S,E,P,I0,I1 = [index.value for index in sepir.Indices][:5]
+RECOVERED0  = sepir.Indices.RECOVERED_UNTESTED.value    # Not R0, which is the reproduction number
+RECOVERED1  = sepir.Indices.RECOVERED_TESTED.value
+
+# Change to state caused by each transition: infection, incubation, onset of symptoms,
+# testing, removal from I0, and removal from I1. Recovery is added separately.
+
+CHANGES = np.zeros((6,7),dtype=np.int64)
+for transition,(source,target) in enumerate([(S,E),(E,P),(P,I0),(I0,I1),(I0,None),(I1,None)]):
+    CHANGES[transition,source] = -1
+    if target!=None:
+        CHANGES[transition,target] = +1
+
+SUMMARY = np.dtype([('extinct',    bool),     # Set if no one remained exposed, presymptomatic or infectious
+                    ('t_end',      float),    # Time at which replicate ended: extinction, or end of simulation
+                    ('t_trigger',  float),    # Time at which infectious first reached trigger (nan if never)
+                    ('peak',       np.int64), # Peak number infectious (I0+I1)
+                    ('t_peak',     float),    # Time of peak
+                    ('infections', np.int64), # Number who left S
+                    ('deaths',     np.int64), # Number who died
+                    ('events',     np.int64), # Number of transitions simulated exactly
+                    ('leaps',      np.int64)])# Number of leaps
+
+# get_parameter
+#
+# Broadcast a parameter, which may be a scalar or have one value for each replicate,
+# to an array of shape (M,)
+
+def get_parameter(value,M):
+    return np.broadcast_to(np.asarray(value,dtype=float),(M,)).copy()
+
+# get_CFR
+#
+# Case fatality rate, as for sepir.dy where demand for ICU exceeds beds, otherwise CFR0
+
+def get_CFR(infectious,CFR1,CFR0,nICU,pICU):
+    overflow = infectious*pICU > nICU
+    return np.where(overflow,
+                    CFR1 - (nICU/(np.where(overflow,infectious,1)*pICU)) * (CFR1 - CFR0),
+                    CFR0)
+
+# select_tau
+#
+# Choose size of leap for each replicate (Cao, Gillespie & Petzold), so that the expected
+# change in each of S, E, P, I0 and I1 is at most tolerance times its size (or 1, if that
+# is larger). S, P, I0 and I1 take part in infection, which is of second order, so their
+# changes are held to half the tolerance. Cao et al also bound the variance of the change;
+# this is not needed here, since small counts are simulated exactly, and binomial draws
+# cannot make a compartment negative.
+#
+# Parameters:
+#     x            Counts, shape (7,K)
+#     propensities Rates of transitions, shape (6,K), in the order of CHANGES
+#     tolerance    Largest relative change expected in any compartment
+
+def select_tau(x,propensities,tolerance):
+    infection,incubation,onset,testing,removal0,removal1 = propensities
+    mu    = np.stack([-infection,
+                      infection - incubation,
+                      incubation - onset,
+                      onset - testing - removal0,
+                      testing - removal1])
+    order = np.array([2,1,2,2,2])[:,None]
+    bound = np.maximum(tolerance * x[:I1+1] / order, 1)
+    with np.errstate(divide='ignore'):
+        return np.min(bound/np.abs(mu),axis=0)
+
+# evolve_stochastic
+#
+# Simulate M replicates of the outbreak. Parameters may be scalars, or arrays with one
+# value for each replicate.
+#
+# Returns:
+#     summaries  One record of type SUMMARY for each replicate
+#     y          Final state of each replicate, shape (7,M)
+
+def evolve_stochastic(M         = 1000,
+                      R0        = 2.5,      # Basic Reproduction number
+                      t_range   = (0,400),  # Range of times (days)
+                      N         = 5000000,  # Population size
+                      initial   = 20,       # Initial number exposed
+                      c         = 0.1,      # Testing rate for symptomatic cases, per diem
+                      alpha     = 0.25,     # E to P transition rate, per diem
+                      gamma     = 0.1,      # I to R transition, per diem
+                      delta     = 1,        # P to I, per diem
+                      epsilon   = 0.15,     # relative infectiousness
+                      CFR1      = 2.0/100,  # case fatality rate for cases exceedinging ICU max
+                      CFR0      = 1.0/100,  # case fatality rate for cases under ICU max
+                      nICU      = 300,      # number of ICU beds
+                      pICU      = 1.25/100, # proportion of cases requiring ICU
+                      trigger   = None,     # Record time at which number infectious first reaches this
+                      tolerance = 0.03,     # Relative change allowed in any compartment in one leap
+                      max_tau   = 1.0,      # Longest leap (days)
+                      critical  = 100,      # Simulate exactly while fewer than this are in E, P, I0 and I1
+                      rng       = None):    # numpy.random.Generator
+    if rng==None:
+        rng = np.random.default_rng()
+    t0,t_end       = t_range
+    N              = get_parameter(N,M)
+    c              = get_parameter(c,M)
+    alpha          = get_parameter(alpha,M)
+    gamma          = get_parameter(gamma,M)
+    delta          = get_parameter(delta,M)
+    epsilon        = get_parameter(epsilon,M)
+    CFR1           = get_parameter(CFR1,M)
+    CFR0           = get_parameter(CFR0,M)
+    nICU           = get_parameter(nICU,M)
+    pICU           = get_parameter(pICU,M)
+    beta           = sepir.get_beta(R0=get_parameter(R0,M),gamma=gamma,delta=delta,epsilon=epsilon)
+    parameters     = [N,c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,nICU,pICU]
+
+    x              = np.zeros((7,M),dtype=np.int64)
+    x[E]           = np.broadcast_to(initial,(M,))
+    x[S]           = N.astype(np.int64) - x[E]
+    t              = np.full(M,float(t0))
+    peak           = x[I0] + x[I1]
+    t_peak         = t.copy()
+    t_trigger      = np.full(M,np.nan)
+    events         = np.zeros(M,dtype=np.int64)
+    leaps          = np.zeros(M,dtype=np.int64)
+    ids            = np.arange(M)       # Replicate held in each column
+
+    summaries      = np.zeros(M,dtype=SUMMARY)
+    y              = np.zeros((7,M),dtype=np.int64)
+
+    def finish(done):
+        finished                            = ids[done]
+        summaries['extinct'][finished]      = x[E:I1+1,done].sum(axis=0)==0
+        summaries['t_end'][finished]        = t[done]
+        summaries['t_trigger'][finished]    = t_trigger[done]
+        summaries['peak'][finished]         = peak[done]
+        summaries['t_peak'][finished]       = t_peak[done]
+        summaries['infections'][finished]   = N[done].astype(np.int64) - x[S,done]
+        summaries['deaths'][finished]       = N[done].astype(np.int64) - x[:,done].sum(axis=0)
+        summaries['events'][finished]       = events[done]
+        summaries['leaps'][finished]        = leaps[done]
+        y[:,finished]                       = x[:,done]
+
+    running = np.ones(M,dtype=bool)
+    while len(ids)>0:
+        N,c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,nICU,pICU = parameters
+        infectious   = x[I0] + x[I1]
+        force        = beta * (epsilon*x[P] + infectious) / N
+        propensities = np.stack([force * x[S],
+                                 alpha * x[E],
+                                 delta * x[P],
+                                 c * x[I0],
+                                 gamma * x[I0],
+                                 gamma * x[I1]])
+        CFR          = get_CFR(infectious,CFR1,CFR0,nICU,pICU)
+        exact        = running & (x[E:I1+1].sum(axis=0)<critical)
+        tau          = np.minimum(select_tau(x,propensities,tolerance),np.minimum(max_tau,t_end-t))
+        tau[~running | exact] = 0
+
+        # Leap
+
+        exposed        = rng.binomial(x[S],  np.minimum(force*tau,1))
+        presymptomatic = rng.binomial(x[E],  np.minimum(alpha*tau,1))
+        symptomatic    = rng.binomial(x[P],  np.minimum(delta*tau,1))
+        leaving0       = rng.binomial(x[I0], np.minimum((c+gamma)*tau,1))
+        tested         = rng.binomial(leaving0, c/(c+gamma))
+        leaving1       = rng.binomial(x[I1], np.minimum(gamma*tau,1))
+        recovered0     = rng.binomial(leaving0-tested, 1-CFR)
+        recovered1     = rng.binomial(leaving1, 1-CFR)
+
+        x[S]          -= exposed
+        x[E]          += exposed - presymptomatic
+        x[P]          += presymptomatic - symptomatic
+        x[I0]         += symptomatic - leaving0
+        x[I1]         += tested - leaving1
+        x[RECOVERED0] += recovered0
+        x[RECOVERED1] += recovered1
+        t             += tau
+        leaps         += tau>0
+
+        # Exact simulation of one transition: choose time to next, and which it is.
+        # If the next would come after the end, the replicate just ends.
+
+        exact = np.flatnonzero(exact)
+        if len(exact)>0:
+            rates      = np.cumsum(propensities[:,exact],axis=0)
+            t_next     = t[exact] + rng.exponential(size=len(exact)) / rates[-1]
+            late       = t_next>t_end
+            t[exact]   = np.minimum(t_next,t_end)
+            exact      = exact[~late]
+            rates      = rates[:,~late]
+            transition = np.argmax(rates > rng.random(len(exact))*rates[-1],axis=0)
+            recovered  = rng.random(len(exact)) >= CFR[exact]
+            x[:,exact]          += CHANGES[transition].T
+            x[RECOVERED0,exact] += (transition==4) & recovered
+            x[RECOVERED1,exact] += (transition==5) & recovered
+            events[exact]       += 1
+
+        infectious     = x[I0] + x[I1]
+        higher         = infectious>peak
+        peak[higher]   = infectious[higher]
+        t_peak[higher] = t[higher]
+        if trigger!=None:
+            reached            = np.isnan(t_trigger) & (infectious>=trigger)
+            t_trigger[reached] = t[reached]
+
+        done    = running & ((t>=t_end) | (x[E:I1+1].sum(axis=0)==0))
+        if done.any():
+            finish(done)
+            running &= ~done
+            # Drop finished replicates once they are a quarter of those held
+            if 4*(len(running)-running.sum())>=len(running):
+                x          = x[:,running]
+                t          = t[running]
+                peak       = peak[running]
+                t_peak     = t_peak[running]
+                t_trigger  = t_trigger[running]
+                events     = events[running]
+                leaps      = leaps[running]
+                ids        = ids[running]
+                parameters = [parameter[running] for parameter in parameters]
+                running    = running[running]
+
+    return summaries,y
+
+# simulate_chunk
+#
+# Simulate replicates first,first+1,...,last-1, with a random number generator seeded from
+# the entropy for the whole simulation and the index of the first, so results do not depend
+# on the number of processes.
+
+def simulate_chunk(first,last,args,entropy):
+    summaries,_ = evolve_stochastic(M         = last-first,
+                                    R0        = args.R0,
+                                    t_range   = (0,args.end),
+                                    N         = args.N,
+                                    initial   = args.initial,
+                                    c         = args.c,
+                                    alpha     = args.alpha,
+                                    gamma     = args.gamma,
+                                    delta     = args.delta,
+                                    epsilon   = args.epsilon,
+                                    CFR1      = args.CFR1,
+                                    CFR0      = args.CFR0,
+                                    nICU      = args.nICU,
+                                    pICU      = args.pICU,
+                                    trigger   = args.trigger,
+                                    tolerance = args.tolerance,
+                                    max_tau   = args.max_tau,
+                                    critical  = args.critical,
+                                    rng       = np.random.default_rng(np.random.SeedSequence(entropy,spawn_key=(first,))))
+    return summaries
+
+# simulate
+#
+# Simulate args.M replicates in chunks, optionally sharing the chunks among several processes
+
+def simulate(args):
+    entropy = np.random.SeedSequence(args.seed).entropy
+    firsts  = range(0,args.M,args.chunk)
+    lasts   = [min(first+args.chunk,args.M) for first in firsts]
+    if args.workers==None:
+        return np.concatenate([simulate_chunk(first,last,args,entropy) for first,last in zip(firsts,lasts)])
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        return np.concatenate(list(executor.map(simulate_chunk,firsts,lasts,repeat(args),repeat(entropy))))
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser('Stochastic SEPIR model: simulate replicates of an outbreak')
+    parser.add_argument('--M',         type=int,   default=1000,       help='Number of replicates')
+    parser.add_argument('--R0',        type=float, default=2.5,        help='Basic Reproduction number')
+    parser.add_argument('--initial',   type=int,   default=20,         help='Number of exposed people at start of simulation')
+    parser.add_argument('--N',         type=int,   default=5000000,    help='Population size')
+    parser.add_argument('--nICU',      type=int,   default=300,        help='Number of ICU beds')
+    parser.add_argument('--end',       type=int,   default=400,        help='Number of days to be simulated')
+    parser.add_argument('--c',         type=float, default=0.1,        help='Testing rate for symptomatic cases, per diem')
+    parser.add_argument('--alpha',     type=float, default=0.25,       help='E to P transition rate, per diem')
+    parser.add_argument('--gamma',     type=float, default=0.1,        help='I to R tranition, per diem')
+    parser.add_argument('--delta',     type=float, default=1.0,        help='P to I, per diem')
+    parser.add_argument('--epsilon',   type=float, default=0.15,       help='Relative infectiousness')
+    parser.add_argument('--CFR1',      type=float, default=2.0/100,    help='Case Fatality Rate for cases exceeding ICU max')
+    parser.add_argument('--CFR0',      type=float, default=1.0/100,    help='Case Fatality Rate for cases under ICU max')
+    parser.add_argument('--pICU',      type=float, default=1.25/100,   help='Proportion of cases requiring ICU')
+    parser.add_argument('--trigger',   type=int,   default=None,       help='Record time at which number of infections reaches this value')
+    parser.add_argument('--tolerance', type=float, default=0.03,       help='Relative change allowed in any compartment in one leap')
+    parser.add_argument('--max-tau',   type=float, default=1.0,        help='Longest leap (days)')
+    parser.add_argument('--critical',  type=int,   default=100,        help='Simulate transitions one at a time while fewer than this '
+                                                                           'are exposed, presymptomatic or infectious')
+    parser.add_argument('--minor',     type=float, default=0.01,       help='Outbreaks that infect less than this proportion of the '
+                                                                           'population are counted as minor')
+    parser.add_argument('--seed',      type=int,   default=None,       help='Seed for random number generator')
+    parser.add_argument('--chunk',     type=int,   default=10000,      help='Number of replicates simulated together')
+    parser.add_argument('--workers',   type=int,   default=None,       help='Share chunks among this many processes')
+    parser.add_argument('--out',                   default=None,       help='Save summary of each replicate to this file (npy)')
+    args = parser.parse_args()
+
+    summaries = simulate(args)
+    if args.out!=None:
+        np.save(args.out,summaries)
+
+    minor = summaries['extinct'] & (summaries['infections']<args.minor*args.N)
+    print (f'Minor outbreaks: {minor.sum()} of {len(summaries)} ({minor.mean():.3f})')
+    print (f'Ended by day {args.end}: {summaries["extinct"].sum()}')
+    for name,values in [('Time to peak',    summaries['t_peak'][~minor]),
+                        ('Peak infections', summaries['peak'][~minor]),
+                        ('Infections',      summaries['infections'][~minor]),
+                        ('Deaths',          summaries['deaths'][~minor]),
+                        ('Time to trigger', summaries['t_trigger'][~np.isnan(summaries['t_trigger'])]),
+                        ('Events',          summaries['events']),
+                        ('Leaps',           summaries['leaps'])]:
+        statistics = Accumulator()
+        statistics.extend(values)
+        print (f'{name+":":17s}{statistics}')
@@ -18,22 +18,26 @@
 # This program was written to replicate Transmission T-028: Sidney Redner on exponential growth processes,
 # https://santafe.edu/news-center/news/transmission-t-028-sidney-redner-exponential-growth-processes
 
-import sepir, matplotlib.pyplot as plt, random, numpy as np, argparse, os, math
+import sepir, agesepir, ensemble, accumulator, checkpoint, cache, render, instrument, matplotlib.pyplot as plt, random, numpy as np, argparse, os, math, scipy.integrate, scipy.optimize
 from scipy.integrate import solve_ivp
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, lru_cache
+from itertools import repeat
 
 # create_NPIs
 #
 # Create a list of random reductions in R0, to be applied over a random set of (near) dates,
-# which have the cumulative effect of reducing R0 below 1.
+# which have the cumulative effect of reducing R0 below 1. Random numbers are drawn from rng,
+# which may be the random module or a random.Random.
 
-def create_NPIs(start=150, R0=2.5, lower_bound=0.9, upper_bound=1.0, dt=5):
+def create_NPIs(start=150, R0=2.5, lower_bound=0.9, upper_bound=1.0, dt=5, rng=random):
      NPIs = []
      t = start
      while R0>=1.0:
-          factor = random.uniform(lower_bound,upper_bound)
+          factor = rng.uniform(lower_bound,upper_bound)
           NPIs.append((t,factor))
           R0 *= factor
-          t += random.randint(1,dt)
+          t += rng.randint(1,dt)
      return NPIs
 
 # find_start
@@ -54,27 +58,60 @@ def find_start(t0,t1,y,
            pICU    = 1.25/100, # proportion of cases requiring ICU
            trigger = None,
            atol    = 1e-7,
-           rtol    = 1e-7):    # Maximum absolute error tolerance for ODE solver
+           rtol    = 1e-7,     # Maximum absolute error tolerance for ODE solver
+           method  = 'RK45',   # Integration method for solve_ivp
+           solutions = None,   # Optional cache.SolutionCache, for result of an earlier call
+           ages    = None):    # Optional agesepir.AgeBands, for age-structured model
+     model = sepir if ages==None else ages
+     
      # triggered
      #
      # This event occurs when the specified number of events is first observed.
      
      def triggered(t,y,*rest):
-          return N*(y[sepir.Indices.INFECTIOUS_TESTED.value]+y[sepir.Indices.INFECTIOUS_UNTESTED.value])-trigger
+          totals = y if ages==None else ages.get_totals(y)
+          return N*(totals[sepir.Indices.INFECTIOUS_TESTED.value]+totals[sepir.Indices.INFECTIOUS_UNTESTED.value])-trigger
      triggered.terminal = True
      triggered.direction = +1
      
-     sol=solve_ivp(sepir.dy, 
-                   (t0,t1),
-                   y,
-                   args=(N, c, alpha,
-                         sepir.get_beta(R0=R0,gamma=gamma,delta=delta,epsilon=epsilon),
-                         gamma, delta, epsilon, CFR1, CFR0, nICU, pICU),
-                   events=None if trigger == None else triggered,
-                   atol=atol,
-                   rtol=rtol)
- 
-     return math.ceil(sol.t_events[0])
+     def compute():
+          sol=solve_ivp(model.dy_vectorized, 
+                        (t0,t1),
+                        y,
+                        args=(N, c, alpha,
+                              model.get_beta(R0=R0,gamma=gamma,delta=delta,epsilon=epsilon),
+                              gamma, delta, epsilon, CFR1, CFR0, nICU, pICU),
+                        events=None if trigger == None else triggered,
+                        atol=atol,
+                        rtol=rtol,
+                        **model.get_solver_options(method))
+          if instrument.enabled:
+               instrument.count_solution(sol,method)
+          return dict(t_events=sol.t_events[0])
+     
+     with instrument.timer('find_start'):
+          t_events = compute() if solutions==None else \
+                     solutions.memoize(dict(model   = 'find_start',
+                                            t_span  = (t0,t1),
+                                            y       = y,
+                                            R0      = R0,
+                                            N       = N,
+                                            c       = c,
+                                            alpha   = alpha,
+                                            gamma   = gamma,
+                                            delta   = delta,
+                                            epsilon = epsilon,
+                                            CFR1    = CFR1,
+                                            CFR0    = CFR0,
+                                            nICU    = nICU,
+                                            pICU    = pICU,
+                                            trigger = trigger,
+                                            atol    = atol,
+                                            rtol    = rtol,
+                                            method  = method,
+                                            **({} if ages==None else dict(ages=ages.get_key()))),
+                                       compute)
+     return math.ceil(t_events['t_events'][0])
 
 # evolve
 #
@@ -94,21 +131,58 @@ def evolve(t0,t1,y,
            pICU    = 1.25/100, # proportion of cases requiring ICU
            trigger = None,
            atol    = 1e-7,
-           rtol    = 1e-7):    # Maximum absolute error tolerance for ODE solver
+           rtol    = 1e-7,     # Maximum absolute error tolerance for ODE solver
+           method  = 'RK45',   # Integration method for solve_ivp
+           dense_output = False,
+           ages    = None):    # Optional agesepir.AgeBands, for age-structured model
+     model = sepir if ages==None else ages
+     with instrument.timer('evolve'):
+          sol = solve_ivp(model.dy_vectorized, 
+                          (t0,t1),
+                          y,
+                          args=(N, c, alpha,
+                                model.get_beta(R0=R0,gamma=gamma,delta=delta,epsilon=epsilon),
+                                gamma, delta, epsilon, CFR1, CFR0, nICU, pICU),
+                          atol=atol,
+                          rtol=rtol,
+                          dense_output=dense_output,
+                          **model.get_solver_options(method))
+     if instrument.enabled:
+          instrument.count_solution(sol,method,dense_output=dense_output)
+     return sol
 
-     return solve_ivp(sepir.dy, 
-                     (t0,t1),
-                     y,
-                     args=(N, c, alpha,
-                           sepir.get_beta(R0=R0,gamma=gamma,delta=delta,epsilon=epsilon),
-                           gamma, delta, epsilon, CFR1, CFR0, nICU, pICU),
-                     atol=atol,
-                     rtol=rtol)
 
+# create_schedule
+#
+# Convert a list of NPIs to a schedule for R0, [(t0,R0),(t1,R0*f1),(t2,R0*f1*f2),...],
+# starting at the beginning of t_range
+
+def create_schedule(R0=2.5, t_range=(0,400), NPIs=[]):
+     schedule = [(t_range[0],R0)]
+     for t,factor in NPIs:
+          R0 *= factor
+          schedule.append((t,R0))
+     return schedule
 
 # evolveR0
 #
-# Evolve the state forward for a fixed time interval varying R0 by applying a series of NPIs 
+# Evolve the state forward for a fixed time interval varying R0 by applying a series of NPIs.
+# R0 follows the schedule from create_schedule. Each NPI ends a step, and a new solver
+# carries on from there with the new R0; for Runge-Kutta methods, it starts with the
+# step size that the last solver had reached, rather than estimating one again.
+# The solution up to the first NPI is the same for every run with the same parameters.
+# If prefix is supplied, each run starts from it, interpolated at its own first NPI;
+# otherwise, if a cache is supplied, the solution is computed once and then retrieved 
+# from the cache. A new solver is started at every NPI, so the result is the same
+# whether the cache is used or not (but not with prefix, which is interpolated).
+# If ages is supplied, the age-structured model is used, and the state has one column
+# for each band (see agesepir.py).
+#
+# Returns:
+#     sol     Solution, with fields as for solve_ivp: t, y, nfev, njev, nlu, status, message, success;
+#             and nsteps and nrejected, the numbers of steps accepted and rejected by the solver
+#             after the first NPI (nrejected is None unless method is Runge-Kutta)
+#     R0s     Value of R0 following each NPI, starting with initial value
 def evolveR0(R0      = 2.5,      # Initial value of Basic Reproduction number
               t_range = (0,400),  # Range of times (days)
               NPIs    = [],       # List od reductions to apply to R0 [(t1,f1),(t2,f2),...]
@@ -125,71 +199,142 @@ def evolveR0(R0      = 2.5,      # Initial value of Basic Reproduction number
               nICU    = 300,      # number of ICU beds
               pICU    = 1.25/100, # proportion of cases requiring ICU7
               rtol    = 1e-7,
-              atol    = 1e-7):    # Maximum absolute error tolerance for ODE solver 
-     
-     # First evolve solution until it is time to apply the first NPI
-     t0 = t_range[0]
-     t1 = NPIs[0][0]
-     sols = [evolve(t0,t1,
-                    sepir.get_initial_y(initial=initial,N=N),
-                    R0      = R0,
-                    N       = N, 
-                    c       = c, 
-                    alpha   = alpha,   
-                    gamma   = gamma,  
-                    delta   = delta,   
-                    epsilon = epsilon, 
-                    CFR1    = CFR1,  
-                    CFR0    = CFR0,  
-                    nICU    = nICU,   
-                    pICU    = pICU,
-                    atol    = atol,
-                    rtol    = rtol)]
-     # Now process each NPI in turn
-     R0s  = [R0]
-     for i in range(len(NPIs)-1):
-          t0 = t1
-          t1 = NPIs[i+1][0]
-          R0*= NPIs[i][1]
-          sols.append(evolve(t0,t1,
-                             [y[-1] for y in sols[-1].y],
-                             R0      = R0,
-                             N       = N, 
-                             c       = c, 
-                             alpha   = alpha,   
-                             gamma   = gamma,  
-                             delta   = delta,   
-                             epsilon = epsilon, 
-                             CFR1    = CFR1,  
-                             CFR0    = CFR0,  
-                             nICU    = nICU,   
-                             pICU    = pICU,
-                             atol    = atol,
-                             rtol    = rtol))
-          R0s.append(R0)
+              atol    = 1e-7,     # Maximum absolute error tolerance for ODE solver 
+              method  = 'RK45',   # Integration method for solve_ivp
+              solutions = None,   # Optional cache.SolutionCache for solution up to first NPI
+              prefix  = None,     # Optional solution up to first NPI, from evolve(...,dense_output=True)
+              ages    = None):    # Optional agesepir.AgeBands, for age-structured model
+     
+     model    = sepir if ages==None else ages
+     schedule = create_schedule(R0=R0,t_range=t_range,NPIs=NPIs)
+     t0,t1    = t_range
+     
+     # Apply any NPIs from before the start; later ones end the steps of the solver
+     
+     R0_start = [R0_t for t,R0_t in schedule if t<=t0][-1] 
+     stops    = [(t,R0_t) for t,R0_t in schedule if t0<t<t1] + [(t1,None)]
+     beta     = model.get_beta(R0=R0_start,gamma=gamma,delta=delta,epsilon=epsilon)
+     
+     def fun(t,y):
+          return model.dy_vectorized(t,y,N,c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,nICU,pICU)
+     
+     def jac(t,y):
+          return model.jacobian(t,y,N,c,alpha,beta,gamma,delta,epsilon,CFR1,CFR0,nICU,pICU)
+     
+     def create_solver(t,y,t_bound,first_step=None):
+          options = model.get_solver_options(method)
+          Solver  = getattr(scipy.integrate,options.pop('method'))
+          if 'jac' in options:
+               options['jac'] = jac
+          if first_step!=None and method not in sepir.IMPLICIT_METHODS:
+               # Implicit methods restart at first order, so they choose their own first step
+               options['first_step'] = min(first_step,t_bound-t)
+          return Solver(fun,t,y,t_bound,atol=atol,rtol=rtol,**options)
+     
+     solver  = create_solver(t0,model.get_initial_y(initial=initial,N=N),stops[0][0])
+     ts      = [solver.t]
+     ys      = [solver.y.copy()]
+     nfev    = njev = nlu = 0
+     message = 'The solver successfully reached the end of the integration interval.'
+     status  = 0
+     first   = 0
+     nsteps    = 0      # Steps accepted since start (or first NPI), and evaluations they used
+     step_nfev = 0
+     h         = None   # Size of last step that wasn't cut short by an NPI
+     
+     if prefix!=None and len(stops)>1:
+          t_first = stops[0][0]
+          if t_first>prefix.t[-1]:
+               raise ValueError(f'First NPI at {t_first} is after end of prefix {prefix.t[-1]}')
+          before        = prefix.t<t_first
+          ts            = list(prefix.t[before]) + [t_first]
+          ys            = list(prefix.y[:,before].T) + [prefix.sol(t_first)]
+          beta          = model.get_beta(R0=stops[0][1],gamma=gamma,delta=delta,epsilon=epsilon)
+          solver        = create_solver(t_first,ys[-1],stops[1][0])
+          first         = 1
+          
+     elif solutions!=None and len(stops)>1:
+          # Every run with these parameters has the same solution up to the first NPI,
+          # so it is taken from the cache if possible, and a new solver starts at the first NPI
+          # with the step size that it would have had without the cache
           
-     # Now we are at the end of NPEs, keep going with final R0     
-     t0 = t1
-     t1 = t_range[1]
-     R0*= NPIs[len(NPIs)-1][1]
-     sols.append(evolve(t0,t1,
-                        [y[-1] for y in sols[-1].y],
-                        R0      = R0,
-                        N       = N, 
-                        c       = c, 
-                        alpha   = alpha,   
-                        gamma   = gamma,  
-                        delta   = delta,   
-                        epsilon = epsilon, 
-                        CFR1    = CFR1,  
-                        CFR0    = CFR0,  
-                        nICU    = nICU,   
-                        pICU    = pICU,
-                        atol    = atol,
-                        rtol    = rtol))
-     R0s.append(R0)
-
-     return sols,R0s
+          def compute():
+               step_size = np.nan
+               while solver.status=='running':
+                    failure = solver.step()
+                    if solver.status=='failed':
+                         raise RuntimeError(f'Solver failed before first NPI: {failure}')
+                    ts.append(solver.t)
+                    ys.append(solver.y.copy())
+                    if solver.status=='running':
+                         step_size = solver.step_size
+               return dict(t=np.array(ts),y=np.array(ys).T,h=step_size)
+          
+          prefix = solutions.memoize(dict(model   = 'evolveR0',
+                                          t_span  = (t0,stops[0][0]),
+                                          R0      = R0_start,
+                                          N       = N,
+                                          initial = initial,
+                                          c       = c,
+                                          alpha   = alpha,
+                                          gamma   = gamma,
+                                          delta   = delta,
+                                          epsilon = epsilon,
+                                          CFR1    = CFR1,
+                                          CFR0    = CFR0,
+                                          nICU    = nICU,
+                                          pICU    = pICU,
+                                          atol    = atol,
+                                          rtol    = rtol,
+                                          method  = method,
+                                          **({} if ages==None else dict(ages=ages.get_key()))),
+                                     compute)
+          ts            = list(prefix['t'])
+          ys            = list(prefix['y'].T)
+          h             = float(prefix.get('h',np.nan))
+          h             = None if np.isnan(h) else h
+          beta          = model.get_beta(R0=stops[0][1],gamma=gamma,delta=delta,epsilon=epsilon)
+          nfev,njev,nlu = solver.nfev, solver.njev, solver.nlu
+          solver        = create_solver(ts[-1],np.array(ys[-1]),stops[1][0],first_step=h)
+          first         = 1
+          
+     for i,(t_stop,R0_stop) in enumerate(stops[first:],first):
+          while solver.status=='running':
+               evaluations = solver.nfev
+               failure     = solver.step()
+               step_nfev  += solver.nfev - evaluations
+               if solver.status!='failed':
+                    ts.append(solver.t)
+                    ys.append(solver.y.copy())
+                    nsteps += 1
+               if solver.status=='running':
+                    h = solver.step_size
+          if solver.status=='failed':
+               message = failure
+               status  = -1
+               break
+          if R0_stop==None: break
+          
+          # R0 has changed, so carry on to next stop with new beta, from the step size
+          # that the last solver had reached
+          beta          = model.get_beta(R0=R0_stop,gamma=gamma,delta=delta,epsilon=epsilon)
+          nfev,njev,nlu = nfev+solver.nfev, njev+solver.njev, nlu+solver.nlu
+          solver        = create_solver(solver.t,solver.y,stops[i+1][0],first_step=h)
+     
+     with instrument.timer('evolveR0 assemble'):
+          sol = scipy.optimize.OptimizeResult(t         = np.array(ts),
+                                              y         = np.array(ys).T,
+                                              nfev      = nfev + solver.nfev,
+                                              njev      = njev + solver.njev,
+                                              nlu       = nlu + solver.nlu,
+                                              nsteps    = nsteps,
+                                              nrejected = instrument.get_rejected(method,step_nfev,nsteps),
+                                              status    = status,
+                                              message   = message,
+                                              success   = status>=0)
+     if instrument.enabled:
+          instrument.count_solver(sol.nfev,sol.njev,sol.nsteps,sol.nrejected)
+     return sol, [R0 for t,R0 in schedule]
 
 # round
 #
@@ -200,27 +345,27 @@ def round(x,n=1000):
 
 # get_ticks
 #
-# Used to etablish ticks for plot: max/min, mean, mean+/- sigma
+# Used to etablish ticks for plot: max/min, mean, mean+/- sigma, from an accumulator.Accumulator
 def get_ticks(y):
-     mu    = np.mean(y)
-     sigma = np.std(y)
-     return [round(min(y)),round(mu-sigma),round(mu),round(mu+sigma),round(max(y))]
+     mu    = y.mean
+     sigma = y.std()
+     return [round(y.min),round(mu-sigma),round(mu),round(mu+sigma),round(y.max)]
 
-# Get coefficient of variation
+# Get coefficient of variation from an accumulator.Accumulator
 
 def get_cv(y):
-     return np.std(y)/np.mean(y)
-
-def plot_details(sols,out='./figs',plot='details.png',indices=range(len(sepir.Indices))):
-     plt.figure(figsize=(20,6))
-     for i in indices:
-          plt.plot([t for sol in sols for t in sol.t],
-                   [sol.y[i][j] for sol in sols for j in range(len(sol.t))],
-                   label=sepir.names[i])
-     plt.legend() 
-     plt.savefig(os.path.join(out, plot))
-    
-     plt.close()
+     return y.cv()
+
+# plot_details
+#
+# Plot selected components of a solution (see render.render_curves)
+
+def plot_details(sol,out='./figs',plot='details.png',indices=range(len(sepir.Indices))):
+     with instrument.timer('plot_details'):
+          render.render_curves(os.path.join(out, plot),
+                               sol.t,
+                               [sol.y[i] for i in indices],
+                               labels=[sepir.names[i] for i in indices])
      
 def parse_args():
      parser = argparse.ArgumentParser('Model COVID19 evolution (see Transmission T-028: Sidney Redner on exponential growth processes)')
@@ -241,7 +386,8 @@ def parse_args():
      parser.add_argument('--show',                  default=False,      help='Show plots at end of run.', action='store_true')
      parser.add_argument('--out',                   default='./figs',   help='Pathname for plot file.')
      parser.add_argument('--plot',                  default='T028.png', help='Plot file name.')
-     parser.add_argument('--seed',      type=int,   default=None,       help='Seed for random number generator.')
+     parser.add_argument('--seed',      type=int,   default=None,       help='Seed for random number generator. Each run is seeded from '
+                                                                           'this and its index, so results do not depend on --workers.')
      parser.add_argument('--start',     type=int,   default=150,        help='Start applying NPIs.')
      parser.add_argument('--dt',        type=int,   default=5,          help='Average interval between NPIs.')
      parser.add_argument('--average',   type=float, default=0.95,       help='Average effect of an NPI on R0.')
@@ -252,25 +398,62 @@ def parse_args():
      parser.add_argument('--rtol',      type=float, default=1e-9,      help='relative tolerance for ode solver')
      parser.add_argument('--details',   type=int,   default=None,      help='Produce detailed plots for debugging', nargs='+')
      parser.add_argument('--trigger',   type=int,   default=None,      help='Trigger epidemic if number of infections exceeds this value')
-     return parser.parse_args()
+     parser.add_argument('--method',                default='RK45',    help='Integration method for ode solver',
+                         choices=['RK45','RK23','DOP853']+sepir.IMPLICIT_METHODS)
+     parser.add_argument('--ensemble',              default=False,     help='Integrate runs together as one system (--details is ignored)',
+                         action='store_true')
+     parser.add_argument('--batch',     type=int,   default=10000,     help='Number of runs in a batch: runs are integrated together in '
+                                                                           'ensemble mode, and checkpointed after each batch')
+     parser.add_argument('--workers',   type=int,   default=None,      help='Share runs among this many processes')
+     parser.add_argument('--checkpoint',            default=None,      help='Directory in which to save results of completed runs')
+     parser.add_argument('--checkpoint-every',type=int,default=10000,   help='Number of runs to collect before writing to checkpoint')
+     parser.add_argument('--resume',                default=False,     help='Resume simulation from checkpoint', action='store_true')
+     parser.add_argument('--cache',                 default=None,      help='Directory for cache of solutions, shared by runs')
+     parser.add_argument('--shared-prefix',         default=False,     help='Integrate up to first NPI once, and start every run from that solution',
+                         action='store_true')
+     parser.add_argument('--profile',               default=False,     help='Report time spent in each phase, and counts of evaluations and steps',
+                         action='store_true')
+     parser.add_argument('--profile-runs',          default=None,      help='With --profile, write summary of each run to this CSV file')
+     parser.add_argument('--ages',                  default=None,      help='CSV file of age bands, for age-structured model (see agesepir.load_bands)')
+     parser.add_argument('--contacts',              default=None,      help='CSV file of contact matrix for age bands (default: homogeneous mixing)')
+     args = parser.parse_args()
+     if args.ages!=None and args.ensemble:
+          parser.error('--ensemble cannot be used with --ages')
+     if args.ensemble and args.method!='RK45':
+          parser.error('--ensemble has its own Dormand-Prince (RK45) integrator, so cannot be used with --method')
+     if args.cache!=None and args.ensemble:
+          parser.error('--ensemble cannot be used with --cache')
+     return args
 
-# monte_carlo
+# get_ages
 #
-# Perform Monte-Carlo simulation
+# Age bands for age-structured model, or None. They are read once in each process.
 
-def monte_carlo(args,start):     
-     durations   = []
-     peaks       = []
-     infections  = []
-         
-     for i in range(args.M):
-          sols,R0s=evolveR0(t_range =(0,args.end),
+@lru_cache()
+def get_ages(file_name,contacts=None):
+     return None if file_name==None else agesepir.load_bands(file_name,contacts=contacts)
+
+# simulate
+#
+# Perform one run of the Monte-Carlo simulation, and summarize it as a record of type SUMMARY
+
+SUMMARY = np.dtype([('duration',   float),    # Time from start to peak
+                    ('peak',       float),    # Peak number of infections
+                    ('infections', float),    # Total number affected
+                    ('discarded',  bool)])    # Set if population did not stabilize
+
+def simulate(i,args,start,rng=random,prefix=None):
+     ages    = get_ages(args.ages,args.contacts)
+     timer   = instrument.timer('evolveR0')
+     with timer:
+          sol,R0s=evolveR0(t_range =(0,args.end),
                              R0      = args.R0,
                              NPIs    = create_NPIs(R0          = args.R0,
                                                    start       = start,
                                                    lower_bound = 2*args.average-1,
                                                    upper_bound = 1,
-                                                   dt          = 2*args.dt),
+                                                   dt          = 2*args.dt,
+                                                   rng         = rng),
                              initial = args.initial,
                              N       = args.N,
                              c       = args.c, 
@@ -283,77 +466,283 @@ def monte_carlo(args,start):
                              nICU    = args.nICU,   
                              pICU    = args.pICU,
                              atol    = args.atol,
-                             rtol    = args.rtol)
-          
-          #  Calculate number affected. Start by getting the last solution curve, 
-          #  and the last point in that curve.
-          final_sequence   = sols[-1].y
-          final_population = [final_sequence[j][-1]  for j in range(0,final_sequence.shape[0])]
+                             rtol    = args.rtol,
+                             method  = args.method,
+                             solutions = None if args.cache==None else cache.open_cache(args.cache),
+                             prefix  = prefix,
+                             ages    = ages)
+     if ages!=None:
+          sol.y = ages.get_totals(sol.y)
+     
+     #  Calculate number affected, using the last point of the solution curve
+     final_population = sol.y[:,-1]
+     
+     # Make sure population has stabilized  
+     stable = abs(max(final_population[i] for i in [sepir.Indices.EXPOSED.value,
+                                                    sepir.Indices.PRE_SYMPTOMATIC.value,
+                                                    sepir.Indices.INFECTIOUS_UNTESTED.value,
+                                                    sepir.Indices.INFECTIOUS_TESTED.value])) < args.tolerance
+     if instrument.enabled:
+          instrument.record_run(i,
+                                seconds   = timer.elapsed,
+                                nfev      = sol.nfev,
+                                njev      = sol.njev,
+                                steps     = sol.nsteps,
+                                rejected  = sol.nrejected,
+                                discarded = not stable)
+     if stable:
+#         Since people progress from Exposed to either Recovered or Dead, the final number of Susceptibles
+#         represents those who weren't affected at all.
+          infections = args.N*(1 - final_population[sepir.Indices.SUSCEPTIBLE.value])
+          if infections<0:
+               print (f'Negative value {infections} in step {i}')
+               plot_details(sol,plot=f'infections{i}.png')
+#         We want to know when the infection peaks          
+          ys    = args.N * (sol.y[sepir.Indices.INFECTIOUS_UNTESTED.value] + sol.y[sepir.Indices.INFECTIOUS_TESTED.value])
+          ts    = sol.t
+          ipeak = np.argmax(ys)
+          if ys[ipeak]<0:
+               print (f'Negative  peak {ys[ipeak]} in step {i}')
+               plot_details(sol,plot=f'peak{i}.png',indices=[3,4]) 
+              
+          if args.details!=None:
+               plot_details(sol,out=args.out,plot=f'details{i}.png',indices=args.details)
           
-          # Make sure population has stabilized  
-          if abs(max(final_population[i] for i in [sepir.Indices.EXPOSED.value,
-                                                   sepir.Indices.PRE_SYMPTOMATIC.value,
-                                                   sepir.Indices.INFECTIOUS_UNTESTED.value,
-                                                   sepir.Indices.INFECTIOUS_TESTED.value])) < args.tolerance: 
-               
-     #         Since people progress from Exposed to either Recovered or Dead, the final number of Susceptibles
-     #         represents those who weren't affected at all.
-               infections.append(args.N*(1 - final_population[sepir.Indices.SUSCEPTIBLE.value]))
-               if infections[-1]<0:
-                    print (f'Negative value {infections[-1]} in step {i}')
-                    plot_details(sols,plot=f'infections{i}.png')
-     #         We want to know when the infection peaks          
-               ys    = [y for sol in sols for y in sepir.scale(sepir.aggregate(sol.y,
-                                                                               selector=[sepir.Indices.INFECTIOUS_UNTESTED.value,
-                                                                                         sepir.Indices.INFECTIOUS_TESTED.value]),
-                                                               N=args.N)]
-               ts    = [t for sol in sols for t in sol.t]
-               ipeak = np.argmax(ys)
-               peaks.append(ys[ipeak])
-               if ys[ipeak]<0:
-                    print (f'Negative  peak {ys[ipeak]} in step {i}')
-                    plot_details(sols,plot=f'peak{i}.png',indices=[3,4]) 
-                    
-               durations.append(ts[ipeak]-start)
-                   
-               if args.details!=None:
-                    plot_details(sols,out=args.out,plot=f'details{i}.png',indices=args.details)
-          else:
-               print (f'Final population of simulation {i} outside tolerance {args.tolerance}: results discarded.')
+          return (ts[ipeak]-start, ys[ipeak], infections, False)
+     else:
+          print (f'Final population of simulation {i} outside tolerance {args.tolerance}: results discarded.')
+          return (np.nan, np.nan, np.nan, True)
 
+# simulate_ensemble
+#
+# Perform runs first,first+1,...,last-1 of the Monte-Carlo simulation by integrating them
+# together (see ensemble.py), and summarize each run as a record of type SUMMARY.
+
+def simulate_ensemble(first,last,args,start,rngs,prefix=None):
+     NPIs = [create_NPIs(R0          = args.R0,
+                         start       = start,
+                         lower_bound = 2*args.average-1,
+                         upper_bound = 1,
+                         dt          = 2*args.dt,
+                         rng         = rng) for rng in rngs]
+     t0 = 0
+     y0 = None
+     if prefix!=None:
+          # Start all members from the prefix at the earliest first NPI
+          t0 = min(member_NPIs[0][0] for member_NPIs in NPIs)
+          y0 = prefix.sol(t0)
+     with instrument.timer('evolve_ensemble'):
+          y,ipeaks,tpeaks = ensemble.evolve_ensemble(
+                             t_range = (t0,args.end),
+                             R0      = args.R0,
+                             NPIs    = NPIs,
+                             initial = args.initial,
+                             N       = args.N,
+                             c       = args.c, 
+                             alpha   = args.alpha,   
+                             gamma   = args.gamma,
+                             delta   = args.delta,
+                             epsilon = args.epsilon,
+                             CFR1    = args.CFR1,  
+                             CFR0    = args.CFR0,  
+                             nICU    = args.nICU,   
+                             pICU    = args.pICU,
+                             atol    = args.atol,
+                             rtol    = args.rtol,
+                             y0      = y0)
+     if prefix!=None:
+          before   = prefix.t<t0
+          infected = (prefix.y[sepir.Indices.INFECTIOUS_UNTESTED.value,before] +
+                      prefix.y[sepir.Indices.INFECTIOUS_TESTED.value,before])
+          if len(infected)>0:
+               # Peak may have been reached before the first NPI
+               higher         = infected.max()>=ipeaks
+               ipeaks[higher] = infected.max()
+               tpeaks[higher] = prefix.t[before][infected.argmax()]
+     
+     # Make sure population has stabilized  
+     discarded = np.abs(np.max(y[[sepir.Indices.EXPOSED.value,
+                                  sepir.Indices.PRE_SYMPTOMATIC.value,
+                                  sepir.Indices.INFECTIOUS_UNTESTED.value,
+                                  sepir.Indices.INFECTIOUS_TESTED.value]],axis=0)) >= args.tolerance
+     for i in np.flatnonzero(discarded):
+          print (f'Final population of simulation {first+i} outside tolerance {args.tolerance}: results discarded.')
+     
+     summaries               = np.empty(last-first,dtype=SUMMARY)
+     summaries['duration']   = np.where(discarded, np.nan, tpeaks-start)
+     summaries['peak']       = np.where(discarded, np.nan, args.N*ipeaks)
+     summaries['infections'] = np.where(discarded, np.nan, args.N*(1 - y[sepir.Indices.SUSCEPTIBLE.value]))
+     summaries['discarded']  = discarded
+     return summaries
+
+# get_rng
+#
+# Random number generator for one run, seeded from the entropy for the whole simulation
+# and the index of the run.
+
+def get_rng(entropy,i):
+     return random.Random(int(np.random.SeedSequence(entropy,spawn_key=(i,)).generate_state(1,np.uint64)[0]))
+
+# simulate_batch
+#
+# Perform runs first,first+1,...,last-1 of the Monte-Carlo simulation, and summarize each
+# run as a record of type SUMMARY. Each run has its own random number generator, seeded
+# from entropy (see get_rng), so results don't depend on how runs are shared among
+# processes. If prefix is specified, runs start from it at their first NPI.
+
+def simulate_batch(first,last,args,start,entropy,prefix=None):
+     rngs = [get_rng(entropy,i) for i in range(first,last)]
+     if args.ensemble:
+          return simulate_ensemble(first,last,args,start,rngs,prefix=prefix)
+     else:
+          return np.array([simulate(i,args,start,rng=rng,prefix=prefix) for i,rng in zip(range(first,last),rngs)],
+                          dtype=SUMMARY)
+
+# monte_carlo
+#
+# Perform Monte-Carlo simulation, optionally sharing the runs among several processes.
+# Returns statistics for durations, peaks, and infections as accumulator.Accumulators.
+#
+# Every run is the same until its first NPI, so with --shared-prefix that part is
+# integrated once, with dense output, and each run continues from it.
+
+def monte_carlo(args,start):     
+     durations   = accumulator.Accumulator()
+     peaks       = accumulator.Accumulator()
+     infections  = accumulator.Accumulator()
+     entropy     = np.random.SeedSequence(args.seed).entropy
+     saved       = None
+     
+     def accumulate(summaries):
+          kept = summaries[~summaries['discarded']]
+          durations.extend(kept['duration'])
+          peaks.extend(kept['peak'])
+          infections.extend(kept['infections'])
+     
+     def record(summaries):
+          with instrument.timer('monte_carlo record'):
+               accumulate(summaries)
+               if saved!=None:
+                    saved.append(summaries)
+     
+     if args.checkpoint!=None:
+          with instrument.timer('monte_carlo load checkpoint'):
+               saved   = checkpoint.Checkpoint(args.checkpoint,
+                                               get_settings(args,start,entropy),
+                                               resume = args.resume,
+                                               every  = args.checkpoint_every)
+               entropy = saved.settings['entropy']
+               for summaries in saved.load():
+                    accumulate(summaries)
+          if saved.completed>0:
+               print (f'Resuming from run {saved.completed}')
+     
+     prefix      = None
+     if args.shared_prefix:
+          ages   = get_ages(args.ages,args.contacts)
+          prefix = evolve(0,start,(sepir if ages==None else ages).get_initial_y(initial=args.initial,N=args.N),
+                          R0      = args.R0,
+                          N       = args.N,
+                          c       = args.c,
+                          alpha   = args.alpha,
+                          gamma   = args.gamma,
+                          delta   = args.delta,
+                          epsilon = args.epsilon,
+                          CFR1    = args.CFR1,
+                          CFR0    = args.CFR0,
+                          nICU    = args.nICU,
+                          pICU    = args.pICU,
+                          atol    = args.atol,
+                          rtol    = args.rtol,
+                          method  = args.method,
+                          dense_output = True,
+                          ages    = ages)
+     
+     resume_from = 0 if saved==None else saved.completed
+     runs        = instrument.timer('monte_carlo runs')
+     if args.workers==None:
+          with runs:
+               for first in range(resume_from,args.M,args.batch):
+                    record(simulate_batch(first,min(first+args.batch,args.M),args,start,entropy,prefix=prefix))
+     else:
+          size    = max(1,min(args.batch,math.ceil((args.M-resume_from)/(4*args.workers))))
+          firsts  = range(resume_from,args.M,size)
+          # If instrumentation is enabled, workers return what they have recorded with each batch
+          batch   = simulate_batch if not instrument.enabled else \
+                    partial(instrument.run_profiled,simulate_batch,instrument.stats.records!=None)
+          with runs, ProcessPoolExecutor(max_workers=args.workers) as executor:
+               for summaries in executor.map(batch,
+                                             firsts,
+                                             [min(first+size,args.M) for first in firsts],
+                                             repeat(args),
+                                             repeat(start),
+                                             repeat(entropy),
+                                             repeat(prefix)):
+                    if instrument.enabled:
+                         summaries,recorded = summaries
+                         instrument.merge(recorded)
+                    record(summaries)
+     
+     if saved!=None:
+          with instrument.timer('monte_carlo flush checkpoint'):
+               saved.flush()
+     
      return ( durations,  peaks,  infections)
 
+# get_settings
+#
+# Settings that determine the results of a simulation, which must not change if it is resumed
+
+def get_settings(args,start,entropy):
+     settings = {key:value for key,value in vars(args).items()
+                 if key not in ['M','show','out','plot','details','workers','batch','checkpoint','resume','checkpoint_every','cache',
+                                'profile','profile_runs']}
+     settings['start']   = start
+     settings['entropy'] = entropy
+     settings['seeding'] = 'per run'
+     return settings
+
+# plot_histogram
+#
+# Plot histogram from an accumulator.Accumulator
+
+def plot_histogram(ax,y):
+     edges,counts = y.histogram.get_bins()
+     ax.hist(edges[:-1],bins=edges,weights=counts,color='c')
+
 # plot_results
 #
-# Plot accumuldated statistics
+# Plot accumuldated statistics. The figure is only created with pyplot if it is to be shown.
 def plot_results(durations,  peaks,  infections,args):
-     fig = plt.figure(figsize=(20,6))
+     fig = plt.figure(figsize=(20,6)) if args.show else render.get_figure((20,6))
      fig.suptitle(f'Duration and Infections: M={args.M}, average={args.average}')
      
-     ax1 = plt.subplot(221)
-     ax1.hist(durations,color='c')
+     ax1 = fig.add_subplot(221)
+     plot_histogram(ax1,durations)
      ax1.set_xlabel(f'Time to peak (days): CV={get_cv(durations):.2}')
      
-     ax2 = plt.subplot(222)
-     ax2.hist(peaks,color='c')
+     ax2 = fig.add_subplot(222)
+     plot_histogram(ax2,peaks)
      ax2.set_xlabel(f'Peak infections: CV={get_cv(peaks):.2}')
      ax2.set_xticks(get_ticks(peaks))
      
-     ax3 = plt.subplot(223)
-     ax3.hist(infections,color='c')
+     ax3 = fig.add_subplot(223)
+     plot_histogram(ax3,infections)
      ax3.set_xlabel(f'Infections: CV={get_cv(infections):.2}')
      ax3.set_xticks(get_ticks(infections))     
      
-     plt.savefig(os.path.join(args.out, args.plot))   
+     fig.savefig(os.path.join(args.out, args.plot))   
      
 if __name__=='__main__':
       
      args = parse_args()
-     random.seed(args.seed)
+     if args.profile:
+          instrument.enable(keep_runs=args.profile_runs!=None)
+     ages  = get_ages(args.ages,args.contacts)
      start = args.start if args.trigger==None else \
           find_start(0,
                      args.end,
-                     sepir.get_initial_y(initial=args.initial,N=args.N),
+                     (sepir if ages==None else ages).get_initial_y(initial=args.initial,N=args.N),
                      R0      = args.R0,
                      N       = args.N,
                      c       = args.c, 
@@ -367,11 +756,24 @@ if __name__=='__main__':
                      pICU    = args.pICU,
                      trigger = args.trigger,
                      atol    = args.atol,
-                     rtol    = args.rtol )
+                     rtol    = args.rtol,
+                     method  = args.method,
+                     solutions = None if args.cache==None else cache.open_cache(args.cache),
+                     ages    = ages)
 
      durations,  peaks,  infections = monte_carlo(args,start)
+     
+     print (f'Time to peak:    {durations}')
+     print (f'Peak infections: {peaks}')
+     print (f'Infections:      {infections}')
 
-     plot_results(durations,  peaks,  infections,args)
+     with instrument.timer('plot_results'):
+          plot_results(durations,  peaks,  infections,args)
+     
+     if args.profile:
+          instrument.report()
+          if args.profile_runs!=None:
+               instrument.write_runs(args.profile_runs)
      
 #    decide whether to display
      if args.show:
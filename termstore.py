@@ -0,0 +1,134 @@
+# termstore.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Store word counts for each document of a corpus in an SQLite database, together with
+# totals for the whole corpus, so that when the corpus changes only new and modified
+# documents need to be processed.
+#
+# Documents are identified by their path relative to the root of the corpus. A document
+# is taken to be unchanged if its modification time and size are as recorded; otherwise
+# its content is hashed, and it is only processed again if the hash differs.
+
+import hashlib, os, sqlite3
+from os.path import join
+
+# get_hash
+#
+# SHA-256 of the content of a file
+
+def get_hash(file_name,block_size=2**20):
+    hash = hashlib.sha256()
+    with open(file_name,'rb') as file:
+        for block in iter(lambda: file.read(block_size),b''):
+            hash.update(block)
+    return hash.hexdigest()
+
+class TermStore:
+    # Parameters:
+    #     path    SQLite database (created if it doesn't exist)
+    #     root    Root of corpus
+    #     mode    What counts mean, e.g. occurrences or documents; this must match the mode
+    #             with which the database was created
+    def __init__(self,path='keywords.db',root='.',mode='term'):
+        self.root       = root
+        self.mode       = mode
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS documents (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, hash TEXT);
+            CREATE TABLE IF NOT EXISTS counts    (path TEXT, word TEXT, count INTEGER, PRIMARY KEY (path,word)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS totals    (word TEXT PRIMARY KEY, count INTEGER) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS settings  (name TEXT PRIMARY KEY, value TEXT);
+        ''')
+        with self.connection:
+            self.connection.execute('INSERT OR IGNORE INTO settings VALUES (?,?)',('mode',mode))
+        saved_mode,     = self.connection.execute("SELECT value FROM settings WHERE name='mode'").fetchone()
+        if saved_mode!=mode:
+            self.connection.close()
+            raise ValueError(f'{path} counts {saved_mode}s, not {mode}s')
+
+    # get_changes
+    #
+    # Compare documents in corpus with those recorded.
+    #
+    # Parameters:
+    #     file_names   Paths of all documents now in corpus, relative to root
+    #
+    # Returns:
+    #     changed   List of (path,mtime,size,hash) for documents that are new or modified
+    #     deleted   Paths of documents that are recorded, but no longer in corpus
+
+    def get_changes(self,file_names):
+        recorded = {path:(mtime,size,hash) for path,mtime,size,hash in
+                    self.connection.execute('SELECT path,mtime,size,hash FROM documents')}
+        changed  = []
+        touched  = []
+        for file_name in file_names:
+            status = os.stat(join(self.root,file_name))
+            if file_name in recorded and recorded[file_name][:2]==(status.st_mtime,status.st_size):
+                continue
+            hash   = get_hash(join(self.root,file_name))
+            if file_name in recorded and recorded[file_name][2]==hash:
+                touched.append((status.st_mtime,status.st_size,file_name))
+            else:
+                changed.append((file_name,status.st_mtime,status.st_size,hash))
+        with self.connection:
+            self.connection.executemany('UPDATE documents SET mtime=?, size=? WHERE path=?',touched)
+        return changed, sorted(recorded.keys() - set(file_names))
+
+    # remove
+    #
+    # Remove a document, subtracting its counts from totals
+
+    def remove(self,path):
+        self.connection.execute('''UPDATE totals
+                                   SET    count = count - (SELECT count FROM counts WHERE path=? AND word=totals.word)
+                                   WHERE  word IN (SELECT word FROM counts WHERE path=?)''',(path,path))
+        self.connection.execute('DELETE FROM counts WHERE path=?',(path,))
+        self.connection.execute('DELETE FROM documents WHERE path=?',(path,))
+
+    # add
+    #
+    # Record counts for a document, replacing any that were recorded before
+
+    def add(self,path,mtime,size,hash,counts):
+        self.remove(path)
+        self.connection.execute('INSERT INTO documents VALUES (?,?,?,?)',(path,mtime,size,hash))
+        self.connection.executemany('INSERT INTO counts VALUES (?,?,?)',
+                                    [(path,word,count) for word,count in counts.items()])
+        self.connection.executemany('''INSERT INTO totals VALUES (?,?)
+                                       ON CONFLICT(word) DO UPDATE SET count=count+excluded.count''',
+                                    counts.items())
+
+    # commit
+    #
+    # Make changes permanent, discarding words that no longer occur
+
+    def commit(self):
+        self.connection.execute('DELETE FROM totals WHERE count<=0')
+        self.connection.commit()
+
+    # get_frequencies
+    #
+    # Words and counts for whole corpus, in descending order by count, then by word
+    # (or just the first k of them)
+
+    def get_frequencies(self,k=None):
+        return self.connection.execute('SELECT word,count FROM totals ORDER BY count DESC, word LIMIT ?',
+                                       (-1 if k==None else k,)).fetchall()
+
+    def close(self):
+        self.connection.close()
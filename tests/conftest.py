@@ -0,0 +1,63 @@
+# conftest.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Shared setup for tests: the modules being tested are scripts at the top of the
+# repository, so it is added to the path, and plots are rendered without a display.
+
+import importlib.util, os, sys, numpy as np
+
+os.environ.setdefault('MPLBACKEND','Agg')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0,ROOT)
+
+# load_script
+#
+# Import one of the scripts whose names contain hyphens, e.g. extract-keys.py
+
+def load_script(name):
+    spec   = importlib.util.spec_from_file_location(name.replace('-','_'),os.path.join(ROOT,f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# get_numerical_jacobian
+#
+# Central difference estimate of the Jacobian of f at x
+
+def get_numerical_jacobian(f,x,step=1e-6):
+    x = np.asarray(x,dtype=float)
+    J = []
+    for i in range(len(x)):
+        h     = step*max(abs(x[i]),1e-2)
+        upper = x.copy()
+        lower = x.copy()
+        upper[i] += h
+        lower[i] -= h
+        J.append((np.asarray(f(upper)) - np.asarray(f(lower)))/(2*h))
+    return np.array(J).T
+
+# get_state
+#
+# A random state of the SEPIR model, or size of them as columns, with the infectious
+# compartments scaled by infected, normalized so each sums to 1, and flattened
+
+def get_state(rng,infected,size=None):
+    y       = rng.uniform(0.5,1.5,(7,) if size==None else (7,size))
+    y[3:5] *= infected
+    return (y/y.sum(axis=0)).ravel()
@@ -0,0 +1,85 @@
+# test_accumulator.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Statistics accumulated in one pass agree with numpy, whether the values arrive at
+# once, in pieces, or in separate accumulators that are then merged.
+
+import numpy as np, accumulator
+
+def get_values(n=20000,seed=1):
+    return np.random.default_rng(seed).lognormal(3,1,n)
+
+def test_moments():
+    values = get_values()
+    y      = accumulator.Accumulator()
+    for part in np.array_split(values,37):
+        y.extend(part)
+    assert y.n==len(values)
+    np.testing.assert_allclose(y.mean,np.mean(values),rtol=1e-12)
+    np.testing.assert_allclose(y.std(),np.std(values),rtol=1e-10)
+    assert y.min==values.min() and y.max==values.max()
+
+def test_merge_matches_single_pass():
+    values = get_values()
+    whole  = accumulator.Accumulator()
+    whole.extend(values)
+    merged = accumulator.Accumulator()
+    for part in np.array_split(values,5):
+        y = accumulator.Accumulator()
+        y.extend(part)
+        merged.merge(y)
+    merged.merge(accumulator.Accumulator())         # Empty accumulators change nothing
+    assert merged.n==whole.n
+    np.testing.assert_allclose([merged.mean,merged.std(),merged.min,merged.max],
+                               [whole.mean,whole.std(),whole.min,whole.max],
+                               rtol=1e-12)
+    np.testing.assert_array_equal(merged.histogram.get_bins()[1],whole.histogram.get_bins()[1])
+
+def test_quantiles():
+    values = get_values(n=100000)
+    sketch = accumulator.QuantileSketch(k=256)
+    for part in np.array_split(values,10):
+        other = accumulator.QuantileSketch(k=256)
+        other.extend(part)
+        sketch.merge(other)
+    q      = np.array([0.01,0.05,0.25,0.5,0.75,0.95,0.99])
+    # Rank error of a sketch is a small multiple of log2(n/k)/k
+    ranks  = np.searchsorted(np.sort(values),sketch.quantile(q))/len(values)
+    np.testing.assert_allclose(ranks,q,atol=0.02)
+    # Memory is bounded: the sketch holds far fewer values than it has seen
+    assert sum(len(level) for level in sketch.levels)<0.05*len(values)
+
+def test_histogram_rebinning():
+    values    = get_values()
+    histogram = accumulator.Histogram(width=2**-10,max_bins=64)
+    histogram.extend(values)
+    edges,counts = histogram.get_bins()
+    assert len(counts)<=64
+    assert counts.sum()==len(values)
+    np.testing.assert_array_equal(counts,np.histogram(values,bins=edges)[0])
+
+def test_histogram_merge_different_widths():
+    values = get_values()
+    narrow = accumulator.Histogram(width=2**-10,max_bins=64)
+    narrow.extend(values[values<20])
+    wide   = accumulator.Histogram(width=2**-10,max_bins=64)
+    wide.extend(values[values>=20])
+    assert narrow.width<wide.width
+    narrow.merge(wide)
+    edges,counts = narrow.get_bins()
+    assert narrow.width>=wide.width and len(counts)<=64
+    np.testing.assert_array_equal(counts,np.histogram(values,bins=edges)[0])
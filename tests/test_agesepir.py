@@ -0,0 +1,50 @@
+# test_agesepir.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# The exact Jacobian of the age-structured model agrees with finite differences, both
+# where the ICUs are overwhelmed and where they are not, and bands that mix homogeneously
+# evolve together as the SEPIR model.
+
+import numpy as np, pytest, agesepir, sepir
+from conftest import get_numerical_jacobian, get_state
+
+@pytest.mark.parametrize('infected',[1e-7,0.1])
+def test_agesepir_jacobian(infected):
+    rng      = np.random.default_rng(4)
+    A        = 3
+    share    = rng.uniform(1,2,A)
+    share   /= share.sum()
+    contacts = rng.uniform(0,3,(A,A))
+    y        = get_state(rng,infected,size=A)
+    args     = (5000000,0.1,0.25,0.3,0.1,1.0,0.15,rng.uniform(0.02,0.03,A),rng.uniform(0.005,0.01,A),300,
+                rng.uniform(0.005,0.02,A),share,contacts)
+    np.testing.assert_allclose(agesepir.jacobian(0,y,*args),
+                               get_numerical_jacobian(lambda y: agesepir.dy(0,y,*args),y),
+                               rtol=1e-5,atol=1e-9)
+
+@pytest.mark.parametrize('method',['RK45','BDF'])
+def test_homogeneous_bands_match_sepir(method):
+    ages     = agesepir.AgeBands([1,2,3])
+    args     = (5000000,0.1,0.25,sepir.get_beta(),0.1,1,0.15,0.02,0.01,300,0.0125)
+    y0       = sepir.get_initial_y(initial=20,N=5000000)
+    expected = sepir.solve((0,300),y0,args=args,method=method,atol=1e-12,rtol=1e-10,t_eval=[100,200,300])
+    sol      = sepir.solve((0,300),ages.get_initial_y(initial=20,N=5000000),
+                           args=(*args[:3],ages.get_beta(),*args[4:]),method=method,atol=1e-12,rtol=1e-10,
+                           t_eval=[100,200,300],ages=ages)
+    assert ages.get_beta()==pytest.approx(sepir.get_beta())
+    # Deaths differ, since sepir.dy lets CFR fall below CFR0 while ICUs have room
+    np.testing.assert_allclose(ages.get_totals(sol.y)[:5],expected.y[:5],rtol=1e-5,atol=1e-10)
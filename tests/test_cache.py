@@ -0,0 +1,68 @@
+# test_cache.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# The cache returns what was stored for the same parameters, removes the least recently
+# used entries when it is full, and gives the same solutions as solving without it.
+
+import os, random, time, numpy as np, pytest, cache, t028
+
+def test_memoize(tmp_path):
+    solutions = cache.SolutionCache(str(tmp_path))
+    calls     = []
+    def compute():
+        calls.append(1)
+        return dict(t=np.arange(3.0),y=np.ones((7,3)))
+    params    = dict(t_span=(0,3),y0=np.zeros(7),method='RK45')
+    first     = solutions.memoize(params,compute)
+    again     = cache.SolutionCache(str(tmp_path)).memoize(dict(params),compute)   # From disk
+    assert len(calls)==1
+    np.testing.assert_array_equal(again['y'],first['y'])
+
+def test_keys(tmp_path):
+    solutions = cache.SolutionCache(str(tmp_path))
+    assert solutions.get_key(dict(y=np.array([1.0,2.0]),N=np.int64(5)))==solutions.get_key(dict(N=5,y=[1.0,2.0]))
+    assert solutions.get_key(dict(y=[1.0,2.0]))!=solutions.get_key(dict(y=[1.0,2.5]))
+    with pytest.raises(TypeError):
+        solutions.get_key(dict(f=object()))
+
+def test_eviction(tmp_path,monkeypatch):
+    entry       = np.zeros(1000)                   # About 8 KB on disk
+    solutions   = cache.SolutionCache(str(tmp_path),max_bytes=50000)
+    listed      = []
+    get_entries = solutions.get_entries
+    monkeypatch.setattr(solutions,'get_entries',lambda: listed.append(1) or get_entries())
+    start       = time.time() - 1000
+    for i in range(12):
+        solutions.put(dict(i=i),y=entry)
+        os.utime(os.path.join(str(tmp_path),solutions.get_key(dict(i=i))),(start+i,start+i))
+    remaining   = [i for i in range(12) if os.path.exists(os.path.join(str(tmp_path),solutions.get_key(dict(i=i))))]
+    assert remaining==list(range(12-len(remaining),12))            # Most recently used were kept
+    assert 0<solutions.total<=50000
+    assert sum(size for _,size,_ in get_entries())==solutions.total
+    assert len(listed)<12                                           # Not listed for every entry
+
+def test_evolveR0_same_with_cache(tmp_path):
+    solutions = cache.SolutionCache(str(tmp_path))
+    rng       = random.Random(1)
+    for method in ['RK45','LSODA']:
+        NPIs       = t028.create_NPIs(rng=rng)
+        uncached,_ = t028.evolveR0(NPIs=NPIs,atol=1e-9,rtol=1e-9,method=method)
+        missed,_   = t028.evolveR0(NPIs=NPIs,atol=1e-9,rtol=1e-9,method=method,solutions=solutions)
+        hit,_      = t028.evolveR0(NPIs=NPIs,atol=1e-9,rtol=1e-9,method=method,solutions=solutions)
+        for sol in [missed,hit]:
+            np.testing.assert_array_equal(sol.t,uncached.t)
+            np.testing.assert_array_equal(sol.y,uncached.y)
@@ -0,0 +1,46 @@
+# test_calibrate.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Forward sensitivities of calibrate.py, compared with finite differences of the
+# outputs with respect to the logarithms of the parameters
+
+import math, numpy as np, calibrate
+
+def test_simulate_sensitivities():
+    names    = ['R0','alpha','c','gamma','delta','epsilon','initial']
+    values   = {'R0':2.2,'alpha':0.3,'c':0.15,'gamma':0.12,'delta':1.0,'epsilon':0.2,'initial':20}
+    settings = {'N':5000000,'nICU':300,'CFR1':0.02,'CFR0':0.01,'pICU':0.0125}
+    days     = np.arange(1,61)
+    series   = ['cases','I1','R1']
+    _,derivatives = calibrate.simulate_sensitivities(values,names,days,series,settings,rtol=1e-11,atol=1e-16)
+    step     = 1e-5
+    for j,name in enumerate(names):
+        outputs = []
+        for sign in [1,-1]:
+            shifted = dict(values,**{name:values[name]*math.exp(sign*step)})
+            output,_ = calibrate.simulate_sensitivities(shifted,names,days,series,settings,rtol=1e-11,atol=1e-16)
+            outputs.append(output)
+        np.testing.assert_allclose(derivatives[:,j],(outputs[0]-outputs[1])/(2*step),rtol=1e-5,atol=1e-3)
+
+def test_simulate_batch_matches_sensitivities():
+    values   = {'R0':np.array([2.2,1.8]),'alpha':0.3,'c':0.15,'gamma':0.12,'delta':1.0,'epsilon':0.2,'initial':20}
+    settings = {'N':5000000,'nICU':300,'CFR1':0.02,'CFR0':0.01,'pICU':0.0125}
+    days     = np.arange(1,61)
+    batch    = calibrate.simulate_batch(values,days,['cases'],settings,rtol=1e-10,atol=1e-15)
+    for k,R0 in enumerate(values['R0']):
+        single,_ = calibrate.simulate_sensitivities(dict(values,R0=R0),['R0'],days,['cases'],settings,rtol=1e-10,atol=1e-15)
+        np.testing.assert_allclose(batch[k],single,rtol=1e-6,atol=1e-3)
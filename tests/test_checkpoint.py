@@ -0,0 +1,71 @@
+# test_checkpoint.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# A simulation that is stopped and resumed from its checkpoint gives the same results
+# as one that runs straight through, and checkpoints refuse to mix settings.
+
+import sys, numpy as np, pytest, checkpoint, t028
+
+def get_args(monkeypatch,*extra):
+    monkeypatch.setattr(sys,'argv',['t028.py','--seed','5','--batch','4']+list(extra))
+    return t028.parse_args()
+
+def get_values(args):
+    return [(y.n,y.mean,y.std(),y.min,y.max) for y in t028.monte_carlo(args,args.start)]
+
+def test_resume_matches_uninterrupted(monkeypatch,tmp_path):
+    path     = str(tmp_path/'checkpoint')
+    expected = get_values(get_args(monkeypatch,'--M','14'))
+    get_values(get_args(monkeypatch,'--M','9','--checkpoint',path,'--checkpoint-every','4'))
+    resumed  = get_values(get_args(monkeypatch,'--M','14','--checkpoint',path,'--checkpoint-every','4','--resume'))
+    np.testing.assert_allclose(resumed,expected,rtol=1e-12)
+    saved    = checkpoint.Checkpoint(path,{},resume=True)
+    assert sum(len(summaries) for summaries in saved.load())==14
+
+def get_summaries(first,last):
+    summaries             = np.zeros(last-first,dtype=t028.SUMMARY)
+    summaries['duration'] = np.arange(first,last)
+    return summaries
+
+def test_chunks(tmp_path):
+    path  = str(tmp_path)
+    saved = checkpoint.Checkpoint(path,{'seed':1},every=3)
+    for first in range(0,10,2):
+        saved.append(get_summaries(first,first+2))
+    saved.flush()
+    (tmp_path/'chunk.tmp.npz').write_bytes(b'interrupted')        # Left by a write that didn't finish
+    loaded = checkpoint.Checkpoint(path,{'seed':1},resume=True)
+    np.testing.assert_array_equal(np.concatenate(list(loaded.load()))['duration'],np.arange(10))
+    assert loaded.completed==10
+
+def test_settings_must_match(tmp_path):
+    path = str(tmp_path)
+    checkpoint.Checkpoint(path,{'seed':1,'entropy':123})
+    with pytest.raises(FileExistsError):
+        checkpoint.Checkpoint(path,{'seed':1,'entropy':123})
+    with pytest.raises(ValueError):
+        checkpoint.Checkpoint(path,{'seed':2,'entropy':123},resume=True)
+    assert checkpoint.Checkpoint(path,{'seed':1,'entropy':456},resume=True).settings['entropy']==123
+
+def test_missing_chunk(tmp_path):
+    path  = str(tmp_path)
+    saved = checkpoint.Checkpoint(path,{},every=2)
+    for first in range(0,6,2):
+        saved.append(get_summaries(first,first+2))
+    (tmp_path/'chunk-000000002.npz').unlink()
+    with pytest.raises(ValueError):
+        list(checkpoint.Checkpoint(path,{},resume=True).load())
@@ -0,0 +1,83 @@
+# test_corpus.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reading the corpus through the thread pool: files are found in the same order as os.walk,
+# returned in order however far the pool reads ahead, and failures are summarized
+
+import json, os, pytest, corpus
+
+def write_paper(path,paper_id,text='text'):
+    file_name = os.path.join(path,f'{paper_id}.json')
+    with open(file_name,'w') as json_file:
+        json.dump({'paper_id':paper_id,'metadata':{'title':paper_id.upper()},'body_text':[{'text':text},{'text':'more'}]},json_file)
+    return file_name
+
+def test_find_json_files_matches_walk(tmp_path):
+    for folder in ['pdf_json','pmc_json','pdf_json/nested','empty']:
+        os.makedirs(os.path.join(tmp_path,folder),exist_ok=True)
+    for i,folder in enumerate(['','pdf_json','pmc_json','pdf_json/nested','pdf_json']):
+        write_paper(os.path.join(tmp_path,folder),f'paper{i}')
+    with open(os.path.join(tmp_path,'pdf_json','notes.txt'),'w') as text_file:
+        text_file.write('not json')
+    expected = [os.path.join(dirpath,name) for dirpath,_,names in os.walk(tmp_path) for name in names if name.endswith('.json')]
+    assert list(corpus.find_json_files(tmp_path))==expected
+    assert len(expected)==5
+
+@pytest.mark.parametrize('threads,prefetch',[(1,1),(4,2),(8,64)])
+def test_read_json_keeps_order(tmp_path,threads,prefetch):
+    file_names = [write_paper(tmp_path,f'paper{i}') for i in range(20)]
+    results    = list(corpus.read_json(file_names,threads=threads,prefetch=prefetch))
+    assert [file_name for file_name,_ in results]==file_names
+    assert [content['paper_id'] for _,content in results]==[f'paper{i}' for i in range(20)]
+
+def test_read_json_errors(tmp_path):
+    file_names = [write_paper(tmp_path,'a'),os.path.join(tmp_path,'missing.json'),write_paper(tmp_path,'b')]
+    with pytest.raises(OSError):
+        list(corpus.read_json(file_names))
+    errors = corpus.Errors()
+    assert [content['paper_id'] for _,content in corpus.read_json(file_names,errors=errors)]==['a','b']
+    assert [(file_name,name) for file_name,name,_ in errors.errors]==[(file_names[1],'FileNotFoundError')]
+
+def test_headers_and_texts(tmp_path):
+    file_name = write_paper(tmp_path,'a','alpha')
+    assert corpus.read_header(file_name)=='a'
+    assert corpus.read_header(file_name,title=True)==('a','A')
+    assert corpus.read_texts(file_name)==['alpha','more']
+
+def test_scan_papers_records_errors(tmp_path):
+    write_paper(tmp_path,'a')
+    with open(os.path.join(tmp_path,'broken.json'),'w') as json_file:
+        json_file.write('not json')
+    with open(os.path.join(tmp_path,'untitled.json'),'w') as json_file:
+        json.dump({'metadata':{}},json_file)
+    errors = corpus.Errors()
+    assert list(corpus.scan_papers(tmp_path,errors=errors))==['a']
+    assert len(errors)==2
+
+def test_report(capsys):
+    errors = corpus.Errors(examples=2)
+    for i in range(3):
+        errors.add(f'{i}.json',KeyError('paper_id'))
+    other  = corpus.Errors()
+    other.add('3.json',ValueError('bad'))
+    errors.merge(other)
+    errors.report()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0]=='4 files could not be read: KeyError 3, ValueError 1'
+    assert len(lines)==4 and lines[-1].strip()=='...'
+    corpus.Errors().report()
+    assert capsys.readouterr().out==''
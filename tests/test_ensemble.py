@@ -0,0 +1,52 @@
+# test_ensemble.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Integrating runs together as an ensemble gives the same results as integrating
+# them one at a time with t028.evolveR0, and t028 rejects options the ensemble ignores.
+
+import random, sys, numpy as np, pytest, ensemble, sepir, t028
+
+def test_create_schedule():
+    breakpoints,members,factors = ensemble.create_schedule([[(10,0.5),(20,0.9)],[],[(10,0.8),(15,0.7)]])
+    np.testing.assert_array_equal(breakpoints,[10,15,20])
+    assert [list(m) for m in members]==[[0,2],[2],[0]]
+    assert [list(f) for f in factors]==[[0.5,0.8],[0.7],[0.9]]
+
+def test_ensemble_matches_evolveR0():
+    rng            = random.Random(1)
+    NPIs           = [t028.create_NPIs(start=150,dt=10,rng=rng) for _ in range(8)]
+    y,peaks,tpeaks = ensemble.evolve_ensemble(NPIs=NPIs,t_range=(0,400),atol=1e-10,rtol=1e-10)
+    for k,member_NPIs in enumerate(NPIs):
+        sol,_    = t028.evolveR0(NPIs=member_NPIs,t_range=(0,400),atol=1e-10,rtol=1e-10)
+        infected = sol.y[sepir.Indices.INFECTIOUS_UNTESTED.value] + sol.y[sepir.Indices.INFECTIOUS_TESTED.value]
+        np.testing.assert_allclose(y[:,k],sol.y[:,-1],rtol=1e-6,atol=1e-10)
+        # Peaks are found at the steps of each integrator, so agree less closely
+        np.testing.assert_allclose(peaks[k],infected.max(),rtol=1e-3)
+        assert abs(tpeaks[k]-sol.t[infected.argmax()])<2
+
+def test_ensemble_from_state():
+    NPIs      = [[(100,0.5)],[(120,0.6)]]
+    sol,_     = t028.evolveR0(NPIs=[],t_range=(0,50),atol=1e-10,rtol=1e-10)
+    whole,_,_ = ensemble.evolve_ensemble(NPIs=NPIs,t_range=(0,200),atol=1e-10,rtol=1e-10)
+    split,_,_ = ensemble.evolve_ensemble(NPIs=NPIs,t_range=(50,200),atol=1e-10,rtol=1e-10,y0=sol.y[:,-1])
+    np.testing.assert_allclose(split,whole,rtol=1e-6,atol=1e-12)
+
+@pytest.mark.parametrize('extra',[['--method','BDF'],['--cache','solutions'],['--ages','ages.csv']])
+def test_ensemble_rejects_ignored_options(monkeypatch,extra):
+    monkeypatch.setattr(sys,'argv',['t028.py','--ensemble']+extra)
+    with pytest.raises(SystemExit):
+        t028.parse_args()
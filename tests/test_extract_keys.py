@@ -0,0 +1,56 @@
+# test_extract_keys.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Counting words for each document, when some files can't be read
+
+import json, os, pytest
+from conftest import load_script
+
+@pytest.fixture
+def extract_keys(monkeypatch):
+    module = load_script('extract-keys')
+    # A blank pipeline has no lemmas, so count the words themselves
+    monkeypatch.setattr(module,'get_words',lambda doc: (token.text.lower() for token in doc if token.is_alpha))
+    return module
+
+def write_paper(path,paper_id,text):
+    file_name = os.path.join(path,f'{paper_id}.json')
+    with open(file_name,'w') as json_file:
+        json.dump({'paper_id':paper_id,'metadata':{'title':paper_id},'body_text':[{'text':text}]},json_file)
+    return file_name
+
+def test_count_documents_skips_unreadable(tmp_path,extract_keys):
+    truncated = os.path.join(tmp_path,'truncated.json')
+    with open(truncated,'w') as json_file:
+        json.dump({'paper_id':'truncated'},json_file)           # No body_text
+    broken    = os.path.join(tmp_path,'broken.json')
+    with open(broken,'w') as json_file:
+        json_file.write('{"paper_id": "broken", "body')
+    file_names = [write_paper(tmp_path,'a','alpha beta'),
+                  broken,
+                  write_paper(tmp_path,'b','gamma gamma'),
+                  os.path.join(tmp_path,'missing.json'),
+                  truncated,
+                  write_paper(tmp_path,'c','delta')]
+    counts,errors = extract_keys.count_documents(file_names,batch_size=2)
+    assert counts==[{'alpha':1,'beta':1},None,{'gamma':2},None,None,{'delta':1}]
+    assert sorted(os.path.basename(file_name) for file_name,_,_ in errors.errors)==['broken.json','missing.json','truncated.json']
+
+def test_count_documents_document_mode(tmp_path,extract_keys):
+    file_names = [write_paper(tmp_path,'a','alpha alpha beta')]
+    counts,_   = extract_keys.count_documents(file_names,mode='document')
+    assert counts==[{'alpha':1,'beta':1}]
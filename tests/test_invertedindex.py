@@ -0,0 +1,73 @@
+# test_invertedindex.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Queries of an index, built in shards that are then merged, agree with a direct search
+# of the documents.
+
+import random, numpy as np, invertedindex
+
+def get_documents(n=300,seed=1):
+    rng        = random.Random(seed)
+    vocabulary = [f'word{i}' for i in range(200)]
+    return {f'paper{i}':set(rng.choices(vocabulary,weights=[1/(rank+1) for rank in range(200)],k=30))
+            for i in range(n)}
+
+def create_index(documents,path,shards=3):
+    writers = [invertedindex.IndexWriter() for _ in range(shards)]
+    for i,(paper_id,words) in enumerate(documents.items()):
+        writers[i*shards//len(documents)].add(paper_id,words)
+    for writer in writers[1:]:
+        writers[0].merge(writer)
+    writers[0].save(path)
+    return invertedindex.InvertedIndex(path)
+
+def test_queries(tmp_path):
+    documents = get_documents()
+    index     = create_index(documents,str(tmp_path))
+    assert index.papers==list(documents)
+    for words in [['word0'],['word0','word1'],['word3','word17','word40'],['word0','unknown']]:
+        assert index.query_and(words)==[paper_id for paper_id,found in documents.items() if found.issuperset(words)]
+        assert index.query_or(words)==[paper_id for paper_id,found in documents.items() if found & set(words)]
+    for word in ['word0','word150','unknown']:
+        assert index.get_document_frequency(word)==sum(word in found for found in documents.values())
+
+def test_top(tmp_path):
+    documents = get_documents()
+    index     = create_index(documents,str(tmp_path))
+    counts    = {}
+    for found in documents.values():
+        for word in found:
+            counts[word] = counts.get(word,0) + 1
+    expected  = sorted(counts.items(),key=lambda item:(-item[1],item[0]))
+    assert index.get_top(10)==expected[:10]
+    assert index.get_top(5,prefix='word1')==[item for item in expected if item[0].startswith('word1')][:5]
+    assert index.get_top(5,prefix='none')==[]
+
+def test_merge_adds_words(tmp_path):
+    writer = invertedindex.IndexWriter()
+    writer.add('a',['x','y'])
+    other  = invertedindex.IndexWriter()
+    other.add('b',['y','z'])
+    other.add('c',[])
+    writer.merge(other)
+    writer.add_words(writer.add('d',['z']),['x'])
+    writer.merge(invertedindex.IndexWriter())
+    writer.save(str(tmp_path))
+    index  = invertedindex.InvertedIndex(str(tmp_path))
+    assert index.papers==['a','b','c','d']
+    assert [list(index.get_documents(word)) for word in ['x','y','z']]==[[0,3],[0,1],[1,3]]
+    assert index.postings.dtype==np.uint8
@@ -0,0 +1,58 @@
+# test_metapop.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# The exact Jacobian of the metapopulation model agrees with finite differences, in
+# regions where the ICUs are overwhelmed and where they are not; uncoupled regions
+# evolve as the SEPIR model; and all methods agree.
+
+import numpy as np, pytest, metapop, sepir
+from scipy import sparse
+from conftest import get_numerical_jacobian, get_state
+
+def test_metapop_jacobian():
+    rng  = np.random.default_rng(3)
+    R    = 4
+    C    = sparse.csr_matrix(np.eye(R) + 0.05*rng.uniform(size=(R,R))*(rng.uniform(size=(R,R))<0.5))
+    y    = get_state(rng,np.array([1e-6,0.1,1e-6,0.1]),size=R)
+    N    = rng.uniform(1e6,5e6,R)
+    args = (C,N,0.1,0.25,rng.uniform(0.2,0.4,R),0.1,1.0,0.15,0.02,0.01,rng.uniform(50,100,R),0.0125)
+    I    = y.reshape(7,R)[3] + y.reshape(7,R)[4]
+    assert list(I*N*0.0125>args[10])==[False,True,False,True]      # ICUs overwhelmed in some regions
+    np.testing.assert_allclose(metapop.jacobian(0,y,*args).toarray(),
+                               get_numerical_jacobian(lambda y: metapop.dy(0,y,*args),y),
+                               rtol=1e-5,atol=1e-9)
+
+def test_uncoupled_regions_match_sepir():
+    N    = np.array([1e6,3e6,5e6])
+    nICU = np.array([50,200,300])
+    sol  = metapop.evolve_regions(sparse.identity(3),N,nICU,[10,20,30],NPIs=[[],[],[]],
+                                  t_range=(0,300),t_eval=[300],atol=1e-12,rtol=1e-10)
+    for r in range(3):
+        single = sepir.solve((0,300),sepir.get_initial_y(initial=10*(r+1),N=N[r]),
+                             args=(N[r],0.1,0.25,sepir.get_beta(),0.1,1,0.15,0.02,0.01,nICU[r],0.0125),
+                             atol=1e-12,rtol=1e-10,t_eval=[300])
+        # Deaths differ, since sepir.dy lets CFR fall below CFR0 while ICUs have room
+        np.testing.assert_allclose(sol.y[:5,r,-1],single.y[:5,-1],rtol=1e-5,atol=1e-10)
+
+@pytest.mark.parametrize('method,analytic',[('BDF',True),('BDF',False),('Radau',True)])
+def test_methods_agree(method,analytic):
+    C,N,nICU = metapop.create_regions(R=10,rng=np.random.default_rng(5))
+    NPIs     = [[(100+r,0.5)] for r in range(10)]
+    expected = metapop.evolve_regions(C,N,nICU,np.full(10,10),NPIs=NPIs,t_eval=[200],atol=1e-10,rtol=1e-8)
+    sol      = metapop.evolve_regions(C,N,nICU,np.full(10,10),NPIs=NPIs,t_eval=[200],atol=1e-10,rtol=1e-8,
+                                      method=method,analytic=analytic)
+    np.testing.assert_allclose(sol.y,expected.y,rtol=1e-3,atol=1e-8)
@@ -0,0 +1,59 @@
+# test_sensitivity.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Sobol indices of the Ishigami function, whose values are known analytically
+#
+#     f(x) = sin(x1) + a sin(x2)^2 + b x3^4 sin(x1), x uniform in [-pi,pi]^3
+
+import math, numpy as np, sensitivity
+
+def get_ishigami_indices(a=7,b=0.1):
+    V1       = 0.5*(1 + b*math.pi**4/5)**2
+    V2       = a**2/8
+    V13      = b**2*math.pi**8*(1/18 - 1/50)
+    variance = V1 + V2 + V13
+    return np.array([V1,V2,0])/variance, np.array([V1+V13,V2,V13])/variance
+
+def test_ishigami():
+    k,samples = 3,2**14
+    U         = sensitivity.create_saltelli(0,samples,k,entropy=7)*2*math.pi - math.pi
+    Y         = np.sin(U[:,0]) + 7*np.sin(U[:,1])**2 + 0.1*U[:,2]**4*np.sin(U[:,0])
+    indices   = sensitivity.bootstrap(sensitivity.get_saltelli_terms(Y.reshape(samples,k+2)),
+                                      sensitivity.get_sobol_indices,
+                                      resamples = 200,
+                                      rng       = np.random.default_rng(1))
+    S1,ST     = get_ishigami_indices()
+    np.testing.assert_allclose(indices['S1'][0],S1,atol=0.02)
+    np.testing.assert_allclose(indices['ST'][0],ST,atol=0.02)
+    for name,expected in [('S1',S1),('ST',ST)]:
+        _,lower,upper = indices[name]
+        assert np.all(lower<=upper)
+        assert np.all((lower-0.02<=expected) & (expected<=upper+0.02))
+
+def test_saltelli_batches():
+    whole   = sensitivity.create_saltelli(0,64,5,entropy=3)
+    batched = np.vstack([sensitivity.create_saltelli(0,20,5,entropy=3),sensitivity.create_saltelli(20,64,5,entropy=3)])
+    np.testing.assert_array_equal(whole,batched)
+
+def test_morris_steps():
+    k,levels = 4,4
+    U        = sensitivity.create_morris(0,10,k,entropy=5,levels=levels).reshape(10,k+1,k)
+    steps    = np.diff(U,axis=1)
+    assert np.all(np.count_nonzero(steps,axis=2)==1)                        # One factor at a time
+    assert np.all(np.sort(np.argmax(np.abs(steps),axis=2),axis=1)==np.arange(k))
+    assert np.allclose(np.abs(steps).sum(axis=2),levels/(2*(levels-1)))
+    assert np.all((U>=0) & (U<=1))
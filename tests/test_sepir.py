@@ -0,0 +1,54 @@
+# test_sepir.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# The vectorized right hand side agrees with dy for every shape of state, the exact
+# Jacobian agrees with finite differences, and explicit and implicit solvers agree.
+
+import numpy as np, pytest, sepir
+from conftest import get_numerical_jacobian, get_state
+
+ARGS = (5000000,0.1,0.25,0.3,0.1,1.0,0.15,0.02,0.01,300,0.0125)
+
+@pytest.mark.parametrize('infected',[1e-4,0.1])
+def test_sepir_jacobian(infected):
+    rng  = np.random.default_rng(1)
+    y    = get_state(rng,infected)
+    np.testing.assert_allclose(sepir.jacobian(0,y,*ARGS),
+                               get_numerical_jacobian(lambda y: sepir.dy(0,y,*ARGS),y),
+                               rtol=1e-5,atol=1e-9)
+
+def test_dy_vectorized_matches_dy():
+    rng      = np.random.default_rng(2)
+    y        = get_state(rng,0.1,size=5).reshape(7,5)
+    expected = np.array([sepir.dy(0,column,*ARGS) for column in y.T]).T
+    np.testing.assert_allclose(sepir.dy_vectorized(0,y,*ARGS),expected,rtol=1e-12,atol=1e-15)
+    for k,column in enumerate(y.T):
+        np.testing.assert_allclose(sepir.dy_vectorized(0,column,*ARGS),expected[:,k],rtol=1e-12,atol=1e-15)
+        np.testing.assert_allclose(sepir.dy_vectorized(0,column[:,None],*ARGS),expected[:,k:k+1],rtol=1e-12,atol=1e-15)
+        out = np.empty(7)
+        assert sepir.dy_vectorized(0,column,*ARGS,out=out) is out
+        np.testing.assert_allclose(out,expected[:,k],rtol=1e-12,atol=1e-15)
+
+def test_solver_options():
+    assert sepir.get_solver_options('RK45')==dict(method='RK45')
+    assert sepir.get_solver_options('BDF')==dict(method='BDF',vectorized=True,jac=sepir.jacobian)
+
+def test_explicit_and_implicit_agree():
+    y0       = sepir.get_initial_y(initial=20,N=5000000)
+    explicit = sepir.solve((0,300),y0,args=ARGS,method='RK45',atol=1e-10,rtol=1e-8,t_eval=[300])
+    implicit = sepir.solve((0,300),y0,args=ARGS,method='BDF',atol=1e-10,rtol=1e-8,t_eval=[300])
+    np.testing.assert_allclose(implicit.y,explicit.y,rtol=1e-4,atol=1e-8)
@@ -0,0 +1,55 @@
+# test_stochastic.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# The stochastic model runs for any valid parameters, conserves people, agrees on average
+# with the deterministic model, and gives the same results however replicates are shared
+# among processes.
+
+import argparse, numpy as np, pytest, sepir, stochastic
+
+def test_CFR():
+    CFR = stochastic.get_CFR(np.array([0,10,1000,100000]),0.02,0.01,300,0.0125)
+    assert list(CFR[:3])==[0.01,0.01,0.01]                     # ICU not overwhelmed
+    assert 0.01<CFR[3]<0.02
+    np.testing.assert_allclose(CFR[3],0.02 - 300/(100000*0.0125)*0.01)
+
+@pytest.mark.parametrize('CFR1,CFR0,nICU',[(0.01,0.01,300),      # CFR1==CFR0
+                                           (0.02,0.01,0)])       # No beds
+def test_edge_parameters(CFR1,CFR0,nICU):
+    summaries,y = stochastic.evolve_stochastic(M=20,CFR1=CFR1,CFR0=CFR0,nICU=nICU,N=100000,t_range=(0,300),
+                                               rng=np.random.default_rng(1))
+    affected    = summaries['infections'] - y[stochastic.E:stochastic.I1+1].sum(axis=0)
+    np.testing.assert_allclose(summaries['deaths'].sum()/affected.sum(),CFR1,rtol=0.1)
+
+def test_conservation_and_mean():
+    N           = 100000
+    summaries,y = stochastic.evolve_stochastic(M=50,N=N,t_range=(0,300),rng=np.random.default_rng(2))
+    np.testing.assert_array_equal(y.sum(axis=0) + summaries['deaths'],N)
+    assert np.all(y>=0)
+    major       = ~summaries['extinct'] | (summaries['infections']>0.1*N)
+    sol         = sepir.solve((0,300),sepir.get_initial_y(initial=20,N=N),
+                              args=(N,0.1,0.25,sepir.get_beta(),0.1,1,0.15,0.02,0.01,300,0.0125),
+                              atol=1e-10,rtol=1e-8)
+    np.testing.assert_allclose(summaries['infections'][major].mean(),N*(1-sol.y[0,-1]),rtol=0.02)
+
+def test_independent_of_workers():
+    args = argparse.Namespace(M=30,R0=2.5,end=100,N=20000,initial=5,c=0.1,alpha=0.25,gamma=0.1,delta=1.0,
+                              epsilon=0.15,CFR1=0.02,CFR0=0.01,nICU=30,pICU=0.0125,trigger=50,tolerance=0.03,
+                              max_tau=1.0,critical=100,seed=4,chunk=10,workers=None)
+    serial       = stochastic.simulate(args)
+    args.workers = 2
+    np.testing.assert_array_equal(stochastic.simulate(args),serial)
@@ -0,0 +1,47 @@
+# test_t028.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Monte Carlo results depend only on the seed, and evolveR0 applies NPIs
+
+import sys, numpy as np, pytest, t028
+
+# get_args
+#
+# Parse command line for t028
+
+def get_args(monkeypatch,*extra):
+    monkeypatch.setattr(sys,'argv',['t028.py','--M','12','--seed','3','--batch','5']+list(extra))
+    return t028.parse_args()
+
+# get_values
+#
+# Values accumulated by monte_carlo, for comparison
+
+def get_values(args):
+    return [(y.n,y.mean,y.std(),y.min,y.max) for y in t028.monte_carlo(args,args.start)]
+
+@pytest.mark.parametrize('extra',[['--workers','1'],['--workers','3'],['--batch','12']])
+def test_monte_carlo_independent_of_workers(monkeypatch,extra):
+    np.testing.assert_allclose(get_values(get_args(monkeypatch,*extra)),
+                               get_values(get_args(monkeypatch)),
+                               rtol=1e-12)
+
+def test_evolveR0_applies_NPIs():
+    sol,R0s = t028.evolveR0(NPIs=[(100,0.5),(120,0.5)],t_range=(0,200))
+    assert R0s==[2.5,1.25,0.625]
+    assert np.all(np.diff(sol.t)>0)
+    assert {100,120}<=set(sol.t)
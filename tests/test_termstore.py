@@ -0,0 +1,69 @@
+# test_termstore.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# TermStore finds new, modified and deleted documents, ignores documents that were only
+# touched, and keeps totals for the corpus in step with the counts for each document.
+
+import os, pytest, termstore
+
+def write(root,name,text,mtime=None):
+    path = root/name
+    path.write_text(text)
+    if mtime!=None:
+        os.utime(path,(mtime,mtime))
+
+def record(store,changed,counts):
+    for path,mtime,size,hash in changed:
+        store.add(path,mtime,size,hash,counts[path])
+    store.commit()
+
+def test_changes(tmp_path):
+    root = tmp_path/'corpus'
+    root.mkdir()
+    write(root,'a.json','alpha beta',mtime=1000)
+    write(root,'b.json','beta gamma',mtime=1000)
+    store           = termstore.TermStore(str(tmp_path/'keywords.db'),root=str(root))
+    changed,deleted = store.get_changes(['a.json','b.json'])
+    assert [path for path,_,_,_ in changed]==['a.json','b.json'] and deleted==[]
+    record(store,changed,{'a.json':{'alpha':1,'beta':1},'b.json':{'beta':1,'gamma':1}})
+    assert store.get_frequencies()==[('beta',2),('alpha',1),('gamma',1)]
+    
+    assert store.get_changes(['a.json','b.json'])==([],[])                # Nothing has changed
+    
+    write(root,'a.json','alpha beta',mtime=2000)                         # Touched, but the same
+    assert store.get_changes(['a.json','b.json'])==([],[])
+    assert store.get_changes(['a.json','b.json'])==([],[])                # New time was recorded
+    
+    write(root,'b.json','delta',mtime=1000)                              # Modified
+    write(root,'c.json','delta',mtime=1000)                              # New
+    changed,deleted = store.get_changes(['b.json','c.json'])
+    assert [path for path,_,_,_ in changed]==['b.json','c.json'] and deleted==['a.json']
+    for path in deleted:
+        store.remove(path)
+    record(store,changed,{'b.json':{'delta':1},'c.json':{'delta':1}})
+    assert store.get_frequencies()==[('delta',2)]
+    store.close()
+    
+    reopened = termstore.TermStore(str(tmp_path/'keywords.db'),root=str(root))
+    assert reopened.get_frequencies(k=1)==[('delta',2)]
+    assert reopened.get_changes(['b.json','c.json'])==([],[])
+    reopened.close()
+
+def test_mode_must_match(tmp_path):
+    termstore.TermStore(str(tmp_path/'keywords.db'),mode='document').close()
+    with pytest.raises(ValueError):
+        termstore.TermStore(str(tmp_path/'keywords.db'),mode='term')
@@ -0,0 +1,69 @@
+# test_verify_links.py
+
+# Copyright (C) 2020 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.GA
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+# Snapshots of metadata are reused while the CSV file is unchanged, each set of columns
+# has its own, and an interrupted write leaves nothing behind.
+
+import os, pandas as pd, pytest
+from conftest import load_script
+
+verify_links = load_script('verify-links')
+
+COLUMNS = ['cord_uid','sha','pmcid','title']
+
+def write_csv(path,titles):
+    pd.DataFrame({'cord_uid' : [f'u{i}' for i in range(len(titles))],
+                  'sha'      : [f'{i:040x}' for i in range(len(titles))],
+                  'pmcid'    : ['']*len(titles),
+                  'title'    : titles,
+                  'abstract' : ['text']*len(titles)}).to_csv(path/'metadata.csv',index=False)
+
+def get_snapshots(path):
+    return sorted(name for name in os.listdir(path) if name.startswith('metadata.csv.'))
+
+def test_snapshots(tmp_path,monkeypatch):
+    write_csv(tmp_path,['A','B'])
+    snapshots = tmp_path/'snapshots'
+    first     = verify_links.create_meta_data(cord_path=str(tmp_path),snapshot=str(snapshots))
+    assert list(first['title'])==['A','B'] and len(get_snapshots(snapshots))==1
+    
+    other     = verify_links.create_meta_data(cord_path=str(tmp_path),columns=['cord_uid','abstract'],snapshot=str(snapshots))
+    assert list(other.columns)==['cord_uid','abstract'] and len(get_snapshots(snapshots))==2
+    
+    read_meta_data = verify_links.read_meta_data
+    monkeypatch.setattr(verify_links,'read_meta_data',lambda *args: pytest.fail('snapshot not used'))
+    pd.testing.assert_frame_equal(verify_links.create_meta_data(cord_path=str(tmp_path),snapshot=str(snapshots)),first)
+    monkeypatch.setattr(verify_links,'read_meta_data',read_meta_data)
+    
+    before    = get_snapshots(snapshots)
+    write_csv(tmp_path,['A','C'])
+    changed   = verify_links.create_meta_data(cord_path=str(tmp_path),snapshot=str(snapshots))
+    assert list(changed['title'])==['A','C']
+    after     = get_snapshots(snapshots)
+    assert len(after)==2 and len(set(before) & set(after))==1         # Only the snapshot with these columns was replaced
+
+def test_interrupted_snapshot(tmp_path,monkeypatch):
+    write_csv(tmp_path,['A','B'])
+    def interrupt(self,file_name):
+        with open(file_name,'wb') as file:
+            file.write(b'partial')
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(pd.DataFrame,'to_feather',interrupt)
+    monkeypatch.setattr(pd.DataFrame,'to_pickle',interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        verify_links.create_meta_data(cord_path=str(tmp_path))
+    assert os.listdir(tmp_path)==['metadata.csv']
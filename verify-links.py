@@ -35,83 +35,155 @@
 #      full_text_file
 #      url
 
-import json, os, pandas as pd, re, sys, numpy as np
+import corpus, hashlib, json, os, pandas as pd, re, sys, numpy as np
 from os.path import join
 from tempfile import NamedTemporaryFile
 
 
 
-def create_meta_data(metadata='metadata.csv',cord_path=''):
-    product         = pd.read_csv(join(cord_path,metadata), error_bad_lines=False, warn_bad_lines=True)
-    product.columns = [re.sub('[^_a-zA-Z0-9]+','_',col) for col in product.columns]
-    return product
+# create_meta_data
+#
+# Read the metadata that are needed to link papers, with missing values replaced by ''.
+# The cleaned metadata are saved in a snapshot (Feather if pyarrow is available, otherwise
+# pickle), which is reused for as long as the hash of the CSV file is unchanged. Snapshots
+# are named for the CSV file, the columns, and the hash, so each set of columns has its own.
+#
+# Parameters:
+#     metadata    Name of CSV file
+#     cord_path   Path to CSV file
+#     columns     Columns to be read (names with anything other than letters, digits, and _ replaced by _)
+#     snapshot    Directory for snapshot (default: same as CSV file); None to skip snapshot
 
-def create_json_dict(cord_path=''):
-    product = {}
-    for root, _, files in os.walk(cord_path):
-        for name in files:
-            if name.endswith('.json'):
-                absolute_json_file_path = join(root,name)
-                with open(absolute_json_file_path) as json_file:
-                    try:
-                        json_data = json.load(json_file)
-                        product[json_data['paper_id']] = json_data
-                    except (json.decoder.JSONDecodeError,UnicodeDecodeError) as err:
-                        print ('{0} error: {1}'.format(absolute_json_file_path,err))
+def create_meta_data(metadata='metadata.csv',cord_path='',columns=['cord_uid','sha','pmcid','title'],snapshot=''):
+    csv_file = join(cord_path,metadata)
+    if snapshot==None:
+        return read_meta_data(csv_file,columns)
+    
+    folder        = snapshot if snapshot!='' else os.path.dirname(os.path.abspath(csv_file))
+    prefix        = '{0}.{1}'.format(metadata,get_columns_key(columns))
+    snapshot_path = os.path.join(folder,'{0}.{1}'.format(prefix,get_hash(csv_file)))
+    for extension,read in [('.feather',pd.read_feather),('.pkl',pd.read_pickle)]:
+        if os.path.exists(snapshot_path+extension):
+            return read(snapshot_path+extension)
+    
+    product = read_meta_data(csv_file,columns)
+    os.makedirs(folder,exist_ok=True)
+    for name in os.listdir(folder):          # Remove snapshots of earlier versions, with the same columns
+        if re.fullmatch(re.escape(prefix)+r'\.[0-9a-f]{64}\.(feather|pkl)',name):
+            os.remove(os.path.join(folder,name))
+    try:
+        write_snapshot(product.to_feather,snapshot_path+'.feather')
+    except ImportError:
+        write_snapshot(product.to_pickle,snapshot_path+'.pkl')
     return product
 
+def read_meta_data(csv_file,columns):
+    names   = {re.sub('[^_a-zA-Z0-9]+','_',col):col for col in pd.read_csv(csv_file,nrows=0).columns}
+    product = pd.read_csv(csv_file,
+                          usecols     = [names[column] for column in columns],
+                          dtype       = {names[column]:str for column in columns},
+                          on_bad_lines= 'warn')
+    product.columns = [re.sub('[^_a-zA-Z0-9]+','_',col) for col in product.columns]
+    return product[columns].fillna('')
+
+# write_snapshot
+#
+# Write a snapshot to a temporary file, then rename it, so an interrupted write never
+# leaves a partial snapshot under a name that would be trusted later
+
+def write_snapshot(write,file_name):
+    with NamedTemporaryFile(dir=os.path.dirname(file_name),prefix='.tmp',delete=False) as temporary:
+        pass
+    try:
+        write(temporary.name)
+        os.replace(temporary.name,file_name)
+    except BaseException:
+        os.remove(temporary.name)
+        raise
+
+# get_columns_key
+#
+# Short hash of the columns that are read
+
+def get_columns_key(columns):
+    return hashlib.sha256(','.join(columns).encode()).hexdigest()[:16]
+
+# get_hash
+#
+# Hash of the contents of a file
+
+def get_hash(file_name,block_size=2**20):
+    hash = hashlib.sha256()
+    with open(file_name,'rb') as file:
+        for block in iter(lambda: file.read(block_size),b''):
+            hash.update(block)
+    return hash.hexdigest()
+
+# create_json_dict
+#
+# Generator for paper_id of each json file (see corpus.scan_papers). The rest of
+# each file is not kept, and files that can't be read are recorded in errors.
+
+def create_json_dict(cord_path='',errors=None,threads=8):
+    return corpus.scan_papers(cord_path,errors=errors,threads=threads)
+
+# link_data
+#
+# Verify that each paper has metadata, matching its id with either sha or pmcid. Papers
+# are looked up in indices built once from the metadata, rather than by scanning the
+# metadata for each paper.
+#
+# Parameters:
+#     metadata   Metadata, with shas split by fix_semicolons
+#     papers     Ids of papers (e.g. from create_json_dict). A paper that appears in more than
+#                one file is counted once, as when papers were collected in a dict.
 
-    
 def link_data(metadata,papers):
-    matched     = 0
-    not_matched = 0
-    for paper_sha in papers.keys():
-        matches_sha = metadata.loc[metadata.sha==paper_sha,'title']
-        if matches_sha.count()==1:
-            matched+=1
-        else:
-            matches_pmcid = metadata.loc[metadata.pmcid==paper_sha,'title']
-            if matches_pmcid.count()>0:
-                matched+=1
-            else:
-                print (paper_sha)
-                not_matched+=1
+    titled      = metadata.loc[metadata.title.notna(),['sha','pmcid']]
+    sha_counts  = titled.sha.value_counts()
+    pmcids      = set(titled.pmcid)
+    paper_ids   = pd.Index(list(dict.fromkeys(papers)),dtype=object)
+    is_matched  = (paper_ids.map(sha_counts).fillna(0)==1) | paper_ids.isin(pmcids)
+    for paper_id in paper_ids[~is_matched]:
+        print (paper_id)
+    matched     = int(is_matched.sum())
+    not_matched = len(paper_ids) - matched
     print ('matched={0}, not_matched={1}, {2}%'.format(matched, not_matched, int(100*not_matched/(matched+not_matched))))    
 
 # fix_semicolons
 #
 # Some metadata records have several shas concatenated - fix them
 #
-# Split sha on semicolon, using an idea from Suresh Sardar
+# Split sha on semicolon, exploding each list of shas into rows, using an idea from Suresh Sardar
 # https://medium.com/@sureshssarda/pandas-splitting-exploding-a-column-into-multiple-rows-b1b1d59ea12e
 
 def fix_semicolons(metadata):
     select_semicolons = metadata.sha.str.contains(';')
-    df2_semicolons    = metadata.loc[select_semicolons,]
     df_plain          = metadata.loc[~select_semicolons,]
-    df_split          = pd.DataFrame(df2_semicolons.sha.str.split('; ').tolist(), index=df2_semicolons.sha).stack()
-    df_split          = df_split.reset_index([0, 'sha'])
-    df_split.columns  = ['sha_concat', 'sha']
-    df_split.drop_duplicates(inplace=True)
-    df_split          = df_split.join(df2_semicolons.set_index('sha'),on='sha_concat',how='outer')
-    df_split.drop(columns='sha_concat',inplace=True)
+    df_split          = metadata.loc[select_semicolons,]
+    df_split          = df_split.assign(sha=df_split.sha.str.split('; ')).explode('sha')
+    df_split          = df_split.loc[~df_split.set_index('sha',append=True).index.duplicated()]
     return pd.concat([df_plain, df_split], axis=0)
     
-
-    
 if __name__=='__main__':
     import argparse
     
     parser = argparse.ArgumentParser()
     parser.add_argument('--path', default=r'C:\CORD-19')
     parser.add_argument('--metadata', default ='metadata.csv')
+    parser.add_argument('--snapshot', default ='', help='Directory for snapshot of metadata (default: same as metadata)')
+    parser.add_argument('--no-snapshot', default=False, action='store_true', help='Read metadata without using a snapshot')
+    parser.add_argument('--threads', default=8, type=int, help='Number of threads reading json files')
     args = parser.parse_args()
     
-    metadata = create_meta_data(metadata=args.metadata,cord_path=args.path)
-    metadata = metadata.replace(np.nan,'',regex=True)
+    metadata = create_meta_data(metadata  = args.metadata,
+                                cord_path = args.path,
+                                snapshot  = None if args.no_snapshot else args.snapshot)
     
     
-    papers   = create_json_dict(cord_path=args.path)
+    errors   = corpus.Errors()
+    papers   = create_json_dict(cord_path=args.path,errors=errors,threads=args.threads)
     link_data(fix_semicolons(metadata),papers)
+    errors.report()
   
     
\ No newline at end of file